@@ -35,17 +35,66 @@ import argparse
 import pkg_resources
 import subprocess
 
+import nibabel as nb
+
 from cbicqc.cbicqc import CBICQC
+from cbicqc.realtime import IncrementalQC, follow_directory
 
 
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Lightweight daily phantom QC analysis and reporting')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'watch', 'realtime'],
+                        help='Analyze all sessions once (run), keep analyzing new sessions as they arrive (watch)'
+                             ' or follow a series volume by volume as it is acquired (realtime)')
     parser.add_argument('-d', '--dir', default='.', help='BIDS QC dataset directory')
     parser.add_argument('-m', '--mode', default='phantom', help="QC Mode (phantom or live)")
     parser.add_argument('-p', '--past', default=12, type=int, help='Number of past months to summarize [12]')
     parser.add_argument('--sub', default='', help='Subject ID')
     parser.add_argument('--ses', default='', help='Session ID')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of sessions to analyze in parallel [1]')
+    parser.add_argument('--plot-jobs', default=1, type=int,
+                        help='Number of report figures to render in parallel (0 : one per CPU) [1]')
+    parser.add_argument('--fig-format', default='png', choices=['png', 'svg'],
+                        help='Report figure format (svg embeds vector figures, requires svglib) [png]')
+    parser.add_argument('--fig-dpi', default=150, type=int, help='Report raster figure resolution [150]')
+    parser.add_argument('--carpet-rows', default=200, type=int,
+                        help='Demeaned carpet plot rows per ROI (0 : every ROI voxel) [200]')
+    parser.add_argument('--carpet-method', default='sample', choices=['sample', 'minmax'],
+                        help='Carpet row reduction, voxel sampling or min/max decimation [sample]')
+    parser.add_argument('--spectrum', default='periodogram', choices=['periodogram', 'welch', 'multitaper'],
+                        help='Power spectrum estimator for ROI and motion spectra [periodogram]')
+    parser.add_argument('--spec-band', nargs=2, type=float, action='append', default=[], metavar=('LO', 'HI'),
+                        help='Frequency band (Hz) for voxelwise band power maps, repeatable '
+                             '[around the dominant signal peak]')
+    parser.add_argument('--no-cache', action='store_true', help='Recompute all analysis stages without caching')
+    parser.add_argument('--cache-gb', default=20.0, type=float,
+                        help='Maximum stage cache size in GB, least recently used removed first (0 : no limit) [20]')
+    parser.add_argument('--cache-days', default=90.0, type=float,
+                        help='Remove stage cache entries unused for this many days (0 : no limit) [90]')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record per-stage peak memory with tracemalloc in stage traces (slower) [RSS only]')
+    parser.add_argument('--chunk-mb', default=0, type=float,
+                        help='Stream the QC series from disk in chunks of this size (MB) rather than loading it [0]')
+    parser.add_argument('--moco', action='store_true',
+                        help='Motion correct the QC series before analysis (loads the whole series) [off]')
+    parser.add_argument('--resample', default='spline', choices=['spline', 'fourier'],
+                        help='Phantom motion correction resampling with --moco (spline or FFT phase ramp) [spline]')
+    parser.add_argument('--moco-engine', default='mcflirt', choices=['mcflirt', 'native'],
+                        help='Live mode motion correction with --moco, FSL MCFLIRT or in-process rigid registration'
+                             ' [mcflirt]')
+    parser.add_argument('--localizer', default='sphere', choices=['sphere', 'flirt'],
+                        help='Phantom localizer, in-process sphere fit or FLIRT template registration [sphere]')
+    parser.add_argument('--poll', default=30.0, type=float, help='Watch mode polling interval in seconds [30]')
+    parser.add_argument('--settle', default=120.0, type=float,
+                        help='Watch mode wait in seconds after last file change before analysis [120]')
+    parser.add_argument('--rt-dir', default='', help='Realtime mode directory receiving 3D NIfTI volumes')
+    parser.add_argument('--rt-rois', default='',
+                        help='Realtime mode ROI label image, required unless --mode phantom'
+                             ' (default: phantom ROIs from the running mean)')
+    parser.add_argument('--every', default=10, type=int, help='Realtime mode partial metrics interval in volumes [10]')
+    parser.add_argument('--rt-timeout', default=60.0, type=float,
+                        help='Realtime mode stop after this many seconds without a new volume [60]')
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -54,6 +103,9 @@ def main():
     sess_id = args.ses
     mode = args.mode
     past_months = args.past
+    n_jobs = args.jobs
+    use_cache = not args.no_cache
+    chunk_mb = args.chunk_mb
 
     # Read version from setup.py
     ver = pkg_resources.get_distribution('cbicqc').version
@@ -69,12 +121,46 @@ def main():
     print('Subject : {}'.format(subj_id if len(subj_id) > 0 else 'All Subjects'))
     print('Session : {}'.format(sess_id if len(sess_id) > 0 else 'All Sessions'))
     print('Summary : {} months'.format(past_months))
+    print('Jobs : {}'.format(n_jobs))
+
+    # Real-time incremental QC of a series still being acquired
+    if args.command == 'realtime':
+
+        if not args.rt_dir:
+            print('* Realtime mode requires --rt-dir')
+            sys.exit(1)
+
+        # ROIs are only localized automatically for the phantom
+        if 'phantom' not in mode and not args.rt_rois:
+            print('* Realtime {} mode requires --rt-rois'.format(mode))
+            sys.exit(1)
+
+        rois_nii = nb.load(args.rt_rois) if args.rt_rois else None
+
+        report_dir = os.path.join(bids_dir, 'derivatives', 'cbicqc')
+        os.makedirs(report_dir, exist_ok=True)
+
+        follow_directory(os.path.realpath(args.rt_dir),
+                         IncrementalQC(rois_nii=rois_nii, report_every=args.every),
+                         metrics_fname=os.path.join(report_dir, 'realtime_metrics.json'),
+                         poll_interval=1.0, timeout=args.rt_timeout)
+
+        sys.exit(0)
 
     # Setup QC analysis
-    qc = CBICQC(bids_dir=bids_dir, subject=subj_id, session=sess_id, mode=mode, past_months=past_months)
+    qc = CBICQC(bids_dir=bids_dir, subject=subj_id, session=sess_id, mode=mode, past_months=past_months,
+                n_jobs=n_jobs, use_cache=use_cache, cache_gb=args.cache_gb, cache_days=args.cache_days,
+                chunk_mb=chunk_mb, moco=args.moco, resample=args.resample, moco_engine=args.moco_engine,
+                localizer=args.localizer, plot_jobs=args.plot_jobs,
+                fig_format=args.fig_format, fig_dpi=args.fig_dpi,
+                carpet_rows=args.carpet_rows, carpet_method=args.carpet_method,
+                spectrum=args.spectrum, spec_bands=args.spec_band, trace_memory=args.trace_memory)
 
     # Run analysis
-    qc.run()
+    if args.command == 'watch':
+        qc.watch(poll_interval=args.poll, settle_time=args.settle)
+    else:
+        qc.run()
 
     # Clean exit
     sys.exit(0)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache for analysis pipeline stages
+Each stage result is keyed by a hash of its upstream keys, parameters and code version
+so only stages downstream of a change are rerun
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import ast
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import inspect
+import tempfile
+import pkg_resources
+import numpy as np
+import nibabel as nb
+
+
+class StageCache:
+
+    def __init__(self, cache_dir, enabled=True):
+        """
+        Content-addressed store of pipeline stage results
+
+        :param cache_dir: str, cache root directory (typically derivatives/cbicqc/cache)
+        :param enabled: bool, if False every stage is recomputed and nothing is stored
+        """
+
+        self._cache_dir = cache_dir
+        self._enabled = enabled
+
+        # True if the most recent stage result came from the cache
+        self.hit = False
+
+        # Source hashes of stage modules, computed once per process
+        self._code_versions = dict()
+        self._templates_key = None
+
+        try:
+            self._pkg_version = pkg_resources.get_distribution('cbicqc').version
+        except pkg_resources.DistributionNotFound:
+            self._pkg_version = 'unknown'
+
+        if self._enabled:
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+    def run(self, func, args=(), deps=(), params=None, files=(), keep=True):
+        """
+        Return cached stage result if available, otherwise run stage and cache its result
+
+        :param func: callable, stage function
+        :param args: tuple, positional data arguments passed to func (not hashed)
+        :param deps: list, keys of upstream stages or input content hashes that determine args
+        :param params: dict, keyword arguments passed to func and included in the key
+        :param files: list, output files written by func, cached alongside its return value
+        :param keep: bool, cache the result - False for results that would duplicate the QC series
+            on disk (motion corrected 4D series), which always rerun but still key downstream stages
+        :return result: stage function return value
+        :return key: str, cache key of this stage result for use by downstream stages
+        """
+
+        params = params or dict()
+
+        if not keep:
+            self.hit = False
+            return func(*args, **params), self._stage_key(func, deps, params)
+
+        found, result, key = self.lookup(func, deps=deps, params=params, files=files)
+
+        if found:
+            return result, key
+
+        result = func(*args, **params)
+
+        self.store(key, result, files)
+
+        return result, key
+
+    def lookup(self, func, deps=(), params=None, files=()):
+        """
+        Cached stage result without running the stage
+        Lets callers dispatch only the missing stages (eg to a worker pool) then store them
+
+        :param func: callable, stage function
+        :param deps: list, keys of upstream stages or input content hashes that determine args
+        :param params: dict, keyword arguments passed to func and included in the key
+        :param files: list, output files restored from the cache on a hit
+        :return found: bool, True if the stage result was in the cache
+        :return result: cached stage return value, or None
+        :return key: str, cache key of this stage result
+        """
+
+        params = params or dict()
+
+        key = self._stage_key(func, deps, params)
+        entry_dir = self._entry_dir(key)
+
+        if self._enabled and os.path.isfile(os.path.join(entry_dir, 'result.pkl')):
+
+            print('      Using cached {}'.format(func.__name__))
+
+            with open(os.path.join(entry_dir, 'result.pkl'), 'rb') as fd:
+                result = pickle.load(fd)
+
+            for fc, fname in enumerate(files):
+                shutil.copyfile(os.path.join(entry_dir, 'file_{}'.format(fc)), fname)
+
+            # Mark the entry as recently used for pruning
+            try:
+                os.utime(entry_dir)
+            except OSError:
+                pass
+
+            self.hit = True
+
+            return True, result, key
+
+        self.hit = False
+
+        return False, None, key
+
+    def store(self, key, result, files=()):
+        """
+        Cache a stage result computed outside run()
+
+        :param key: str, cache key from lookup()
+        :param result: stage function return value
+        :param files: list, output files written by the stage
+        """
+
+        if self._enabled:
+            self._store(self._entry_dir(key), result, files)
+
+    def prune(self, max_gb=20.0, max_age_days=90.0):
+        """
+        Remove cache entries unused for max_age_days, then least recently used entries
+        until the cache is no larger than max_gb
+
+        :param max_gb: float, maximum total cache size in GB (0 : no size limit)
+        :param max_age_days: float, maximum days since an entry was stored or last used (0 : no age limit)
+        :return n_removed: int, number of entries removed
+        :return size_gb: float, cache size in GB after pruning
+        """
+
+        if not self._enabled or not os.path.isdir(self._cache_dir):
+            return 0, 0.0
+
+        # (last used, size, path) of every entry, including temporary entries left by interrupted stores
+        entries = []
+
+        for prefix in os.listdir(self._cache_dir):
+
+            prefix_dir = os.path.join(self._cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+
+            for name in os.listdir(prefix_dir):
+
+                entry_dir = os.path.join(prefix_dir, name)
+
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                    entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+                except OSError:
+                    continue
+
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        oldest = time.time() - max_age_days * 86400.0
+        max_bytes = max_gb * 2 ** 30
+
+        n_removed = 0
+
+        for mtime, size, entry_dir in entries:
+
+            if (max_age_days > 0 and mtime < oldest) or (max_gb > 0 and total > max_bytes):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                n_removed += 1
+            else:
+                break
+
+        return n_removed, total / 2 ** 30
+
+    @staticmethod
+    def key(*items):
+        """
+        SHA1 key from JSON-serializable items (stage names, upstream keys, parameters)
+        """
+
+        return hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def file_key(fname, block_size=1 << 20):
+        """
+        SHA1 hash of file contents
+        """
+
+        h = hashlib.sha1()
+
+        with open(fname, 'rb') as fd:
+            for block in iter(lambda: fd.read(block_size), b''):
+                h.update(block)
+
+        return h.hexdigest()
+
+    @staticmethod
+    def array_key(*arrays):
+        """
+        SHA1 hash of array contents, shapes and dtypes
+        """
+
+        h = hashlib.sha1()
+
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            h.update(str((a.shape, a.dtype.str)).encode())
+            h.update(a.tobytes())
+
+        return h.hexdigest()
+
+    def _stage_key(self, func, deps, params):
+
+        return self.key(func.__name__, self._code_version(func), list(deps), params)
+
+    def _code_version(self, func):
+        """
+        Package version plus hash of the source module defining the stage, the package modules
+        it imports (directly or indirectly) and the package template images
+        Editing a module invalidates only the stages that use it (and their dependents)
+        """
+
+        src_fname = inspect.getsourcefile(func)
+
+        if src_fname not in self._code_versions:
+
+            h = hashlib.sha1()
+            for fname in sorted(_package_imports(src_fname)):
+                h.update(self.file_key(fname).encode())
+            h.update(self._template_key().encode())
+
+            self._code_versions[src_fname] = '{}:{}'.format(self._pkg_version, h.hexdigest())
+
+        return self._code_versions[src_fname]
+
+    def _template_key(self):
+        """
+        Hash of the template images shipped with the package, computed once per process
+        """
+
+        if self._templates_key is None:
+
+            template_dir = pkg_resources.resource_filename('cbicqc', 'templates')
+
+            h = hashlib.sha1()
+            if os.path.isdir(template_dir):
+                for fname in sorted(os.listdir(template_dir)):
+                    h.update(fname.encode())
+                    h.update(self.file_key(os.path.join(template_dir, fname)).encode())
+
+            self._templates_key = h.hexdigest()
+
+        return self._templates_key
+
+    def _entry_dir(self, key):
+
+        return os.path.join(self._cache_dir, key[:2], key)
+
+    def _store(self, entry_dir, result, files):
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+        # Build entry in a temporary directory then rename into place
+        # Concurrent workers storing the same key simply discard their copy
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+
+        with open(os.path.join(tmp_dir, 'result.pkl'), 'wb') as fd:
+            pickle.dump(_in_memory(result), fd, protocol=pickle.HIGHEST_PROTOCOL)
+
+        for fc, fname in enumerate(files):
+            shutil.copyfile(fname, os.path.join(tmp_dir, 'file_{}'.format(fc)))
+
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _package_imports(src_fname):
+    """
+    Source files of a module and every module of the same package it imports, directly or indirectly
+    Only relative imports (from .module import ...) are followed, as used throughout cbicqc
+
+    :param src_fname: str, module source filename
+    :return: set, module source filenames including src_fname
+    """
+
+    pkg_dir = os.path.dirname(src_fname)
+
+    found = set()
+    todo = [src_fname]
+
+    while todo:
+
+        fname = todo.pop()
+        if fname in found or not os.path.isfile(fname):
+            continue
+        found.add(fname)
+
+        with open(fname) as fd:
+            tree = ast.parse(fd.read(), filename=fname)
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.level == 1:
+                modules = [node.module] if node.module else [alias.name for alias in node.names]
+                todo += [os.path.join(pkg_dir, *m.split('.')) + '.py' for m in modules]
+
+    return found
+
+
+def _in_memory(obj):
+    """
+    Replace file-backed Nifti images with in-memory copies so cached results
+    do not refer to files in a deleted work directory
+    """
+
+    if isinstance(obj, nb.spatialimages.SpatialImage):
+        return nb.Nifti1Image(np.asanyarray(obj.dataobj), obj.affine, obj.header)
+    elif isinstance(obj, tuple):
+        return tuple(_in_memory(o) for o in obj)
+    elif isinstance(obj, list):
+        return [_in_memory(o) for o in obj]
+
+    return obj
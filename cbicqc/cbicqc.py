@@ -35,32 +35,45 @@ SOFTWARE.
 """
 
 import os
-import sys
+import io
 import json
 import tempfile
 import shutil
+import time
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import nibabel as nb
-import datetime as dt
 import pandas as pd
 
-import bids
-
-from .timeseries import temporal_mean_sd, extract_timeseries, detrend_timeseries
+from .timeseries import temporal_mean_sd, temporal_mean_sd_streaming, extract_timeseries, detrend_timeseries
 from .graphics import (plot_roi_timeseries, plot_roi_powerspec,
                        plot_mopar_timeseries, plot_mopar_powerspec,
-                       orthoslices,
-                       roi_demeaned_ts)
-from .rois import register_template, make_rois
+                       orthoslice_sections, plot_orthoslices,
+                       roi_carpets, plot_roi_carpets, plot_slice_spikes, plot_weisskoff)
+from .rois import register_template, make_rois, xfm_cache_key
 from .metrics import qc_metrics
+from .maps import detrended_maps
+from .spectra import session_spectra, save_spectra, spectral_peak_maps
+from .spikes import slice_spikes, save_slice_spikes
+from .weisskoff import weisskoff
 from .moco import moco_phantom, moco_live
-from .report import ReportPDF
+from .rigid import moco_rigid
+from .report import ReportPDF, vector_figures_available
 from .summary import Summarize
+from .index import QCIndex
+from .cache import StageCache
+from .trace import StageTracer
+from .series import QCSeries
 
 
 class CBICQC:
 
-    def __init__(self, bids_dir, subject='', session='', mode='phantom', past_months=12):
+    def __init__(self, bids_dir, subject='', session='', mode='phantom', past_months=12, n_jobs=1,
+                 use_cache=True, cache_gb=20.0, cache_days=90.0, dtype='float32', chunk_mb=0, moco=False,
+                 resample='spline', moco_engine='mcflirt', localizer='sphere', plot_jobs=1, fig_format='png', fig_dpi=150, carpet_rows=200,
+                 carpet_method='sample', spectrum='periodogram', spec_bands=(), trace_memory=False):
 
         # Copy arguments into object
         self._bids_dir = bids_dir
@@ -68,6 +81,38 @@ class CBICQC:
         self._session = session
         self._mode = mode
         self._past_months = past_months
+        self._n_jobs = max(1, n_jobs)
+        self._use_cache = use_cache
+        self._dtype = dtype
+        self._chunk_mb = chunk_mb
+
+        # Motion correction is off by default (stationary phantom) - resample chooses the phantom
+        # resampling backend and moco_engine the live mode registration
+        self._do_moco = moco
+        self._resample = resample
+        self._moco_engine = moco_engine
+        self._localizer = localizer
+
+        # Report figure workers (1 : serial, 0 : one per CPU), started on first use and kept across sessions
+        self._plot_jobs = plot_jobs if plot_jobs > 0 else multiprocessing.cpu_count()
+        self._plot_pool = None
+
+        # Report figure format - SVG figures are embedded as vector drawings if svglib is available
+        if fig_format == 'svg' and not vector_figures_available():
+            print('* svglib not installed - embedding raster figures')
+            fig_format = 'png'
+        self._fig_format = fig_format
+        self._fig_dpi = fig_dpi
+
+        # Demeaned carpet rows per ROI (0 : every ROI voxel) and row reduction ('sample' or 'minmax')
+        self._carpet_rows = carpet_rows
+        self._carpet_method = carpet_method
+
+        # Power spectrum estimator ('periodogram', 'welch' or 'multitaper')
+        self._spectrum = spectrum
+
+        # Frequency bands (Hz) for band power maps, default : around the dominant signal ROI peak
+        self._spec_bands = [list(band) for band in spec_bands]
 
         # Phantom or in vivo suffix ('T2star' or 'bold')
         self._suffix = 'T2star' if 'phantom' in mode else 'bold'
@@ -76,28 +121,32 @@ class CBICQC:
         self._this_subject = ''
         self._this_session = ''
 
-        # BIDS layout
-        self._layout = None
-
         # Create work and report directories
         self._work_dir = tempfile.mkdtemp()
         self._report_dir = os.path.join(self._bids_dir, 'derivatives', 'cbicqc')
         os.makedirs(self._report_dir, exist_ok=True)
 
+        # Persistent session file index
+        self._index = QCIndex(self._bids_dir, os.path.join(self._report_dir, 'cbicqc_index.json'))
+
+        # Content-addressed analysis stage cache, pruned by size and age after each run or watch batch
+        self._cache = StageCache(os.path.join(self._report_dir, 'cache'), enabled=use_cache)
+        self._cache_gb = cache_gb
+        self._cache_days = cache_days
+
+        # Stage timing traces for this run (indexing, summaries) and the current session
+        # Per-stage peak memory needs tracemalloc, otherwise the RSS high-water mark is recorded
+        self._trace_memory = trace_memory
+        self._run_tracer = StageTracer(trace_memory)
+        self._tracer = None
+        self._run_trace_json = os.path.join(self._report_dir, 'cbicqc_trace.json')
+
         # Intermediate filenames
         self._report_pdf = ''
         self._report_json = ''
         self._tmean_fname = os.path.join(self._work_dir, 'tmean.nii.gz')
         self._tsd_fname = os.path.join(self._work_dir, 'tsd.nii.gz')
         self._roi_labels_fname = os.path.join(self._work_dir, 'roi_labels.nii.gz')
-        self._roi_ts_png = os.path.join(self._work_dir, 'roi_timeseries.png')
-        self._roi_ps_png = os.path.join(self._work_dir, 'roi_powerspec.png')
-        self._mopar_ts_png = os.path.join(self._work_dir, 'mopar_timeseries.png')
-        self._mopar_pspec_png = os.path.join(self._work_dir, 'mopar_powerspec.png')
-        self._tmean_montage_png = os.path.join(self._work_dir, 'tmean_montage.png')
-        self._tsd_montage_png = os.path.join(self._work_dir, 'tsd_montage.png')
-        self._rois_montage_png = os.path.join(self._work_dir, 'rois_montage.png')
-        self._rois_demeaned_png = os.path.join(self._work_dir, 'rois_demeaned.png')
 
         # Flags
         self._save_intermediates = False
@@ -112,98 +161,389 @@ class CBICQC:
         print('Starting CBIC QC analysis')
         print('')
 
-        # Index BIDS directory
-        print('  Indexing BIDS layout')
+        # Incrementally update BIDS session index
+        print('  Updating BIDS session index')
 
-        bids.config.set_option('extension_initial_dot', True)
-        self._layout = bids.BIDSLayout(self._bids_dir,
-                                  absolute_paths=True,
-                                  ignore=['sourcedata', 'work', 'derivatives', 'exclude'])
+        with self._run_tracer.stage('indexing') as event:
+            n_scanned = self._index.update()
+            self._index.save()
+            event['args']['rescanned'] = n_scanned
 
-        print('    Indexing complete')
+        print('    Indexing complete ({} directories rescanned)'.format(n_scanned))
         print('')
 
-        # Get complete subject list from BIDS layout
+        # Get complete subject list from session index
         if self._subject:
             subject_list = [self._subject]
         else:
-            subject_list = self._layout.get_subjects()
+            subject_list = self._index.get_subjects()
 
-        # Loop over all QC subjects
-        for self._this_subject in subject_list:
+        # Build (subject, session) job list for all QC subjects
+        sessions = dict()
 
-            print('  Subject {}'.format(self._this_subject))
+        for subject in subject_list:
 
-            # Get the session list either from class data or BIDS layout (fallback)
+            # Get the session list either from class data or session index (fallback)
             if self._session:
-                session_list = [self._session]
+                sessions[subject] = [self._session]
             else:
-                session_list = self._layout.get_sessions(subject=self._this_subject)
+                sessions[subject] = self._index.get_sessions(subject)
+
+        # Analyze all sessions, summarizing each subject once its sessions are complete
+        self._process(sessions)
+
+        self._prune_cache()
+
+        self._run_tracer.save(self._run_trace_json)
+
+        # Cleanup temporary QC directory
+        self.cleanup()
+
+    def watch(self, poll_interval=30.0, settle_time=120.0):
+        """
+        Long-running mode that analyzes new sessions as soon as they land in the BIDS tree
+        The session index and work directory stay warm between polls and all sessions
+        that settle within one poll interval are analyzed as a single batch
+
+        :param poll_interval: float, seconds between scans of the BIDS tree
+        :param settle_time: float, seconds a session's files must be unchanged before analysis
+        """
+
+        print('')
+        print('Watching {} for new QC sessions (Ctrl-C to stop)'.format(self._bids_dir))
+        print('  Poll interval : {} s'.format(poll_interval))
+        print('  Settle time   : {} s'.format(settle_time))
+
+        # File signatures from the previous poll and for sessions that failed analysis
+        signatures = dict()
+        failed = dict()
+
+        try:
+
+            while True:
+
+                # Fresh run trace each poll so a long watch does not accumulate events
+                self._run_tracer = StageTracer(self._trace_memory)
+
+                with self._run_tracer.stage('indexing'):
+                    self._index.update()
+                    self._index.save()
+
+                subject_list = [self._subject] if self._subject else self._index.get_subjects()
+
+                # Newly completed sessions for each subject
+                batch = dict()
 
-            # Init list of session metrics for this subject
-            metric_list = []
+                for subject in subject_list:
 
-            for self._this_session in session_list:
+                    session_list = [self._session] if self._session else self._index.get_sessions(subject)
 
-                print('')
-                print('    Session {}'.format(self._this_session))
+                    for session in session_list:
 
-                # Report PDF and JSON filenames - used in both report and summarize modes
-                self._report_pdf = os.path.join(self._report_dir,
-                                                '{}_{}_qc.pdf'.format(self._this_subject, self._this_session))
-                self._report_json = self._report_pdf.replace('.pdf', '.json')
+                        report_pdf, report_json = self._report_fnames(subject, session)
+                        if os.path.isfile(report_pdf) and os.path.isfile(report_json):
+                            continue
 
-                if os.path.isfile(self._report_pdf) and os.path.isfile(self._report_json):
+                        sig, newest = self._session_signature(subject, session)
+
+                        prev_sig = signatures.get((subject, session), None)
+                        signatures[(subject, session)] = sig
+
+                        # Require a QC image, no change since the last poll and no recent writes
+                        # Sessions that failed are retried only once their files change
+                        if sig is None or sig != prev_sig or failed.get((subject, session), None) == sig:
+                            continue
+
+                        if time.time() - newest < settle_time:
+                            continue
+
+                        batch.setdefault(subject, []).append(session)
+
+                if batch:
+
+                    # Summaries need all previously reported sessions for each subject
+                    sessions = dict()
+                    for subject, new_sessions in batch.items():
+                        sessions[subject] = [ses for ses in self._index.get_sessions(subject)
+                                             if all(os.path.isfile(f) for f in self._report_fnames(subject, ses))
+                                             or ses in new_sessions]
+
+                    print('')
+                    print('  {} new session(s) detected'.format(sum(len(v) for v in batch.values())))
+
+                    # Failed sessions are retried only once their files change
+                    failures = dict()
+
+                    try:
+                        self._process(sessions, failed=failures)
+                    except Exception as err:
+                        print('  * Summary failed ({})'.format(err))
+
+                    for subject, session in failures:
+                        failed[(subject, session)] = signatures[(subject, session)]
+
+                    self._prune_cache()
+
+                    self._run_tracer.save(self._run_trace_json)
+
+                time.sleep(poll_interval)
+
+        except KeyboardInterrupt:
+
+            print('')
+            print('Stopping watch')
+
+        self.cleanup()
+
+    def _prune_cache(self):
+        """
+        Limit the stage cache to the configured size and entry age
+        """
+
+        with self._run_tracer.stage('prune_cache') as event:
+            n_removed, size_gb = self._cache.prune(max_gb=self._cache_gb, max_age_days=self._cache_days)
+            event['args']['removed'] = n_removed
+
+        if n_removed > 0:
+            print('  Pruned {} stage cache entries ({:.2f} GB remaining)'.format(n_removed, size_gb))
+
+    def _session_signature(self, subject, session):
+        """
+        Signature of all files in a session directory for change detection
+
+        :return sig: tuple, (relative path, size, mtime) for each file or None if no QC image is present
+        :return newest: float, most recent file modification time (seconds since epoch)
+        """
+
+        if not self._index.get(subject, session, suffix=self._suffix):
+            return None, 0.0
+
+        ses_dir = os.path.join(self._bids_dir, 'sub-' + subject, 'ses-' + session)
+
+        sig = []
+        for root, _, files in os.walk(ses_dir):
+            for fname in files:
+                st = os.stat(os.path.join(root, fname))
+                sig.append((os.path.relpath(os.path.join(root, fname), ses_dir), st.st_size, st.st_mtime_ns))
+
+        newest = max(m for _, _, m in sig) * 1e-9 if sig else 0.0
+
+        return tuple(sorted(sig)), newest
+
+    def _process(self, sessions, failed=None):
+        """
+        Analyze and report all sessions then summarize each subject
+        Sessions are farmed out to a process pool if more than one job is requested
+
+        :param sessions: dict, session ID lists keyed by subject ID
+        :param failed: dict, if provided, sessions whose analysis fails are recorded here
+            as {(subject, session): error} and the remaining sessions continue
+        """
+
+        # Sessions still requiring analysis, keyed by (subject, session)
+        todo = dict()
+
+        for subject, session_list in sessions.items():
+
+            for session in session_list:
+
+                report_pdf, report_json = self._report_fnames(subject, session)
+
+                if os.path.isfile(report_pdf) and os.path.isfile(report_json):
 
                     # QC analysis and reporting already run
-                    print('      Report and metadata detected for this session')
+                    print('    {} {} : report and metadata detected for this session'.format(subject, session))
 
                 else:
 
-                    # QC analysis and report generation
-                    self._analyze_and_report()
+                    try:
+                        todo[(subject, session)] = self._find_qc_image(subject, session)
+                    except Exception as err:
+                        self._session_failed(subject, session, err, failed)
+
+        # Subjects waiting on analyses before summarizing
+        pending = {subject: sum(1 for (sub, _) in todo if sub == subject) for subject in sessions}
+
+        for subject in sessions:
+            if pending[subject] == 0:
+                self._summarize_reported(subject, sessions[subject], failed)
+
+        if self._n_jobs > 1 and len(todo) > 1:
+
+            n_threads = max(1, multiprocessing.cpu_count() // self._n_jobs)
+
+            print('')
+            print('  Analyzing {} sessions with {} jobs ({} threads per job)'.format(
+                len(todo), self._n_jobs, n_threads))
+
+            # Spawn (rather than fork) workers so BLAS/OpenMP thread limits take effect at import
+            with _thread_limits(n_threads), \
+                    ProcessPoolExecutor(max_workers=self._n_jobs,
+                                        mp_context=multiprocessing.get_context('spawn')) as pool:
+
+                futures = {pool.submit(_analyze_session_worker, self._worker_args(), subject, session, img_fname):
+                           (subject, session) for (subject, session), img_fname in todo.items()}
+
+                for future in as_completed(futures):
+
+                    subject, session = futures[future]
+
+                    try:
+                        future.result()
+                        print('    Completed session {} {}'.format(subject, session))
+                    except Exception as err:
+                        self._session_failed(subject, session, err, failed)
+
+                    pending[subject] -= 1
+                    if pending[subject] == 0:
+                        self._summarize_reported(subject, sessions[subject], failed)
+
+        else:
+
+            for (subject, session), img_fname in todo.items():
+
+                try:
+                    self._analyze_session(subject, session, img_fname)
+                except Exception as err:
+                    self._session_failed(subject, session, err, failed)
+
+                pending[subject] -= 1
+                if pending[subject] == 0:
+                    self._summarize_reported(subject, sessions[subject], failed)
+
+    @staticmethod
+    def _session_failed(subject, session, err, failed):
+        """
+        Record a failed session analysis, or re-raise if failures are not being collected
+
+        :param err: Exception, analysis error
+        :param failed: dict, failed sessions keyed by (subject, session), or None to re-raise
+        """
+
+        if failed is None:
+            raise err
+
+        print('    * Analysis of {} {} failed ({}) - waiting for session files to change'.format(
+            subject, session, err))
+
+        failed[(subject, session)] = err
+
+    def _summarize_reported(self, subject, session_list, failed):
+        """
+        Summarize a subject over its sessions that were reported successfully
+        """
+
+        session_list = [ses for ses in session_list if not failed or (subject, ses) not in failed]
+
+        if session_list:
+            self._summarize(subject, session_list)
+
+    def _analyze_session(self, subject, session, img_fname):
+        """
+        QC analysis and report generation for a single subject/session
+
+        :param subject: str, subject ID
+        :param session: str, session ID
+        :param img_fname: str, QC image filename
+        """
+
+        self._this_subject = subject
+        self._this_session = session
+
+        print('')
+        print('    Subject {} Session {}'.format(subject, session))
+
+        # Report PDF and JSON filenames - used in both report and summarize modes
+        self._report_pdf, self._report_json = self._report_fnames(subject, session)
 
-                # Add metrics for this subject/session to cumulative list
-                metric_list.append(self._get_metrics())
+        # Per-stage timing trace saved alongside the report JSON
+        self._tracer = StageTracer(self._trace_memory)
 
-            # Convert metric list to dataframe and save to file
-            self._metrics_df = pd.DataFrame(metric_list)
+        with self._tracer.stage('session', subject=subject, session=session):
+            self._analyze_and_report(img_fname)
 
-            # Generate summary report for this subject
-            Summarize(self._report_dir, self._metrics_df, self._past_months)
+        self._tracer.save(self._report_json.replace('.json', '_trace.json'))
 
-            # Cleanup temporary QC directory
-            self.cleanup()
+    def _summarize(self, subject, session_list):
+        """
+        Generate summary report for all sessions of a subject
 
-    def _analyze_and_report(self):
+        :param subject: str, subject ID
+        :param session_list: list, session IDs
+        """
+
+        print('')
+        print('  Summarizing subject {}'.format(subject))
+
+        # Convert metric list to dataframe and save to file
+        metric_list = [self._get_metrics(subject, session) for session in session_list]
+        self._metrics_df = pd.DataFrame(metric_list)
+
+        # Generate summary report for this subject
+        with self._run_tracer.stage('summarize', subject=subject):
+            Summarize(self._report_dir, self._metrics_df, self._past_months,
+                      fig_format=self._fig_format, fig_dpi=self._fig_dpi)
+
+    def _worker_args(self):
+        """
+        Constructor arguments for per-session worker instances
+        Each worker creates its own CBICQC object and work directory
+        """
+
+        return dict(bids_dir=self._bids_dir,
+                    mode=self._mode,
+                    past_months=self._past_months,
+                    use_cache=self._use_cache,
+                    dtype=self._dtype,
+                    chunk_mb=self._chunk_mb,
+                    moco=self._do_moco,
+                    resample=self._resample,
+                    moco_engine=self._moco_engine,
+                    localizer=self._localizer,
+                    plot_jobs=max(1, self._plot_jobs // self._n_jobs),
+                    fig_format=self._fig_format,
+                    fig_dpi=self._fig_dpi,
+                    carpet_rows=self._carpet_rows,
+                    carpet_method=self._carpet_method,
+                    spectrum=self._spectrum,
+                    spec_bands=self._spec_bands,
+                    trace_memory=self._trace_memory)
+
+    def _report_fnames(self, subject, session):
+
+        report_pdf = os.path.join(self._report_dir, '{}_{}_qc.pdf'.format(subject, session))
+        report_json = report_pdf.replace('.pdf', '.json')
+
+        return report_pdf, report_json
+
+    def _find_qc_image(self, subject, session):
 
         # Get first QC image for this subject/session
-        img_list = self._layout.get(return_type='file',
-                                    extension=['nii', 'nii.gz'],
-                                    subject=self._this_subject,
-                                    session=self._this_session,
-                                    suffix=self._suffix)
+        img_list = self._index.get(subject, session, suffix=self._suffix)
         if not img_list:
-            print('    * No QC images found for subject {} session {} - exiting'.
-                  format(self._this_subject, self._this_session))
-            sys.exit(1)
+            raise FileNotFoundError('No QC images found for subject {} session {}'.format(subject, session))
+
+        return img_list[0]
+
+    def _analyze_and_report(self, qc_img_fname):
 
-        qc_img_fname = img_list[0]
         qc_meta_fname = qc_img_fname.replace('.nii.gz', '.json')
 
-        # Load 4D QC phantom image
-        print('      Loading QC timeseries image')
-        qc_nii = nb.load(qc_img_fname)
+        with self._tracer.stage('load'):
 
-        # Load metadata if available
-        print('      Loading QC metadata')
-        try:
-            with open(qc_meta_fname, 'r') as fd:
-                meta = json.load(fd)
-        except IOError:
-            print('      * Could not open image metadata {}'.format(qc_meta_fname))
-            print('      * Using default imaging parameters')
-            meta = self.default_metadata()
+            # Load 4D QC phantom image
+            print('      Loading QC timeseries image')
+            qc_nii = nb.load(qc_img_fname)
+
+            # Load metadata if available
+            print('      Loading QC metadata')
+            try:
+                with open(qc_meta_fname, 'r') as fd:
+                    meta = json.load(fd)
+            except IOError:
+                print('      * Could not open image metadata {}'.format(qc_meta_fname))
+                print('      * Using default imaging parameters')
+                meta = self.default_metadata()
 
         # Check for missing fields (typically non-Siemens scanners)
         if 'SequenceName' not in meta:
@@ -221,37 +561,91 @@ class CBICQC:
         meta['VoxelSize'] = ' x '.join(str(x) for x in qc_nii.header.get('pixdim')[1:4])
         meta['MatrixSize'] = ' x '.join(str(x) for x in qc_nii.shape)
 
-        # Perform rigid body motion correction on QC series
-        print('      Starting {} motion correction'.format(self._mode))
-        t0 = dt.datetime.now()
+        # Stage cache keys derive from the content of the QC image
+        with self._tracer.stage('hash_image'):
+            img_key = self._cache.file_key(qc_img_fname)
+
+        # Decode the 4D series once - all stages share views of this single array
+        # In streaming mode (chunk_mb > 0) the series stays on disk for chunked stages
+        series = QCSeries(qc_nii, dtype=self._dtype)
+
+        if not self._chunk_mb:
+            with self._tracer.stage('decode'):
+                series.data
 
-        qc_moco_nii, qc_moco_pars = self._moco(qc_nii, skip=True)
+        # Optional motion correction of the QC series - the corrected series replaces the decoded series
+        if self._do_moco:
+            print('      Starting {} motion correction'.format(self._mode))
 
-        t1 = dt.datetime.now()
-        print('      Completed motion correction in {} seconds'.format((t1 - t0).seconds))
+        with self._tracer.stage('moco') as event:
+            qc_moco_pars, moco_key = self._moco(series, img_key, skip=not self._do_moco)
+
+        if self._do_moco:
+            print('      Completed motion correction in {:.1f} seconds'.format(event['dur'] * 1e-6))
 
         # Temporal mean and sd images
         print('      Calculating temporal mean image')
-        tmean_nii, tsd_nii, tsfnr_nii = temporal_mean_sd(qc_moco_nii)
+        if self._chunk_mb:
+            (tmean_nii, tsd_nii, tsfnr_nii), tstats_key = self._run_stage(
+                'temporal_stats', temporal_mean_sd_streaming, (series.lazy_nii,), deps=[moco_key],
+                params=dict(chunk_mb=self._chunk_mb))
+        else:
+            (tmean_nii, tsd_nii, tsfnr_nii), tstats_key = self._run_stage(
+                'temporal_stats', temporal_mean_sd, (series.nii,), deps=[moco_key])
 
         # Register labels to temporal mean via template image
-        print('      Register labels to temporal mean image')
-        labels_nii = register_template(tmean_nii, self._work_dir, mode=self._mode)
+        # Template transforms are cached per scanner, protocol, QC mode and template
+        xfm_dir = os.path.join(self._report_dir, 'xfm_cache',
+                               xfm_cache_key(meta.get('DeviceSerialNumber', 'Unknown'), tmean_nii, mode=self._mode))
+        print('      Localizing phantom or registering template labels to temporal mean image')
+        labels_nii, labels_key = self._run_stage(
+            'registration', register_template, (tmean_nii, self._work_dir),
+            deps=[tstats_key], params=dict(mode=self._mode, localizer=self._localizer, xfm_dir=xfm_dir))
 
         # Generate ROIs from labels
         # Construct Nyquist Ghost and airspace ROIs from labels
-        rois_nii = make_rois(labels_nii)
+        # roi_set holds the sorted voxel indices of each label for all downstream gathers
+        (rois_nii, roi_set), rois_key = self._run_stage('rois', make_rois, (labels_nii,), deps=[labels_key])
 
-        # Extract ROI time series
+        # Extract ROI time series with air space slice and line profiles from the same pass
         print('      Extracting ROI time series')
-        s_mean_t = extract_timeseries(qc_moco_nii, rois_nii)
+        (s_mean_t, air_profiles), ts_key = self._run_stage(
+            'extraction', extract_timeseries, (series.lazy_nii if self._chunk_mb else series.nii, roi_set),
+            deps=[moco_key, rois_key], params=dict(chunk_mb=self._chunk_mb or 256, air_profiles=True))
 
         # Detrend time series
         print('      Detrending time series')
-        fit_results, s_detrend_t = detrend_timeseries(s_mean_t)
+        (fit_results, s_detrend_t), detrend_key = self._run_stage(
+            'detrending', detrend_timeseries, (s_mean_t,), deps=[ts_key])
+
+        # Voxelwise detrended SFNR, drift and warm-up maps over the phantom
+        print('      Calculating voxelwise detrended maps')
+        (sfnr_nii, drift_nii, warmup_nii), maps_key = self._run_stage(
+            'detrended_maps', detrended_maps, (series.lazy_nii if self._chunk_mb else series.nii, rois_nii, roi_set),
+            deps=[moco_key, rois_key], params=dict(chunk_mb=self._chunk_mb or 256))
+
+        # Map derivatives saved alongside the report
+        report_stub = self._report_json.replace('.json', '')
+        nb.save(sfnr_nii, report_stub + '_sfnr.nii.gz')
+        nb.save(drift_nii, report_stub + '_drift.nii.gz')
+        nb.save(warmup_nii, report_stub + '_warmup.nii.gz')
+
+        # Slice spikes and zipper lines from the air space profiles
+        print('      Detecting slice spikes and zipper artifacts')
+        spikes, spikes_key = self._run_stage(
+            'slice_spikes', slice_spikes, (air_profiles, roi_set.shape), deps=[ts_key])
+        save_slice_spikes(spikes, report_stub + '_slicespikes.json')
+
+        # Weisskoff fluctuation analysis and radius of decorrelation
+        print('      Calculating Weisskoff fluctuations')
+        wk, wk_key = self._run_stage(
+            'weisskoff', weisskoff, (series.lazy_nii if self._chunk_mb else series.nii, roi_set),
+            deps=[moco_key, rois_key])
 
         # Calculate QC metrics
-        metrics = qc_metrics(fit_results, tsfnr_nii, rois_nii)
+        metrics, _ = self._run_stage(
+            'metrics', qc_metrics, (fit_results, tsfnr_nii, roi_set, spikes, wk),
+            deps=[detrend_key, tstats_key, rois_key, spikes_key, wk_key])
 
         # Merge meta data into metrics dictionary for report JSON sidecar
         metrics.update(meta)
@@ -259,17 +653,71 @@ class CBICQC:
         # Time vector (seconds)
         t = np.arange(0, s_mean_t.shape[1]) * meta['RepetitionTime']
 
+        # ROI and motion spectra with dominant peaks, saved alongside the report
+        print('      Calculating power spectra')
+        t_key = self._cache.array_key(t)
+        spectra, _ = self._run_stage(
+            'spectra', session_spectra, (t, s_detrend_t, qc_moco_pars),
+            deps=[t_key, detrend_key, moco_key], params=dict(method=self._spectrum))
+        save_spectra(spectra, report_stub + '_spectra.npz')
+
+        # Voxelwise spectral peak maps localize periodic instabilities averaged out of the ROI spectra
+        print('      Calculating voxelwise spectral peak maps')
+        bands = self._spec_bands or self._default_bands(spectra)
+        (peak_hz_nii, peak_frac_nii, band_frac_nii), spec_maps_key = self._run_stage(
+            'spectral_maps', spectral_peak_maps,
+            (series.lazy_nii if self._chunk_mb else series.nii, meta['RepetitionTime']),
+            deps=[moco_key], params=dict(bands=bands, chunk_mb=self._chunk_mb or 256))
+        nb.save(peak_hz_nii, report_stub + '_peakfreq.nii.gz')
+        nb.save(peak_frac_nii, report_stub + '_peakpower.nii.gz')
+        if band_frac_nii is not None:
+            nb.save(band_frac_nii, report_stub + '_bandpower.nii.gz')
+
         print('      Generating Report')
 
-        # Create report images
-        plot_roi_timeseries(t, s_mean_t, s_detrend_t, self._roi_ts_png)
-        plot_roi_powerspec(t, s_detrend_t, self._roi_ps_png)
-        plot_mopar_timeseries(t, qc_moco_pars, self._mopar_ts_png)
-        plot_mopar_powerspec(t, qc_moco_pars, self._mopar_pspec_png)
-        roi_demeaned_ts(qc_moco_nii, rois_nii, self._rois_demeaned_png)
-        orthoslices(tmean_nii, self._tmean_montage_png, cmap='gray', irng='robust')
-        orthoslices(tsd_nii, self._tsd_montage_png, cmap='viridis', irng='robust')
-        orthoslices(rois_nii, self._rois_montage_png, cmap='tab20', irng='noscale')
+        # Report figures - each worker receives only the small arrays its figure needs
+        # Arguments that need a pass over the series are given as callables, evaluated only on a cache miss
+        figures = [
+            ('ROITimeseries', plot_roi_timeseries, (t, s_mean_t, s_detrend_t), [t_key, ts_key, detrend_key], None),
+            ('ROIPowerspec', plot_roi_powerspec, (spectra['f'], spectra['roi_pspec'], spectra['roi_peak_hz']),
+             [t_key, detrend_key, self._spectrum], None),
+            ('MoparTimeseries', plot_mopar_timeseries, (t, qc_moco_pars), [t_key, moco_key], None),
+            ('MoparPowerspec', plot_mopar_powerspec,
+             (spectra['f'], spectra['motion_pspec'], spectra['motion_peak_hz']),
+             [t_key, moco_key, self._spectrum], None),
+            ('ROIDemeanedTS', plot_roi_carpets,
+             lambda: (roi_carpets(series.lazy_nii if self._chunk_mb else series.nii, roi_set,
+                                  n_samp=self._carpet_rows, method=self._carpet_method,
+                                  chunk_mb=self._chunk_mb or 256, tmean_nii=tmean_nii),),
+             [moco_key, rois_key, self._carpet_rows, self._carpet_method], None),
+            ('SliceSpikes', plot_slice_spikes, (spikes['slice_z'], spikes['row_score'], spikes['col_score'],
+                                            spikes['spike_thresh']), [spikes_key], None),
+            ('Weisskoff', plot_weisskoff, (wk['widths'], wk['cv'], wk['cv_theory'], wk['rdc']), [wk_key], None),
+        ]
+
+        # Central sections of each 3D image (figure name, image, upstream key, colormap, intensity range)
+        section_images = [
+            ('TMeanMontage', tmean_nii, tstats_key, 'gray', 'robust'),
+            ('TSDMontage', tsd_nii, tstats_key, 'viridis', 'robust'),
+            ('ROIsMontage', rois_nii, rois_key, 'tab20', 'noscale'),
+            ('SFNRMontage', sfnr_nii, maps_key, 'viridis', 'robust'),
+            ('DriftMontage', drift_nii, maps_key, 'coolwarm', 'robust'),
+            ('WarmupMontage', warmup_nii, maps_key, 'magma', 'robust'),
+            ('PeakFreqMontage', peak_hz_nii, spec_maps_key, 'viridis', 'default'),
+            ('PeakPowerMontage', peak_frac_nii, spec_maps_key, 'magma', 'robust'),
+        ]
+
+        # First band power map
+        if band_frac_nii is not None:
+            band_nii = nb.Nifti1Image(np.asanyarray(band_frac_nii.dataobj)[..., 0], band_frac_nii.affine)
+            section_images.append(('BandPowerMontage', band_nii, spec_maps_key, 'magma', 'robust'))
+
+        for name, img_nii, img_key, cmap, irng in section_images:
+
+            sections, vmin, vmax = orthoslice_sections(img_nii, cmap=cmap, irng=irng)
+            figures.append((name, plot_orthoslices, (sections, vmin, vmax), [img_key, name, irng], dict(cmap=cmap)))
+
+        figures = self._render_figures(figures)
 
         # OPTIONAL: Save intermediate images
         if self._save_intermediates:
@@ -281,23 +729,110 @@ class CBICQC:
         fnames = dict(WorkDir=self._work_dir,
                       ReportPDF=self._report_pdf,
                       ReportJSON=self._report_json,
-                      ROITimeseries=self._roi_ts_png,
-                      ROIPowerspec=self._roi_ps_png,
-                      MoparTimeseries=self._mopar_ts_png,
-                      MoparPowerspec=self._mopar_pspec_png,
-                      TMeanMontage=self._tmean_montage_png,
-                      TSDMontage=self._tsd_montage_png,
-                      ROIsMontage=self._rois_montage_png,
-                      ROIDemeanedTS=self._rois_demeaned_png,
                       TMean=self._tmean_fname,
                       TSD=self._tsd_fname,
                       ROILabels=self._roi_labels_fname)
 
         # Build PDF report
-        ReportPDF(fnames, meta, metrics)
+        with self._tracer.stage('report_pdf'):
+            ReportPDF(fnames, meta, metrics, figures, bands=bands)
+
+    def _run_stage(self, name, func, args=(), deps=(), params=None, files=()):
+        """
+        Run a cached analysis stage under the session tracer
+
+        :param name: str, stage name for trace
+        :return result: stage function return value
+        :return key: str, stage cache key
+        """
+
+        with self._tracer.stage(name) as event:
+            result, key = self._cache.run(func, args, deps=deps, params=params, files=files)
+            event['args']['cached'] = self._cache.hit
+
+        return result, key
+
+    @staticmethod
+    def _default_bands(spectra, half_width_bins=2):
+        """
+        Band around the dominant peak of the signal ROI spectrum, if any
+
+        :param spectra: dict, from session_spectra
+        :param half_width_bins: int, band half width in frequency bins
+        :return bands: list, [[f_lo, f_hi]] in Hz, or [] if the signal ROI spectrum has no peaks
+        """
+
+        f_peak = spectra['roi_peak_hz'][2, 0]
+
+        if not np.isfinite(f_peak):
+            return []
+
+        df = spectra['f'][1] - spectra['f'][0]
+
+        return [[float(f_peak - half_width_bins * df), float(f_peak + half_width_bins * df)]]
+
+    def _render_figures(self, figures):
+        """
+        Render cached report figures to memory, in parallel when more than one needs drawing
+        Figures are independent, so report time is set by the slowest figure rather than their sum
+
+        :param figures: list, (name, func, args, deps, params) for each figure stage
+            args may be a callable returning the argument tuple, called only if the figure is not cached
+        :return rendered: dict, rendered figure bytes (PNG or SVG) keyed by figure name
+        """
+
+        rendered = dict()
+
+        with self._tracer.stage('figures', fmt=self._fig_format, dpi=self._fig_dpi) as event:
+
+            todo = []
+
+            for name, func, args, deps, params in figures:
+
+                params = dict(params or dict(), dpi=self._fig_dpi, fmt=self._fig_format)
+
+                found, result, key = self._cache.lookup(func, deps=deps, params=params)
+
+                if found:
+                    rendered[name] = result
+                else:
+                    todo.append((name, func, args() if callable(args) else args, params, key))
+
+            event['args']['rendered'] = len(todo)
+
+            if self._plot_jobs > 1 and len(todo) > 1:
+
+                # Figures are single-threaded - cap BLAS/OpenMP threads in workers spawned on submit
+                with _thread_limits(1):
+
+                    # No more workers than report figures
+                    if self._plot_pool is None:
+                        self._plot_pool = ProcessPoolExecutor(max_workers=min(self._plot_jobs, len(figures)),
+                                                              mp_context=multiprocessing.get_context('spawn'))
+
+                    futures = {self._plot_pool.submit(_render_figure, func, args, params): (name, key)
+                               for name, func, args, params, key in todo}
+
+                done = ((futures[future], future.result()) for future in as_completed(futures))
+
+            else:
+
+                done = (((name, key), _render_figure(func, args, params))
+                        for name, func, args, params, key in todo)
+
+            for (name, key), (result, dur) in done:
+                self._cache.store(key, result)
+                rendered[name] = result
+                event['args'][name + '_s'] = round(dur, 3)
+
+        return rendered
 
     def cleanup(self, skip=False):
 
+        if self._plot_pool is not None:
+            self._plot_pool.shutdown()
+            self._plot_pool = None
+
         if skip:
             print('')
             print('Retaining {}'.format(self._work_dir))
@@ -306,41 +841,54 @@ class CBICQC:
             print('Deleting work directory')
             shutil.rmtree(self._work_dir)
 
-    def _moco(self, img_nii, skip=False):
+    def _moco(self, series, img_key, skip=False):
         """
         Motion correction wrapper
+        The motion corrected series replaces the raw series in place
 
-        :param img_nii: Nifti, image object
+        :param series: QCSeries, session 4D series
+        :param img_key: str, content hash of image
         :param skip: bool, skip motion correction
-        :return moco_nii: Nifti, motion corrected image object
         :return moco_pars: array, motion parameter timeseries
+        :return moco_key: str, stage cache key of motion corrected image
         """
 
         if skip:
 
-            moco_nii = img_nii
-            moco_pars = np.zeros([img_nii.shape[3], 6])
+            moco_pars = np.zeros([series.shape[3], 6])
+            moco_key = img_key
 
         else:
 
             if 'phantom' in self._mode:
 
-                moco_nii, moco_pars = moco_phantom(img_nii)
+                (moco_nii, moco_pars), moco_key = self._cache.run(moco_phantom, (series.nii,), deps=[img_key],
+                                                                  params=dict(inplace=True, method=self._resample),
+                                                                  keep=False)
+
+            elif 'live' in self._mode and 'native' in self._moco_engine:
+
+                (moco_nii, moco_pars), moco_key = self._cache.run(moco_rigid, (series.nii,), deps=[img_key],
+                                                                  params=dict(inplace=True), keep=False)
 
             elif 'live' in self._mode:
 
-                moco_nii, moco_pars = moco_live(img_nii, self._work_dir)
+                (moco_nii, moco_pars), moco_key = self._cache.run(moco_live, (series.nii, self._work_dir),
+                                                                  deps=[img_key], keep=False)
 
             else:
 
-                print('      * Unknown QC mode ({})'.format(self._mode))
-                sys.exit(1)
+                raise ValueError('Unknown QC mode ({})'.format(self._mode))
+
+            series.set_nii(moco_nii)
+
+        return moco_pars, moco_key
 
-        return moco_nii, moco_pars
+    def _get_metrics(self, subject, session):
 
-    def _get_metrics(self):
+        _, report_json = self._report_fnames(subject, session)
 
-        with open(self._report_json, 'r') as fd:
+        with open(report_json, 'r') as fd:
             metrics = json.load(fd)
 
         return metrics
@@ -388,3 +936,71 @@ class CBICQC:
 
         print('Saving QC report to {}'.format(dest_pdf))
         shutil.copyfile(src_pdf, dest_pdf)
+
+
+def _analyze_session_worker(qc_args, subject, session, img_fname):
+    """
+    Process pool entry point for a single session analysis
+    Each worker gets its own CBICQC object and work directory
+
+    :param qc_args: dict, CBICQC constructor arguments
+    :param subject: str, subject ID
+    :param session: str, session ID
+    :param img_fname: str, QC image filename
+    """
+
+    qc = CBICQC(**qc_args)
+
+    try:
+        qc._analyze_session(subject, session, img_fname)
+    finally:
+        qc.cleanup()
+
+
+def _render_figure(func, args, params):
+    """
+    Figure pool entry point - renders to memory so nothing is written to the work directory
+
+    :param func: callable, figure function taking an output filename or buffer after args
+    :param args: tuple, figure data arrays
+    :param params: dict, figure keyword arguments (including dpi and fmt)
+    :return data: bytes, rendered figure
+    :return dur: float, render time (s)
+    """
+
+    t0 = time.perf_counter()
+
+    buf = io.BytesIO()
+    func(*args, buf, **params)
+
+    return buf.getvalue(), time.perf_counter() - t0
+
+
+@contextlib.contextmanager
+def _thread_limits(n_threads):
+    """
+    Temporarily cap BLAS/OpenMP thread pools for spawned worker processes
+    Workers inherit the environment when they start, so the parent is unaffected
+
+    :param n_threads: int, maximum threads per worker
+    """
+
+    env_vars = ['OMP_NUM_THREADS',
+                'OPENBLAS_NUM_THREADS',
+                'MKL_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS',
+                'NUMEXPR_NUM_THREADS']
+
+    saved = {var: os.environ.get(var) for var in env_vars}
+
+    for var in env_vars:
+        os.environ[var] = str(n_threads)
+
+    try:
+        yield
+    finally:
+        for var, val in saved.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
@@ -25,105 +25,101 @@ Copyright 2019 California Institute of Technology.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.dates as mdates
-import matplotlib.gridspec as gridspec
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-from scipy.signal import periodogram
 from skimage.util import montage
 from skimage.exposure import rescale_intensity
 import pandas as pd
 from datetime import date
 
-from .moco import total_rotation
+from .spectra import relative_db
+from .rois import as_roiset
+from .series import iter_volume_chunks
 
 
-def plot_roi_timeseries(t, s_mean_t, s_detrend_t, plot_fname):
+def new_figure(figsize):
     """
-    Plot spatial mean ROI signal vs time
+    Standalone Agg figure - no pyplot global state, so figures can be rendered
+    concurrently and are released as soon as they go out of scope
 
-    :param t: float array, time vector (s)
-    :param s_mean_t:
-    :param s_detrend_t:
-    :param plot_fname:
-    :return:
+    :param figsize: tuple, figure size (inches)
+    :return fig: Figure
     """
 
-    roi_names = ['Air', 'Nyquist Ghost', 'Signal']
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
 
-    plt.subplots(3, 1, figsize=(10, 5))
+    return fig
 
-    for lc in range(0, 3):
 
-        plt.subplot(3, 1, lc+1)
-        plt.plot(t, s_mean_t[lc, :], t, s_detrend_t[lc, :])
-        plt.title(roi_names[lc], loc='left')
-
-    # Add x label to final subplot
-    plt.xlabel('Time (s)')
-
-    # Space subplots without title overlap
-    plt.tight_layout()
+def save_figure(fig, fname, dpi=300, fmt=None):
+    """
+    Render figure to a file or an in-memory buffer
 
-    # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    :param fig: Figure
+    :param fname: str or file-like, output image filename or buffer (eg BytesIO)
+    :param dpi: int, raster resolution (also used for images embedded in vector output)
+    :param fmt: str, image format ('png', 'svg', ...), None to infer from the filename
+    """
 
-    # Close plot
-    plt.close()
+    fig.savefig(fname, dpi=dpi, format=fmt)
 
 
-def plot_roi_powerspec(t, s_detrend_t, plot_fname):
+def plot_roi_timeseries(t, s_mean_t, s_detrend_t, plot_fname, dpi=300, fmt=None):
     """
-    Plot ROI timeseries power spectra
+    Plot spatial mean ROI signal vs time
 
     :param t: float array, time vector (s)
+    :param s_mean_t:
     :param s_detrend_t:
     :param plot_fname:
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
     :return:
     """
 
-    titles = ['Air (dB)', 'Nyquist Ghost (dB)', 'Signal (dB)']
-
-    # Sampling frequency (Hz)
-    fs = 1.0 / (t[1] - t[0])
-
-    # Power spectra of detrending residual for each ROI
-    f, pspec = periodogram(s_detrend_t, fs, scaling='spectrum')
-
-    # Drop first time point (zeros)
-    pspec = pspec[:, 1:]
-    f = f[1:]
+    roi_names = ['Air', 'Nyquist Ghost', 'Signal']
 
-    plt.subplots(3, 1, figsize=(10, 5))
+    fig = new_figure((10, 5))
+    axs = fig.subplots(3, 1)
 
     for lc in range(0, 3):
 
-        # Power dB relative to row max
-        p = pspec[lc, :]
-        p_max = np.max(p)
-        if p_max < 1e-10:
-            p_db = np.zeros_like(p)
-        else:
-            p_db = 10.0 * np.log10(p / np.max(p))
-
-        plt.subplot(3, 1, lc + 1)
-        plt.plot(f, p_db)
-        plt.title(titles[lc], loc='left')
+        axs[lc].plot(t, s_mean_t[lc, :], t, s_detrend_t[lc, :])
+        axs[lc].set_title(roi_names[lc], loc='left')
 
     # Add x label to final subplot
-    plt.xlabel('Frequency (Hz)')
+    axs[-1].set_xlabel('Time (s)')
 
     # Space subplots without title overlap
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    save_figure(fig, plot_fname, dpi=dpi, fmt=fmt)
 
-    # Close plot
-    plt.close()
 
+def plot_roi_powerspec(f, pspec, peak_hz, plot_fname, dpi=300, fmt=None):
+    """
+    Plot ROI timeseries power spectra from session_spectra
+
+    :param f: float array, frequencies (Hz)
+    :param pspec: array, ROI power spectra (n_rois x nf)
+    :param peak_hz: array, dominant peak frequencies (n_rois x n_peaks), NaN padded
+    :param plot_fname: str or file-like, output plot filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
+    :return:
+    """
 
-def plot_mopar_timeseries(t, mopars, plot_fname):
+    titles = ['Air (dB)', 'Nyquist Ghost (dB)', 'Signal (dB)']
+
+    _plot_spectra(f, pspec[:3], peak_hz[:3], titles, plot_fname, dpi=dpi, fmt=fmt)
+
+
+def plot_mopar_timeseries(t, mopars, plot_fname, dpi=300, fmt=None):
     """
     Plots x, y, z displacement and rotation timeseries from MCFLIRT registrations
 
@@ -131,113 +127,118 @@ def plot_mopar_timeseries(t, mopars, plot_fname):
     Displacements in mm, rotations in degrees
 
     :param mopars: float array, nt x 6 motion parameters [rx, ry, rz, dx, dy, dz]
-    :param plot_fname: str, output plot filename
+    :param plot_fname: str or file-like, output plot filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
     :return:
     """
 
     nt = mopars.shape[0]
     t = np.arange(0, nt)
 
-    plt.subplots(2, 1, figsize=(10, 5))
+    fig = new_figure((10, 5))
+    axs = fig.subplots(2, 1)
 
-    plt.subplot(2, 1, 1)
-    plt.plot(t, mopars[:, 3:6] * 1e3)
-    plt.legend(['x', 'y', 'z'])
-    plt.title('Displacement (um)', loc='left')
+    axs[0].plot(t, mopars[:, 3:6] * 1e3)
+    axs[0].legend(['x', 'y', 'z'])
+    axs[0].set_title('Displacement (um)', loc='left')
 
-    plt.subplot(2, 1, 2)
-    plt.plot(t, mopars[:, 0:3] * 1e3)
-    plt.legend(['x', 'y', 'z'])
-    plt.title('Rotation (mdeg)', loc='left')
+    axs[1].plot(t, mopars[:, 0:3] * 1e3)
+    axs[1].legend(['x', 'y', 'z'])
+    axs[1].set_title('Rotation (mdeg)', loc='left')
 
     # Add x label to final subplot
-    plt.xlabel('Time (s)')
+    axs[1].set_xlabel('Time (s)')
 
     # Space subplots without title overlap
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
-
-    # Close plot
-    plt.close()
+    save_figure(fig, plot_fname, dpi=dpi, fmt=fmt)
 
 
-def plot_mopar_powerspec(t, mopars, plot_fname):
+def plot_mopar_powerspec(f, pspec, peak_hz, plot_fname, dpi=300, fmt=None):
     """
-    Plot total motion power spectrum
-
-    :param t: float array, time vector (s)
-    :param mopars: array, N x 6
-    :param plot_fname:
+    Plot total motion power spectra from session_spectra
+
+    :param f: float array, frequencies (Hz)
+    :param pspec: array, total displacement and rotation power spectra (2 x nf)
+    :param peak_hz: array, dominant peak frequencies (2 x n_peaks), NaN padded
+    :param plot_fname: str or file-like, output plot filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
     :return:
     """
 
-    # Sampling frequency (Hz)
-    fs = 1.0 / (t[1] - t[0])
-
-    # Total displacement timecourse
-    dtot = np.linalg.norm(mopars[:, 3:6], ord=2, axis=1)
+    titles = ['Displacement (dB)', 'Rotation (dB)']
 
-    # Total rotation timecourse
-    rtot = total_rotation(mopars[:, 0:3])
+    _plot_spectra(f, pspec, peak_hz, titles, plot_fname, dpi=dpi, fmt=fmt)
 
-    # Total motion array
-    mtot = np.array([dtot, rtot])
 
-    # Power spectra of total displacement and rotation timecourses
-    f, pspec = periodogram(mtot, fs, scaling='spectrum')
+def _plot_spectra(f, pspec, peak_hz, titles, plot_fname, dpi=300, fmt=None):
 
-    # Drop first point (zero)
-    pspec = pspec[:, 1:]
+    # Drop first point (zero frequency)
+    p_db = relative_db(pspec[:, 1:])
     f = f[1:]
 
-    plt.subplots(2, 1, figsize=(10, 5))
-    titles = ['Displacement (dB)', 'Rotation (dB)']
+    n = len(titles)
 
-    for lc in range(0, 2):
+    fig = new_figure((10, 5))
+    axs = fig.subplots(n, 1)
 
-        # Power dB relative to row max
-        p = pspec[lc, :]
-        p_max = np.max(p)
-        if p_max < 1e-10:
-            p_db = np.zeros_like(p)
-        else:
-            p_db = 10.0 * np.log10(p / np.max(p))
+    for lc in range(0, n):
 
-        plt.subplot(2, 1, lc+1)
-        plt.plot(f, p_db)
-        plt.title(titles[lc], loc='left')
+        axs[lc].plot(f, p_db[lc])
+
+        # Mark dominant peaks
+        pk = peak_hz[lc][np.isfinite(peak_hz[lc])]
+        if pk.size > 0:
+            axs[lc].plot(pk, np.interp(pk, f, p_db[lc]), 'rv')
+
+        axs[lc].set_title(titles[lc], loc='left')
 
     # Add x axis label to last subplot
-    plt.xlabel('Frequency (Hz)')
+    axs[-1].set_xlabel('Frequency (Hz)')
 
     # Space subplots without title overlap
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(plot_fname, dpi=300)
+    save_figure(fig, plot_fname, dpi=dpi, fmt=fmt)
 
-    # Close plot
-    plt.close()
 
+def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default', dpi=300, fmt=None):
 
-def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
+    sections, vmin, vmax = orthoslice_sections(img_nii, cmap, irng)
 
-    orient_name = ['Axial', 'Coronal', 'Sagittal']
+    return plot_orthoslices(sections, vmin, vmax, ortho_fname, cmap=cmap, dpi=dpi, fmt=fmt)
 
-    img3d = img_nii.get_data()
+
+def orthoslice_sections(img_nii, cmap='viridis', irng='default'):
+    """
+    Central axial, coronal and sagittal sections and display range of a 3D image
+    Only these small arrays need to be passed to a figure worker
+
+    :param img_nii: Nifti object, 3D image
+    :param cmap: str, colormap name (sets the range for irng='noscale')
+    :param irng: str, intensity range ('default', 'robust' or 'noscale')
+    :return sections: list, 2D central sections (axial, coronal, sagittal)
+    :return vmin: float, display minimum
+    :return vmax: float, display maximum
+    """
+
+    img3d = np.asanyarray(img_nii.dataobj)
 
     # Intensity scaling
     if 'robust' in irng:
         vmin, vmax = np.percentile(img3d, (1, 99))
     elif 'noscale' in irng:
-        nc = plt.get_cmap(cmap).N
+        nc = matplotlib.colormaps[cmap].N
         vmin, vmax = 0, nc
     else:
         vmin, vmax = np.min(img3d), np.max(img3d)
 
-    plt.subplots(1, 3, figsize=(7, 2.4))
+    sections = []
 
     for ax in [0, 1, 2]:
 
@@ -246,35 +247,46 @@ def orthoslices(img_nii, ortho_fname, cmap='viridis', irng='default'):
         img3d_t = np.transpose(img3d, ax_order)
 
         # Extract central section in first dimension
-        m2d = img3d_t[int(img3d_t.shape[0]/2), :, :]
+        sections.append(np.array(img3d_t[int(img3d_t.shape[0]/2), :, :]))
 
-        plt.subplot(1, 3, ax+1)
-        plt.imshow(m2d,
-                   cmap=plt.get_cmap(cmap),
-                   vmin=vmin, vmax=vmax,
-                   aspect='equal',
-                   origin='lower')
-        plt.title(orient_name[ax])
+    return sections, vmin, vmax
 
-        plt.axis('off')
-        plt.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
 
-    # Save plot to file
-    plt.savefig(ortho_fname, dpi=300)
+def plot_orthoslices(sections, vmin, vmax, ortho_fname, cmap='viridis', dpi=300, fmt=None):
+
+    orient_name = ['Axial', 'Coronal', 'Sagittal']
 
-    # Close plot
-    plt.close()
+    fig = new_figure((7, 2.4))
+    axs = fig.subplots(1, 3)
+
+    for ax in [0, 1, 2]:
+
+        axs[ax].imshow(sections[ax],
+                       cmap=matplotlib.colormaps[cmap],
+                       vmin=vmin, vmax=vmax,
+                       aspect='equal',
+                       interpolation='nearest',
+                       origin='lower')
+        axs[ax].set_title(orient_name[ax])
+
+        axs[ax].axis('off')
+
+    fig.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
+
+    # Save plot to file
+    save_figure(fig, ortho_fname, dpi=dpi, fmt=fmt)
 
     return ortho_fname
 
 
-def orthoslice_montage(img_nii, montage_fname, cmap='viridis', irng='default'):
+def orthoslice_montage(img_nii, montage_fname, cmap='viridis', irng='default', dpi=300, fmt=None):
 
     orient_name = ['Axial', 'Coronal', 'Sagittal']
 
-    img3d = img_nii.get_data()
+    img3d = np.asanyarray(img_nii.dataobj)
 
-    plt.subplots(1, 3, figsize=(7, 2.4))
+    fig = new_figure((7, 2.4))
+    axs = fig.subplots(1, 3)
 
     for ax in [0, 1, 2]:
 
@@ -300,100 +312,270 @@ def orthoslice_montage(img_nii, montage_fname, cmap='viridis', irng='default'):
             # Do nothing
             pass
 
-        plt.subplot(1, 3, ax+1)
-        plt.imshow(m2d,
-                   cmap=plt.get_cmap(cmap),
-                   aspect='equal',
-                   origin='lower')
-        plt.title(orient_name[ax])
+        axs[ax].imshow(m2d,
+                       cmap=matplotlib.colormaps[cmap],
+                       aspect='equal',
+                       interpolation='nearest',
+                       origin='lower')
+        axs[ax].set_title(orient_name[ax])
 
-        plt.axis('off')
-        plt.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
+        axs[ax].axis('off')
 
     # Remove excess space
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(montage_fname, dpi=300)
+    save_figure(fig, montage_fname, dpi=dpi, fmt=fmt)
 
-    # Close plot
-    plt.close()
 
-
-def roi_demeaned_ts(img_nii, rois_nii, residuals_fname):
+def roi_demeaned_ts(img_nii, rois, residuals_fname, dpi=300, fmt=None):
     """
     Create temporal-spatial image of demeaned voxel timecourse
     - one graymap per ROI
     - subsample voxels in each ROI to yield n_samp timeseries
 
-    :param img_nii:
-    :param rois_nii:
-    :param residuals_fname: str, ROI residuals PNG filename
+    :param img_nii: Nifti object, 4D series
+    :param rois: ROISet or Nifti object, integer ROI labels
+    :param residuals_fname: str or file-like, ROI residuals image filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
     :return:
     """
 
-    # Number of voxel samples from each ROI
-    n_samp = 200
+    plot_roi_carpets(roi_carpets(img_nii, rois), residuals_fname, dpi=dpi, fmt=fmt)
 
-    roi_name = ['Air', 'Nyquist Ghost', 'Signal']
 
-    rois = rois_nii.get_data()
-    s = img_nii.get_data()
+def roi_carpets(img_nii, rois, n_samp=200, method='sample', chunk_mb=64, tmean_nii=None):
+    """
+    Demeaned voxel timecourses from the air, Nyquist ghost and signal ROIs
+    The series is read in chunks of whole volumes and only the carpet rows are kept, so file-backed
+    series are never decoded in full
+
+    :param img_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param rois: ROISet or Nifti object, integer ROI labels
+    :param n_samp: int, carpet rows per ROI (0 for all ROI voxels)
+    :param method: str, row reduction when an ROI has more than n_samp voxels (see carpet_rows)
+    :param chunk_mb: float, approximate working memory per chunk of volumes (MB)
+    :param tmean_nii: Nifti object, temporal mean image of the series (computed with an extra pass if None)
+    :return carpets: list, (rows x nt) demeaned timecourse arrays for ROI labels 1, 2, 3
+    """
+
+    roi_set = as_roiset(rois)
+    nt = img_nii.shape[3]
+
+    inds = [roi_set.indices(lc) for lc in range(1, 4)]
+
+    # Voxel temporal means for demeaning each chunk
+    if tmean_nii is not None:
+        vox_means = np.asanyarray(tmean_nii.dataobj).ravel(order='F')
+    else:
+        vox_means = np.zeros(int(np.prod(img_nii.shape[:3])))
+        for _, chunk in iter_volume_chunks(img_nii, chunk_mb):
+            vox_means += np.sum(chunk.reshape((-1, chunk.shape[3]), order='F'), axis=1, dtype=np.float64)
+        vox_means /= nt
+
+    blocks = [[] for _ in inds]
+
+    for _, chunk in iter_volume_chunks(img_nii, chunk_mb):
+
+        # (voxels x k) view of this chunk
+        c_vt = chunk.reshape((-1, chunk.shape[3]), order='F')
+
+        for lc, roi_inds in enumerate(inds):
+            blocks[lc].append(carpet_rows(c_vt, roi_inds, n_samp, method=method,
+                                          block_mb=chunk_mb, vox_means=vox_means))
+
+    return [np.hstack(b) if b else np.zeros([0, nt]) for b in blocks]
+
 
-    # Number of time points and labels
-    nt = s.shape[3]
+def carpet_rows(s_vt, inds, n_rows=200, method='sample', block_mb=64, vox_means=None):
+    """
+    Carpet plot rows from the voxel timecourses of one ROI
+    Only the voxel rows needed are gathered, in blocks, so memory scales with the carpet size
+    rather than the 4D series
+
+    - 'sample' : n_rows evenly spaced voxels
+    - 'minmax' : consecutive ROI voxels are binned into n_rows / 2 groups and each group contributes
+                 its elementwise minimum and maximum demeaned timecourse, so isolated spikes survive
+                 decimation of large or full-resolution carpets
+    Every voxel is kept if n_rows is 0 or at least the number of ROI voxels
+
+    :param s_vt: array, (voxels x time) view of the series or of a chunk of volumes, Fortran voxel order
+    :param inds: array, flat voxel indices of the ROI
+    :param n_rows: int, carpet rows (0 for all voxels)
+    :param method: str, 'sample' or 'minmax'
+    :param block_mb: float, working memory for gathered voxel timecourses (MB)
+    :param vox_means: array, flat voxel temporal means, None to demean over the volumes in s_vt
+    :return rows: array, (rows x nt) demeaned timecourses
+    """
+
+    nv, nt = inds.size, s_vt.shape[1]
+
+    if nv == 0:
+        return np.zeros([0, nt])
+
+    def demeaned(sel):
+        x = s_vt[sel].astype(np.float64)
+        x -= np.mean(x, axis=1, keepdims=True) if vox_means is None else vox_means[sel][:, np.newaxis]
+        return x
+
+    if 'sample' in method and 0 < n_rows < nv:
+        return demeaned(inds[np.linspace(0, nv - 1, n_rows).astype(int)])
+
+    # Voxel bins: one voxel per row at full resolution, otherwise min/max row pairs
+    full = n_rows <= 0 or n_rows >= nv
+    n_bins = nv if full else max(n_rows // 2, 1)
+    edges = np.linspace(0, nv, n_bins + 1).astype(int)
+
+    rows = np.empty([n_bins if full else 2 * n_bins, nt])
+
+    # Bins per gathered block within the working memory budget
+    bin_size = int(np.ceil(nv / n_bins))
+    n_block = int(max(1, block_mb * 2 ** 20 // (8 * nt * bin_size)))
+
+    for b0 in range(0, n_bins, n_block):
+
+        b1 = min(b0 + n_block, n_bins)
+
+        x = demeaned(inds[edges[b0]:edges[b1]])
+
+        if full:
+            rows[b0:b1] = x
+        else:
+            starts = edges[b0:b1] - edges[b0]
+            rows[2 * b0:2 * b1:2] = np.minimum.reduceat(x, starts, axis=0)
+            rows[2 * b0 + 1:2 * b1:2] = np.maximum.reduceat(x, starts, axis=0)
 
-    plt.subplots(3, 1, figsize=(7, 9))
+    return rows
 
-    for lc in range(1, 4):
 
-        mask3d = np.array(rois == lc)
-        mask4d = np.tile(mask3d[:, :, :, np.newaxis], (1, 1, 1, nt))
+def plot_roi_carpets(carpets, residuals_fname, dpi=300, fmt=None):
+    """
+    Plot one graymap per ROI from roi_carpets
 
-        nx = np.sum(mask3d)
+    :param carpets: list, (n_samp x nt) demeaned timecourse arrays (air, Nyquist ghost, signal)
+    :param residuals_fname: str or file-like, ROI residuals image filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
+    """
 
-        s_xt = s[mask4d].reshape(nx, nt)
+    roi_name = ['Air', 'Nyquist Ghost', 'Signal']
 
-        # Downsample spatial dimension to n_samp
-        inds = np.linspace(0, nx-1, n_samp).astype(int)
-        s_xt_d = s_xt[inds, :]
+    fig = new_figure((7, 9))
+    axs = fig.subplots(3, 1)
 
-        # Demean rows
-        row_means = np.mean(s_xt_d, axis=1)
-        res = s_xt_d.astype(np.float64) - np.tile(row_means[:, np.newaxis], (1, nt))
+    for lc, res in enumerate(carpets):
 
         # Plot graymap
-        plt.subplot(3, 1, lc)
-        plt.imshow(res,
-                   cmap=plt.get_cmap('viridis'),
-                   aspect='auto',
-                   origin='upper'
+        axs[lc].imshow(res,
+                       cmap=matplotlib.colormaps['viridis'],
+                       aspect='auto',
+                       interpolation='nearest',
+                       origin='upper'
         )
 
-        plt.title(roi_name[lc-1])
+        axs[lc].set_title(roi_name[lc])
+
+        axs[lc].axis('off')
 
-        plt.axis('off')
-        plt.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
+    fig.subplots_adjust(bottom=0.0, top=0.9, left=0.0, right=1.0)
 
     # Remove excess space
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save plot to file
-    plt.savefig(residuals_fname, dpi=300)
+    save_figure(fig, residuals_fname, dpi=dpi, fmt=fmt)
+
+
+def plot_slice_spikes(slice_z, row_score, col_score, spike_thresh, plot_fname, dpi=300, fmt=None):
+    """
+    Slice x volume air signal z-scores with detected spikes, and zipper scores of every row and column
+
+    :param slice_z: array, (nz x nt) slice air signal robust z-scores
+    :param row_score: array, (ny x nz) row zipper scores
+    :param col_score: array, (nx x nz) column zipper scores
+    :param spike_thresh: float, slice spike threshold (spikes are circled)
+    :param plot_fname: str or file-like, output filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
+    """
+
+    fig = new_figure((7, 7))
+    gs = fig.add_gridspec(2, 2)
+
+    ax = fig.add_subplot(gs[0, :])
+    # Spikes saturate the color scale so background fluctuations remain visible
+    z_lim = 2.0 * spike_thresh
+    im = ax.imshow(slice_z, cmap='coolwarm', vmin=-z_lim, vmax=z_lim,
+                   aspect='auto', interpolation='nearest', origin='lower')
+
+    zc, tc = np.nonzero(np.nan_to_num(slice_z) > spike_thresh)
+    ax.plot(tc, zc, 'ko', mfc='none', ms=8)
+
+    ax.set_title('Slice Air Signal (robust z)')
+    ax.set_xlabel('Volume')
+    ax.set_ylabel('Slice')
+    fig.colorbar(im, ax=ax)
+
+    # Lines without air space in gray
+    cmap = matplotlib.colormaps['magma'].with_extremes(bad='0.5')
+
+    for col, (score, title) in enumerate([(row_score, 'Row'), (col_score, 'Column')]):
 
-    # Close plot
-    plt.close()
+        ax = fig.add_subplot(gs[1, col])
+        im = ax.imshow(score, cmap=cmap, vmin=0.0, aspect='auto', interpolation='nearest', origin='lower')
+        ax.set_title('{} Zipper Score'.format(title))
+        ax.set_xlabel('Slice')
+        ax.set_ylabel(title)
+        fig.colorbar(im, ax=ax)
+
+    # Remove excess space
+    fig.tight_layout()
+
+    save_figure(fig, plot_fname, dpi=dpi, fmt=fmt)
+
+
+def plot_weisskoff(widths, cv, cv_theory, rdc, plot_fname, dpi=300, fmt=None):
+    """
+    Weisskoff plot of ROI fluctuation against ROI width (log-log)
+
+    :param widths: array, square ROI widths (voxels)
+    :param cv: array, measured fluctuation (% of mean)
+    :param cv_theory: array, fluctuation expected for uncorrelated noise (1 / width)
+    :param rdc: float, radius of decorrelation (voxels)
+    :param plot_fname: str or file-like, output plot filename or buffer
+    :param dpi: int, raster resolution
+    :param fmt: str, image format, None to infer from the filename
+    """
+
+    fig = new_figure((7, 5))
+    ax = fig.subplots(1, 1)
+
+    ax.loglog(widths, cv, 'o-', label='Measured')
+    ax.loglog(widths, cv_theory, 'k--', label='Theoretical')
+    ax.axvline(rdc, color='r', linestyle=':', label='RDC = {:.1f}'.format(rdc))
+
+    ax.set_xlabel('ROI Width (voxels)')
+    ax.set_ylabel('Fluctuation (%)')
+    ax.legend()
+
+    # Space subplots without title overlap
+    fig.tight_layout()
+
+    # Save plot to file
+    save_figure(fig, plot_fname, dpi=dpi, fmt=fmt)
 
 
-def metric_trend_plot(mc, metric_name, metrics_df, gridspec, past_months=12):
+def metric_trend_plot(fig, mc, metric_name, metrics_df, gridspec, past_months=12):
     """
     Plot session metric trend with median, 5th and 95th percentiles
     Add metric histogram at right
 
+    :param fig: Figure, summary figure
     :param mc: int, index of metric to plot
     :param metric_name: str, metric name to plot
     :param metrics_df: DataFrame, complete metric dataframe for current subject
-    :param gridspec: GridSpec, pyplot grid specification
+    :param gridspec: GridSpec, figure grid specification
     :param past_months: int, number of past months to plot
     :return:
     """
@@ -404,7 +586,7 @@ def metric_trend_plot(mc, metric_name, metrics_df, gridspec, past_months=12):
     t1 = pd.Timestamp(date.today())
     t0 = t1 - pd.DateOffset(months=past_months)
 
-    ax0 = plt.subplot(gridspec[mc, 0])
+    ax0 = fig.add_subplot(gridspec[mc, 0])
 
     marker_dict = {'Outlier': 'x', 'Inlier': 'o'}
     color_dict = {'Outlier': 'red', 'Inlier': 'palegreen'}
@@ -434,7 +616,7 @@ def metric_trend_plot(mc, metric_name, metrics_df, gridspec, past_months=12):
     ax0.plot([t0, t1], [p50, p50], 'g')
     ax0.plot([t0, t1], [p95, p95], 'g:')
 
-    ax1 = plt.subplot(gridspec[mc, 1], sharey=ax0)
+    ax1 = fig.add_subplot(gridspec[mc, 1], sharey=ax0)
     df.hist(
         column=metric_name,
         grid=False,
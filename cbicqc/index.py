@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Persistent session file index for BIDS QC datasets
+Replaces a full BIDSLayout re-index on every run with an incremental index
+of the fixed sub-*/ses-*/<datatype>/ QC layout, updated from directory mtimes
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+
+
+class QCIndex:
+
+    # Bump if the on-disk index structure changes
+    _version = 1
+
+    def __init__(self, bids_dir, index_fname):
+        """
+        Session file index for a BIDS QC dataset
+
+        :param bids_dir: str, BIDS dataset root directory
+        :param index_fname: str, JSON index filename (typically in derivatives/cbicqc)
+        """
+
+        self._bids_dir = bids_dir
+        self._index_fname = index_fname
+
+        # Directory tree with mtimes at root, subject, session and datatype levels
+        self._tree = self._load()
+
+    def update(self):
+        """
+        Rescan only those directories whose mtime has changed since the last update
+        Every directory is still stat'ed since changes deep in the tree do not touch parent mtimes
+
+        :return n_scanned: int, number of directories rescanned
+        """
+
+        n_scanned = self._refresh(self._bids_dir, self._tree, 'sub-', 'subjects')
+
+        for sub_label, sub_entry in self._tree['subjects'].items():
+
+            sub_dir = os.path.join(self._bids_dir, 'sub-' + sub_label)
+            n_scanned += self._refresh(sub_dir, sub_entry, 'ses-', 'sessions')
+
+            for ses_label, ses_entry in sub_entry['sessions'].items():
+
+                ses_dir = os.path.join(sub_dir, 'ses-' + ses_label)
+                n_scanned += self._refresh(ses_dir, ses_entry, '', 'datatypes')
+
+                for dtype, dtype_entry in ses_entry['datatypes'].items():
+
+                    dtype_dir = os.path.join(ses_dir, dtype)
+                    n_scanned += self._refresh_files(dtype_dir, dtype_entry)
+
+        return n_scanned
+
+    def save(self):
+
+        # Write to temporary file then rename so concurrent readers never see a partial index
+        tmp_fname = self._index_fname + '.tmp'
+
+        with open(tmp_fname, 'w') as fd:
+            json.dump(self._tree, fd)
+
+        os.replace(tmp_fname, self._index_fname)
+
+    def get_subjects(self):
+
+        return sorted(self._tree['subjects'])
+
+    def get_sessions(self, subject):
+
+        sub_entry = self._tree['subjects'].get(subject, None)
+
+        return sorted(sub_entry['sessions']) if sub_entry else []
+
+    def get(self, subject, session, suffix, extension=('.nii', '.nii.gz')):
+        """
+        Absolute paths of all files in a session with a given BIDS suffix and extension
+
+        :param subject: str, subject label without 'sub-' prefix
+        :param session: str, session label without 'ses-' prefix
+        :param suffix: str, BIDS suffix (eg 'T2star', 'bold')
+        :param extension: tuple, allowed file extensions
+        :return fnames: list, sorted absolute file paths
+        """
+
+        fnames = []
+
+        try:
+            ses_entry = self._tree['subjects'][subject]['sessions'][session]
+        except KeyError:
+            return fnames
+
+        for dtype, dtype_entry in ses_entry['datatypes'].items():
+
+            for fname in dtype_entry['files']:
+
+                for ext in extension:
+                    if fname.endswith('_' + suffix + ext):
+                        fnames.append(os.path.join(self._bids_dir,
+                                                   'sub-' + subject,
+                                                   'ses-' + session,
+                                                   dtype,
+                                                   fname))
+
+        return sorted(fnames)
+
+    def _load(self):
+
+        empty = dict(version=self._version, mtime=0, subjects=dict())
+
+        try:
+            with open(self._index_fname, 'r') as fd:
+                tree = json.load(fd)
+        except (IOError, ValueError):
+            return empty
+
+        if tree.get('version', None) != self._version:
+            return empty
+
+        return tree
+
+    @staticmethod
+    def _refresh(dname, entry, prefix, key):
+        """
+        Reconcile child directory entries with the filesystem if the directory mtime has changed
+
+        :param dname: str, directory path
+        :param entry: dict, index entry for this directory
+        :param prefix: str, required child directory prefix ('sub-', 'ses-' or '')
+        :param key: str, child entry key in index entry
+        :return: int, 1 if directory was rescanned, otherwise 0
+        """
+
+        mtime = os.stat(dname).st_mtime_ns
+
+        if entry.get('mtime', None) == mtime and key in entry:
+            return 0
+
+        children = entry.setdefault(key, dict())
+
+        labels = set()
+        with os.scandir(dname) as it:
+            for de in it:
+                if de.is_dir() and de.name.startswith(prefix) and not de.name.startswith('.'):
+                    labels.add(de.name[len(prefix):])
+
+        # Drop deleted children and add new children with an unset mtime to force a scan
+        for label in set(children) - labels:
+            del children[label]
+
+        for label in labels - set(children):
+            children[label] = dict(mtime=0)
+
+        entry['mtime'] = mtime
+
+        return 1
+
+    @staticmethod
+    def _refresh_files(dname, entry):
+
+        mtime = os.stat(dname).st_mtime_ns
+
+        if entry.get('mtime', None) == mtime and 'files' in entry:
+            return 0
+
+        with os.scandir(dname) as it:
+            entry['files'] = sorted(de.name for de in it if de.is_file())
+
+        entry['mtime'] = mtime
+
+        return 1
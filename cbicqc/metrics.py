@@ -26,17 +26,22 @@ Copyright 2019 California Institute of Technology.
 
 import numpy as np
 
+from .rois import as_roiset
 
-def qc_metrics(fit_results, tsfnr_nii, rois_nii):
+
+def qc_metrics(fit_results, tsfnr_nii, rois, spikes=None, weisskoff=None):
     """
     Calculate QC metrics for each ROI
 
-    :param fit_results: list, fit objects from scipy least_squares
+    :param fit_results: list, explin fit results (.x parameters, .fun residuals) from detrend_timeseries
+    :param tsfnr_nii: Nifti object, voxelwise tSFNR image
+    :param rois: ROISet or Nifti object, integer ROI labels
+    :param spikes: dict, slice spike and zipper detections from slice_spikes (optional)
+    :param weisskoff: dict, Weisskoff analysis results (optional)
     :return metrics:, dict, QC metric results dictionary
     """
 
     # TODO:
-    # EMI analysis with zipper identification
     # Coil element SNR and fluctuation analysis
     # - Requires separate labels for each coil element
 
@@ -50,7 +55,7 @@ def qc_metrics(fit_results, tsfnr_nii, rois_nii):
     signal_mean = fit_results[2].x[3]
 
     # Calculate main signal tSFNR
-    tsfnr = calc_tsfnr(tsfnr_nii, rois_nii)
+    tsfnr = calc_tsfnr(tsfnr_nii, rois)
 
     # Create and fill dictionary of QC metrics
     metrics = dict()
@@ -74,6 +79,15 @@ def qc_metrics(fit_results, tsfnr_nii, rois_nii):
     metrics['NyquistSpikes'] = spike_count(fit_results[1].fun)
     metrics['AirSpikes'] = spike_count(fit_results[2].fun)
 
+    # Slice-resolved EMI spikes and zipper artifacts
+    if spikes is not None:
+        metrics['SliceSpikes'] = spikes['n_spikes']
+        metrics['ZipperScore'] = spikes['zipper_score']
+
+    # Radius of decorrelation (voxels)
+    if weisskoff is not None:
+        metrics['RDC'] = weisskoff['rdc']
+
     return metrics
 
 
@@ -99,12 +113,15 @@ def spike_count(points, thresh=3.5):
     return int(np.sum(modified_z_score > thresh))
 
 
-def calc_tsfnr(tsfnr_nii, rois_nii):
+def calc_tsfnr(tsfnr_nii, rois):
+
+    tsfnr_img = np.asanyarray(tsfnr_nii.dataobj)
 
-    tsfnr_img = tsfnr_nii.get_data()
-    rois_img = rois_nii.get_data()
+    # Gather label 1 voxels from the flat (Fortran order) tSFNR image
+    tsfnr_roi = as_roiset(rois).gather(tsfnr_img.ravel(order='F'), 1)
 
-    return np.mean(tsfnr_img[rois_img == 1])
+    # Cast to float to prevent JSON encoding errors later (float32 series)
+    return float(np.mean(tsfnr_roi))
 
 
 
@@ -28,58 +28,187 @@ import os
 import subprocess
 import numpy as np
 import nibabel as nb
-from scipy.ndimage.measurements import center_of_mass
-from scipy.ndimage import shift
 from scipy.spatial.transform import Rotation
 
+from .resample import shift_volumes
 
-def moco_phantom(img_nii):
+
+def moco_phantom(img_nii, inplace=False, method='spline', order=3, n_threads=0):
     """
     Spherical QC phantom requires simpler registration approach.
     Use center of mass registration only.
 
     :param img_nii: Nifti object,
         4D QC time series
+    :param inplace: bool,
+        Correct the series array in place rather than a copy (avoids a second 4D array)
+    :param method: str,
+        Resampling backend, 'spline' or 'fourier' (see resample.shift_volumes)
+    :param order: int,
+        Spline interpolation order
+    :param n_threads: int,
+        Resampling threads (0 = all available)
     :return moco_nii: Nifti object,
         Motion corrected 4D QC time series
     :return moco_pars: array,
         Motion parameter array (nt x 6)
     """
 
-    img = img_nii.get_data()
+    img = np.asanyarray(img_nii.dataobj)
     nt = img.shape[3]
     vox_mm = img_nii.header.get('pixdim')[1:4]
 
     # Clip intensity range to 1st, 99th percentile for robust CoM
-    p1, p99 = np.percentile(img, (1, 99))
-    img_clip = np.clip(img, p1, p99)
+    p1, p99 = fast_percentile(img, (1, 99))
+
+    # Center of mass shift required to register each volume to the zeroth volume
+    com_t = centers_of_mass(img, p1, p99)
+    com_d = com_t[0] - com_t
+
+    # Translate all volumes to the zeroth volume
+    # Spline resampling uses 'nearest neighbor' mode to minimize motion x signal artifacts at image edges
+    moco_img = shift_volumes(img, com_d, method=method, order=order, n_threads=n_threads,
+                             out=img if inplace else None)
 
-    moco_img = img.copy()
+    # Save CoM translations
+    # FSL MCFLIRT convention: [rx, ry, rz, dx, dy, dz]
     moco_pars = np.zeros([nt, 6])
+    moco_pars[:, 3:6] = com_d * vox_mm
 
-    # Reference center of mass
-    com_0 = np.array(center_of_mass(img_clip[:, :, :, 0]))
+    # Create motion corrected Nifti volume
+    moco_nii = nb.Nifti1Image(moco_img, img_nii.affine)
 
-    for tc in range(1, nt):
+    return moco_nii, moco_pars
 
-        # Center of mass of current volume
-        com_t = np.array(center_of_mass(img_clip[:, :, :, tc]))
 
-        # Center of mass shift required to register current and zeroth volumes
-        com_d = com_0 - com_t
+def centers_of_mass(img, vmin, vmax, chunk_mb=4):
+    """
+    Intensity-weighted centroid of every volume in one pass over the series
+    Equivalent to scipy center_of_mass of each clipped volume. Each block of volumes is clipped
+    once and reduced to its marginal projections, so no clipped 4D copy is made
+
+    :param img: array, 4D series (nx x ny x nz x nt)
+    :param vmin: float, lower clip intensity
+    :param vmax: float, upper clip intensity
+    :param chunk_mb: float, approximate working memory for each clipped block of volumes (MB)
+    :return com: array, voxel coordinate centers of mass (nt x 3)
+    """
 
-        # Translate with spline interpolation
-        # Use 'nearest neighbor' mode to minimize motion x signal artifacts at image edges
-        moco_img[:, :, :, tc] = shift(img[:, :, :, tc], com_d, mode='nearest')
+    nx, ny, nz, nt = img.shape
 
-        # Save CoM translation
-        # FSL MCFLIRT convention: [rx, ry, rz, dx, dy, dz]
-        moco_pars[tc, 3:6] = com_d * vox_mm
+    # Small cache-resident blocks keep the clip and both reductions in one sweep of memory
+    n_vols = int(max(1, chunk_mb * 2 ** 20 // (nx * ny * nz * img.itemsize)))
+    buf = np.empty((nx, ny, nz, min(n_vols, nt)), dtype=img.dtype, order='F')
 
-    # Create motion corrected Nifti volume
-    moco_nii = nb.Nifti1Image(moco_img, img_nii.affine)
+    com = np.zeros([nt, 3])
 
-    return moco_nii, moco_pars
+    for t0 in range(0, nt, n_vols):
+
+        block = img[..., t0:t0 + n_vols]
+        k = block.shape[3]
+
+        c = np.clip(block, vmin, vmax, out=buf[..., :k])
+        c = c.reshape((nx, ny * nz, k), order='F')
+
+        # Marginal projections along x and onto the yz plane
+        # Partial sums are short, so accumulate in the image type then total in float64
+        s_x = np.einsum('xmt->xt', c).astype(np.float64)
+        s_yz = np.einsum('xmt->mt', c).astype(np.float64).reshape((ny, nz, k), order='F')
+
+        total = np.sum(s_x, axis=0)
+
+        com[t0:t0 + k, 0] = np.arange(nx) @ s_x / total
+        com[t0:t0 + k, 1] = np.arange(ny) @ np.sum(s_yz, axis=1) / total
+        com[t0:t0 + k, 2] = np.arange(nz) @ np.sum(s_yz, axis=0) / total
+
+    return com
+
+
+def fast_percentile(x, q, sample_step=97, block_size=1 << 18):
+    """
+    Exact percentiles (numpy linear interpolation) without sorting or copying the full array
+    A strided sample brackets each required order statistic, then one cache-blocked pass counts
+    values below and tied with each bracket and gathers the few values inside it.
+    Falls back to np.percentile if a bracket misses
+
+    :param x: array, data (any shape)
+    :param q: tuple, percentiles in [0, 100]
+    :param sample_step: int, stride of the bracketing sample
+    :param block_size: int, elements per block of the counting pass
+    :return: array, percentile values
+    """
+
+    flat = x.reshape(-1, order='A')
+    n = flat.size
+
+    sample = np.sort(flat[::sample_step])
+    m = sample.size
+
+    if m < 100:
+        return np.percentile(x, q)
+
+    q = np.atleast_1d(q).astype(float)
+
+    # Sample brackets around each interpolated rank with a generous binomial margin
+    brackets = []
+    for qc in q:
+        j = qc / 100.0 * (m - 1)
+        dj = 6 * np.sqrt(m * max(qc / 100.0 * (1 - qc / 100.0), 1.0 / m)) + 2
+        jlo, jhi = int(np.floor(j - dj)), int(np.ceil(j + dj))
+        brackets.append((sample[jlo] if jlo >= 0 else -np.inf,
+                         sample[jhi] if jhi < m else np.inf))
+
+    # Counts below and tied with the bracket ends (ties are common, eg zero-filled air)
+    # and values strictly inside each bracket
+    n_below = np.zeros(len(q), dtype=np.int64)
+    n_lo = np.zeros(len(q), dtype=np.int64)
+    n_hi = np.zeros(len(q), dtype=np.int64)
+    inside = [[] for _ in q]
+
+    for b0 in range(0, n, block_size):
+
+        blk = flat[b0:b0 + block_size]
+
+        for qc, (lo, hi) in enumerate(brackets):
+            n_below[qc] += np.count_nonzero(blk < lo)
+            n_lo[qc] += np.count_nonzero(blk == lo)
+            if hi > lo:
+                n_hi[qc] += np.count_nonzero(blk == hi)
+            mask = blk > lo
+            mask &= blk < hi
+            inside[qc].append(blk[mask])
+
+    results = []
+
+    for qc, (lo, hi) in enumerate(brackets):
+
+        interior = np.concatenate(inside[qc])
+
+        # Order statistics either side of the interpolated rank
+        rank = q[qc] / 100.0 * (n - 1)
+        k = int(np.floor(rank))
+
+        v = []
+
+        for kc in [k, min(k + 1, n - 1)]:
+
+            i = kc - n_below[qc]
+
+            if 0 <= i < n_lo[qc]:
+                v.append(lo)
+            elif 0 <= i - n_lo[qc] < interior.size:
+                i -= n_lo[qc]
+                v.append(np.partition(interior, i)[i])
+            elif 0 <= i - n_lo[qc] - interior.size < n_hi[qc]:
+                v.append(hi)
+            else:
+                return np.percentile(x, q)
+
+        v_k, v_k1 = float(v[0]), float(v[1])
+
+        results.append(v_k + (v_k1 - v_k) * (rank - k))
+
+    return np.array(results)
 
 
 def moco_live(img_nii, work_dir):
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Real-time incremental QC for series still being acquired
+Volumes are accepted one at a time (eg from a scanner real-time export directory) and
+running statistics are updated in O(volume) per step, with partial metrics every N volumes
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import numpy as np
+import nibabel as nb
+from nibabel.filebasedimages import ImageFileError
+from scipy.ndimage import center_of_mass
+
+from .timeseries import welford_update, detrend_timeseries
+from .rois import make_rois, as_roiset
+from .metrics import qc_metrics
+
+
+class IncrementalQC:
+
+    def __init__(self, rois_nii=None, report_every=10, n_init=10):
+        """
+        Running QC analysis of a series acquired one volume at a time
+
+        :param rois_nii: Nifti object, ROI labels (as from make_rois). If None, phantom ROIs are
+            built from the running mean once n_init volumes have arrived
+        :param report_every: int, emit partial metrics every N volumes
+        :param n_init: int, volumes buffered before ROIs are built (if rois_nii is None)
+        """
+
+        self._roi_set = as_roiset(rois_nii) if rois_nii is not None else None
+        self._report_every = report_every
+        self._n_init = n_init
+
+        self._affine = None
+        self._vox_mm = None
+
+        # Running temporal mean and sum of squared deviations (float64)
+        self._n = 0
+        self._tmean = None
+        self._m2 = None
+
+        # Per-volume ROI means
+        self._roi_ts = []
+
+        # Volumes held back until ROIs exist
+        self._pending = []
+
+        # Center of mass clip range and reference
+        self._clip = None
+        self._com_0 = None
+        self._mopars = []
+
+    @property
+    def n_volumes(self):
+        return self._n
+
+    def add_volume(self, vol, affine=None, vox_mm=None):
+        """
+        Merge one volume into the running analysis
+
+        :param vol: array or Nifti object, 3D volume
+        :param affine: array, voxel to world transform (taken from vol if it is a Nifti object)
+        :param vox_mm: array, voxel dimensions in mm (taken from vol if it is a Nifti object)
+        :return metrics: dict, partial metrics every report_every volumes, otherwise None
+        """
+
+        if isinstance(vol, nb.spatialimages.SpatialImage):
+            affine = vol.affine
+            vox_mm = vol.header.get_zooms()[:3]
+            vol = np.asanyarray(vol.dataobj)
+
+        vol = np.asarray(vol, dtype=np.float32)
+
+        if self._tmean is None:
+            self._affine = np.eye(4) if affine is None else affine
+            self._vox_mm = np.ones(3) if vox_mm is None else np.asarray(vox_mm, dtype=float)
+            self._tmean = np.zeros(vol.shape)
+            self._m2 = np.zeros(vol.shape)
+
+        # Running mean and SD
+        self._n = welford_update(self._n, self._tmean, self._m2, vol[..., np.newaxis])
+
+        # Center of mass motion (as in moco_phantom, relative to the first volume)
+        self._mopars.append(self._com_motion(vol))
+
+        # ROI means - volumes are buffered until ROIs can be built from the running mean
+        self._pending.append(vol)
+
+        if self._roi_set is None and self._n >= self._n_init:
+            _, self._roi_set = phantom_rois(nb.Nifti1Image(self._tmean, self._affine))
+
+        if self._roi_set is not None:
+            for v in self._pending:
+                self._roi_ts.append(self._roi_means(v))
+            self._pending = []
+
+        if self._n % self._report_every == 0:
+            return self.metrics()
+
+        return None
+
+    def metrics(self):
+        """
+        Partial QC metrics for the volumes received so far
+        Uses the same detrending and metric calculations as the full analysis
+
+        :return metrics: dict, QC metrics plus volume count and motion summary, or None if too few volumes
+        """
+
+        if len(self._roi_ts) < 8:
+            return None
+
+        s_mean_t = np.array(self._roi_ts).T
+
+        # Rows for labels 1 .. max label (NaN for empty labels, as extract_timeseries)
+        fit_results, _ = detrend_timeseries(np.nan_to_num(s_mean_t))
+
+        tsfnr = self._tmean / (self.tsd + np.finfo(float).eps)
+        tsfnr_nii = nb.Nifti1Image(tsfnr, self._affine)
+
+        metrics = qc_metrics(fit_results, tsfnr_nii, self._roi_set)
+
+        disp = np.linalg.norm(np.array(self._mopars)[:, 3:6], axis=1)
+        metrics['Volumes'] = int(self._n)
+        metrics['MeanDisplacement'] = float(np.mean(disp))
+        metrics['MaxDisplacement'] = float(np.max(disp))
+
+        return metrics
+
+    @property
+    def tmean(self):
+        return self._tmean
+
+    @property
+    def tsd(self):
+        # Population SD to match temporal_mean_sd
+        return np.sqrt(self._m2 / max(self._n, 1))
+
+    @property
+    def roi_timeseries(self):
+        return np.array(self._roi_ts).T
+
+    @property
+    def moco_pars(self):
+        return np.array(self._mopars)
+
+    def _roi_means(self, vol):
+
+        return self._roi_set.means(self._roi_set.gather(vol.ravel(order='F')))
+
+    def _com_motion(self, vol):
+
+        # Clip to the 1st, 99th percentile of the first volume for a robust CoM
+        if self._clip is None:
+            self._clip = np.percentile(vol, (1, 99))
+
+        com_t = np.array(center_of_mass(np.clip(vol, *self._clip)))
+
+        if self._com_0 is None:
+            self._com_0 = com_t
+
+        # FSL MCFLIRT convention: [rx, ry, rz, dx, dy, dz]
+        mopars = np.zeros(6)
+        mopars[3:6] = (self._com_0 - com_t) * self._vox_mm
+
+        return mopars
+
+
+def phantom_rois(tmean_nii, frac=0.25):
+    """
+    Phantom ROIs from a threshold mask of the temporal mean
+    Stands in for template registration while the series is still being acquired
+
+    :param tmean_nii: Nifti object, temporal mean image
+    :param frac: float, threshold as a fraction of the 99th percentile intensity
+    :return rois_nii: Nifti object, ROI labels (see make_rois)
+    :return roi_set: ROISet, sparse ROI voxel indices
+    """
+
+    tmean = np.asanyarray(tmean_nii.dataobj)
+
+    labels = (tmean > frac * np.percentile(tmean, 99)).astype(np.uint8)
+
+    return make_rois(nb.Nifti1Image(labels, tmean_nii.affine))
+
+
+def follow_directory(in_dir, qc, metrics_fname='', poll_interval=1.0, timeout=60.0, n_volumes=0):
+    """
+    Feed 3D NIfTI volumes from a directory to an IncrementalQC as they appear
+    Files are taken in natural filename order once their size is unchanged over at least one poll
+    interval. Files that still fail to load (eg truncated by a slow writer) are retried on the next poll
+
+    :param in_dir: str, directory written by the scanner real-time export
+    :param qc: IncrementalQC object
+    :param metrics_fname: str, JSON file rewritten with the latest partial metrics (optional)
+    :param poll_interval: float, seconds between directory polls
+    :param timeout: float, stop after this many seconds without a new volume
+    :param n_volumes: int, stop after this many volumes (0 = until timeout)
+    :return metrics: dict, final partial metrics
+    """
+
+    done = set()
+
+    # (size, time of reading) of each file at its first unchanged size
+    sizes = dict()
+    t_last = time.time()
+    metrics = None
+
+    print('    Following {}'.format(in_dir))
+
+    while True:
+
+        new_fnames = []
+
+        for fname in sorted(os.listdir(in_dir), key=_natural_key):
+
+            if fname in done or not (fname.endswith('.nii') or fname.endswith('.nii.gz')):
+                continue
+
+            # Wait for the writer to finish - size unchanged for at least one poll interval
+            size = os.path.getsize(os.path.join(in_dir, fname))
+            if fname not in sizes or sizes[fname][0] != size:
+                sizes[fname] = (size, time.time())
+                break
+            if time.time() - sizes[fname][1] < poll_interval:
+                break
+
+            new_fnames.append(fname)
+
+        retry = False
+
+        for fname in new_fnames:
+
+            try:
+
+                img_nii = nb.load(os.path.join(in_dir, fname))
+
+                # Accept single volumes or short 4D blocks
+                vols = np.asanyarray(img_nii.dataobj)
+
+            except (ImageFileError, EOFError, OSError, ValueError, zlib.error) as err:
+
+                # Incomplete file - retry from this file once its size is stable again
+                print('    * Could not load {} ({}) - retrying'.format(fname, err))
+                sizes.pop(fname, None)
+                retry = True
+                break
+
+            if vols.ndim == 3:
+                vols = vols[..., np.newaxis]
+
+            for tc in range(vols.shape[3]):
+
+                m = qc.add_volume(vols[..., tc], img_nii.affine, img_nii.header.get_zooms()[:3])
+
+                if m is not None:
+                    metrics = m
+                    _print_metrics(metrics)
+                    if metrics_fname:
+                        _save_metrics(metrics, metrics_fname)
+
+            done.add(fname)
+            t_last = time.time()
+
+        if n_volumes and qc.n_volumes >= n_volumes:
+            break
+
+        if time.time() - t_last > timeout:
+            print('    No new volumes for {:.0f} seconds - stopping'.format(timeout))
+            break
+
+        if retry or not new_fnames:
+            time.sleep(poll_interval)
+
+    # Final metrics for all volumes received
+    final = qc.metrics()
+    if final is not None and (metrics is None or final['Volumes'] != metrics['Volumes']):
+        metrics = final
+        _print_metrics(metrics)
+        if metrics_fname:
+            _save_metrics(metrics, metrics_fname)
+
+    return metrics
+
+
+def _natural_key(fname):
+
+    # Numbered volumes sort numerically (vol_2 before vol_10)
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', fname)]
+
+
+def _print_metrics(metrics):
+
+    print('      Volume {:4d} : SFNR {:7.1f}  SNR {:7.1f}  Drift {:6.3f} %  Spikes {:d}  Max disp {:.3f} mm'.format(
+        metrics['Volumes'], metrics['SFNR'], metrics['SNR'], metrics['Drift'],
+        metrics['SignalSpikes'], metrics['MaxDisplacement']))
+
+
+def _save_metrics(metrics, metrics_fname):
+
+    # Write then rename so readers never see a partial file
+    tmp_fname = metrics_fname + '.tmp'
+
+    with open(tmp_fname, 'w') as fd:
+        json.dump({k: float(v) if isinstance(v, np.floating) else v for k, v in metrics.items()},
+                  fd, sort_keys=True, indent=4)
+
+    os.replace(tmp_fname, metrics_fname)
@@ -38,6 +38,7 @@ SOFTWARE.
 """
 
 import os
+import io
 import json
 import shutil
 import datetime as dt
@@ -53,12 +54,29 @@ from reportlab.platypus import (SimpleDocTemplate,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 
+# Optional vector figure embedding
+try:
+    from svglib.svglib import svg2rlg
+except ImportError:
+    svg2rlg = None
+
 
 class ReportPDF:
 
-    def __init__(self, fnames, meta, metrics):
+    def __init__(self, fnames, meta, metrics, figures, bands=()):
+        """
+        Build session QC report PDF and write metrics JSON sidecar
+
+        :param fnames: dict, work directory and report output filenames
+        :param meta: dict, session metadata
+        :param metrics: dict, QC metrics
+        :param figures: dict, rendered figures (PNG or SVG bytes, or image filenames)
+        :param bands: list, (f_lo, f_hi) band power map frequency bands (Hz)
+        """
 
         self._fnames = fnames
+        self._figures = figures
+        self._bands = bands
         self._meta = meta
         self._metrics = metrics
         self._tmp_report_pdf = os.path.join(fnames['WorkDir'], 'report.pdf')
@@ -73,9 +91,11 @@ class ReportPDF:
         self._init_pdf()
         self._add_summary()
         self._add_roi_timeseries()
+        self._add_weisskoff()
         self._add_motion_timeseries()
         self._add_sections()
         self._add_demeaned_ts()
+        self._add_slice_spikes()
 
         self._doc.build(self._contents)
         self._save_report()
@@ -149,6 +169,9 @@ class ReportPDF:
                           ['Warmup Time Constant', '{:.1f} TRs'.format(self._metrics['WarmupTime'])]
                           ]
 
+        if 'RDC' in self._metrics:
+            signal_metrics.append(['Radius of Decorrelation', '{:.1f} voxels'.format(self._metrics['RDC'])])
+
         ptext = '<font size=11><b>Main Signal</b></font>'
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
@@ -163,6 +186,10 @@ class ReportPDF:
                          ['Nyquist Ghost Spikes', '{}'.format(self._metrics['NyquistSpikes'])],
                          ['Air Spikes', '{}'.format(self._metrics['AirSpikes'])]]
 
+        if 'SliceSpikes' in self._metrics:
+            noise_metrics += [['Slice Spikes', '{}'.format(self._metrics['SliceSpikes'])],
+                              ['Zipper Score', '{:.1f}'.format(self._metrics['ZipperScore'])]]
+
         ptext = '<font size=11><b>Noise and Spiking</b></font>'
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
@@ -194,7 +221,7 @@ class ReportPDF:
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        roi_ts_img = Image(self._fnames['ROITimeseries'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
+        roi_ts_img = figure_flowable(self._figures['ROITimeseries'], 7.0 * inch, 3.5 * inch)
         self._contents.append(roi_ts_img)
 
         self._contents.append(Spacer(1, 0.5 * inch))
@@ -210,17 +237,44 @@ class ReportPDF:
         ptext = """
         <font size=11>
         Power spectrum of the spatial mean signal in each ROI. The dB scale is relative to maximum spectral power.
+        Red markers indicate the dominant spectral peaks.
         </font>
         """
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        roi_ps_img = Image(self._fnames['ROIPowerspec'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
+        roi_ps_img = figure_flowable(self._figures['ROIPowerspec'], 7.0 * inch, 3.5 * inch)
         self._contents.append(roi_ps_img)
 
         self._contents.append(Spacer(1, 0.5 * inch))
 
 
+    def _add_weisskoff(self):
+
+        if 'Weisskoff' not in self._figures:
+            return
+
+        # Page break
+        self._contents.append(PageBreak())
+
+        ptext = '<font size=14><b>Weisskoff Analysis</b></font>'
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.25 * inch))
+
+        ptext = """
+        <font size=11>
+        Fluctuation of the quadratically detrended mean signal in square ROIs of increasing width, centered
+        on the phantom in its central slice. Uncorrelated noise falls as the inverse of the ROI width
+        (dashed line). The radius of decorrelation (RDC) is the width beyond which larger ROIs no longer
+        reduce the fluctuation, so low RDC indicates spatially correlated instability.
+        </font>
+        """
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.1 * inch))
+
+        weisskoff_img = figure_flowable(self._figures['Weisskoff'], 7.0 * inch, 5.0 * inch)
+        self._contents.append(weisskoff_img)
+
     def _add_motion_timeseries(self):
 
         # Page break
@@ -244,7 +298,7 @@ class ReportPDF:
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        mo_ts_img = Image(self._fnames['MoparTimeseries'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
+        mo_ts_img = figure_flowable(self._figures['MoparTimeseries'], 7.0 * inch, 3.5 * inch)
         self._contents.append(mo_ts_img)
 
         self._contents.append(Spacer(1, 0.5 * inch))
@@ -260,13 +314,13 @@ class ReportPDF:
         ptext = """
         <font size=11>
         Power spectrum of the absolute displacement and total rotation timecourses.
-        The dB scale is relative to maximum spectral power.
+        The dB scale is relative to maximum spectral power. Red markers indicate the dominant spectral peaks.
         </font>
         """
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        mo_ts_img = Image(self._fnames['MoparPowerspec'], 7.0 * inch, 3.5 * inch, hAlign='LEFT')
+        mo_ts_img = figure_flowable(self._figures['MoparPowerspec'], 7.0 * inch, 3.5 * inch)
         self._contents.append(mo_ts_img)
 
         self._contents.append(Spacer(1, 0.5 * inch))
@@ -280,17 +334,52 @@ class ReportPDF:
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.25 * inch))
 
-        self._add_section('Temporal Mean', self._fnames['TMeanMontage'])
-        self._add_section('Temporal Standard Deviation', self._fnames['TSDMontage'])
-        self._add_section('Regions of Interest', self._fnames['ROIsMontage'])
+        self._add_section('Temporal Mean', self._figures['TMeanMontage'])
+        self._add_section('Temporal Standard Deviation', self._figures['TSDMontage'])
+        self._add_section('Regions of Interest', self._figures['ROIsMontage'])
+
+        # Voxelwise maps from explin fits of in-phantom voxels
+        self._contents.append(PageBreak())
+
+        ptext = '<font size=14><b>Detrended Maps</b></font>'
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.25 * inch))
+
+        self._add_section('Detrended SFNR', self._figures['SFNRMontage'])
+        self._add_section('Drift (% per volume)', self._figures['DriftMontage'])
+        self._add_section('Warm-up Amplitude (%)', self._figures['WarmupMontage'])
+
+        # Voxelwise spectral peak maps
+        self._contents.append(PageBreak())
+
+        ptext = '<font size=14><b>Spectral Peak Maps</b></font>'
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.25 * inch))
+
+        ptext = """
+        <font size=11>
+        Frequency and fractional power of the strongest spectral peak in each voxel timeseries after linear
+        detrending. Periodic instabilities confined to a slab or coil region appear as localized peak power.
+        </font>
+        """
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.1 * inch))
+
+        self._add_section('Peak Frequency (Hz)', self._figures['PeakFreqMontage'])
+        self._add_section('Peak Power Fraction', self._figures['PeakPowerMontage'])
 
-    def _add_section(self, title, img_fname):
+        if 'BandPowerMontage' in self._figures:
+            f_lo, f_hi = self._bands[0]
+            self._add_section('Band Power Fraction ({:.3f} - {:.3f} Hz)'.format(f_lo, f_hi),
+                              self._figures['BandPowerMontage'])
+
+    def _add_section(self, title, fig):
 
         ptext = '<font size=11><b>{}</b></font>'.format(title)
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        tmean_montage_img = Image(img_fname, 7.0 * inch, 2.4 * inch, hAlign='LEFT')
+        tmean_montage_img = figure_flowable(fig, 7.0 * inch, 2.4 * inch)
 
         self._contents.append(tmean_montage_img)
         self._contents.append(Spacer(1, 0.25 * inch))
@@ -312,9 +401,36 @@ class ReportPDF:
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.1 * inch))
 
-        residuals_img = Image(self._fnames['ROIDemeanedTS'], 7.0 * inch, 9.0 * inch, hAlign='LEFT')
+        residuals_img = figure_flowable(self._figures['ROIDemeanedTS'], 7.0 * inch, 9.0 * inch)
         self._contents.append(residuals_img)
 
+    def _add_slice_spikes(self):
+
+        if 'SliceSpikes' not in self._figures:
+            return
+
+        # Page break
+        self._contents.append(PageBreak())
+
+        ptext = '<font size=14><b>Slice Spikes and Zipper Artifacts</b></font>'
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.25 * inch))
+
+        ptext = """
+        <font size=11>
+        Robust z-scores of the air space signal in each slice and volume (top). Spikes confined to a single
+        slice are averaged out of the air ROI timeseries but appear here as isolated outliers (circled).
+        Zipper scores (bottom) measure how far each row and column of the air space stands out from
+        its neighbours, as the median over all volumes. Persistent zipper lines have high scores.
+        Localized spikes and zipper lines are listed in the slice spike JSON file saved with this report.
+        </font>
+        """
+        self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
+        self._contents.append(Spacer(1, 0.1 * inch))
+
+        spikes_img = figure_flowable(self._figures['SliceSpikes'], 7.0 * inch, 7.0 * inch)
+        self._contents.append(spikes_img)
+
     def _save_report(self):
 
         # Copy report PDF to derivatives
@@ -325,3 +441,37 @@ class ReportPDF:
             json.dump(self._metrics, fd, sort_keys=True, indent=4)
 
 
+def vector_figures_available():
+    """
+    :return: bool, True if SVG figures can be embedded as vector drawings (svglib installed)
+    """
+
+    return svg2rlg is not None
+
+
+def figure_flowable(fig, width, height):
+    """
+    Left-aligned report flowable for a rendered figure
+    PNG data are embedded as rasters and SVG data as vector drawings, without temporary files
+
+    :param fig: bytes or str, rendered PNG or SVG figure, or image filename
+    :param width: float, width on page (points)
+    :param height: float, height on page (points)
+    :return: flowable, reportlab Image or Drawing
+    """
+
+    if isinstance(fig, str):
+        return Image(fig, width, height, hAlign='LEFT')
+
+    if fig[:5] == b'<?xml' or fig[:4] == b'<svg':
+
+        drawing = svg2rlg(io.BytesIO(fig))
+
+        # Scale drawing to the requested size
+        drawing.scale(width / drawing.width, height / drawing.height)
+        drawing.width, drawing.height = width, height
+        drawing.hAlign = 'LEFT'
+
+        return drawing
+
+    return Image(io.BytesIO(fig), width, height, hAlign='LEFT')
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+In-process rigid-body (6-DOF) motion correction for live mode
+Multi-resolution inverse compositional Gauss-Newton registration of each volume to a reference
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+from scipy.ndimage import gaussian_filter, map_coordinates, spline_filter
+from scipy.spatial.transform import Rotation
+
+from .resample import default_threads
+
+
+def moco_rigid(img_nii, reference='mean', levels=(4, 2, 1), n_iter=(10, 6, 3), order=1, reg_order=3, n_threads=0,
+               inplace=False):
+    """
+    Native rigid-body motion correction (MCFLIRT replacement)
+
+    :param img_nii: Nifti object, 4D series
+    :param reference: str, registration target, 'mean' (temporal mean) or 'first' (first volume)
+    :param levels: tuple, voxel subsampling factor of each resolution level (coarse to fine)
+    :param n_iter: tuple, maximum Gauss-Newton iterations at each level
+    :param order: int, spline order of the final resampling (1 = trilinear as MCFLIRT)
+    :param reg_order: int, spline order of the moving volume interpolation in the registration cost
+    :param n_threads: int, volumes registered in parallel (0 = OMP_NUM_THREADS if set, otherwise all CPUs)
+    :param inplace: bool, correct the series array in place rather than a copy
+    :return moco_nii: Nifti object, motion corrected 4D series
+    :return moco_pars: array, motion parameters (nt x 6), MCFLIRT convention
+        [rx, ry, rz, dx, dy, dz], rotations in radians (R = Rx Ry Rz) about the volume center,
+        translations in mm
+    """
+
+    img = np.asanyarray(img_nii.dataobj)
+    nt = img.shape[3]
+    vox_mm = np.array(img_nii.header.get('pixdim')[1:4], dtype=float)
+
+    if 'first' in reference:
+        ref = img[..., 0].astype(np.float64)
+    else:
+        ref = np.mean(img, axis=3, dtype=np.float64)
+
+    reg = RigidRegistration(ref, vox_mm, levels=levels, n_iter=n_iter, order=reg_order)
+
+    moco_img = img if inplace else np.empty_like(img)
+    moco_pars = np.zeros([nt, 6])
+
+    def _correct(tc):
+        mov = img[..., tc]
+        A = reg.register(mov)
+        moco_img[..., tc] = reg.resample(mov, A, order=order)
+        moco_pars[tc] = rigid_params(A)
+
+    n_threads = n_threads or default_threads()
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(pool.map(_correct, range(nt)))
+    else:
+        for tc in range(nt):
+            _correct(tc)
+
+    moco_nii = nb.Nifti1Image(moco_img, img_nii.affine)
+
+    return moco_nii, moco_pars
+
+
+class RigidRegistration:
+
+    def __init__(self, ref, vox_mm, levels=(4, 2, 1), n_iter=(10, 6, 3), order=3, tol=1e-4):
+        """
+        Rigid registration of volumes to a fixed reference (inverse compositional Gauss-Newton)
+        Reference gradients, Jacobians and Gauss-Newton Hessians are precomputed once per level
+        and shared by every volume, so each iteration costs one trilinear warp of the moving volume
+
+        Transforms are 4x4 matrices mapping reference mm coordinates (origin at the volume center)
+        to moving volume mm coordinates
+
+        :param ref: array, 3D reference volume
+        :param vox_mm: array, voxel dimensions (mm)
+        :param levels: tuple, voxel subsampling factor of each level (coarse to fine)
+        :param n_iter: tuple, maximum iterations at each level
+        :param order: int, spline order of the moving volume interpolation in the registration cost
+            Trilinear interpolation error is correlated with the reference gradients used by the
+            inverse compositional update and biases the solution (about 0.15 degree on smooth phantoms),
+            cubic interpolation removes the bias. The moving volume is prefiltered once per level
+        :param tol: float, convergence threshold on the parameter update (radians and mm)
+        """
+
+        self._shape = ref.shape
+        self._vox_mm = np.asarray(vox_mm, dtype=float)
+        self._center = (np.array(ref.shape) - 1) / 2.0
+        self._n_iter = n_iter
+        self._order = order
+        self._tol = tol
+
+        self._levels = [self._prepare_level(ref, f) for f in levels]
+
+    def register(self, mov, A=None):
+        """
+        :param mov: array, 3D moving volume
+        :param A: array, initial 4x4 transform (identity if None)
+        :return A: array, 4x4 transform from reference to moving mm coordinates
+        """
+
+        A = np.eye(4) if A is None else A.copy()
+
+        for level, n_iter in zip(self._levels, self._n_iter):
+
+            mov_s = gaussian_filter(mov.astype(np.float64), level['sigma']) if level['sigma'] > 0 else mov
+
+            # Spline coefficients computed once per level rather than on every warp
+            if self._order > 1:
+                mov_s = spline_filter(mov_s, order=self._order, output=np.float64, mode='nearest')
+
+            for _ in range(n_iter):
+
+                # Residual between warped moving volume and reference
+                err = self._warp(mov_s, A, level['x_mm'], order=self._order, prefilter=False) - level['ref']
+
+                dp = level['H_inv'] @ (level['J'].T @ err)
+
+                # Inverse compositional update : W(p) <- W(p) o W(dp)^-1
+                A = A @ np.linalg.inv(_rigid_matrix(dp))
+
+                if np.max(np.abs(dp)) < self._tol:
+                    break
+
+        return A
+
+    def resample(self, mov, A, order=1):
+        """
+        Resample a moving volume onto the reference grid
+
+        :param mov: array, 3D moving volume
+        :param A: array, 4x4 transform from register
+        :param order: int, spline order
+        :return: array, resampled volume
+        """
+
+        grid = np.indices(self._shape).reshape(3, -1).T
+        x_mm = (grid - self._center) * self._vox_mm
+
+        out = self._warp(mov, A, x_mm, order=order)
+
+        return out.reshape(self._shape).astype(mov.dtype)
+
+    def _prepare_level(self, ref, f):
+
+        # Smooth in proportion to subsampling, then sample the reference on the coarse grid
+        sigma = f / 2.0 if f > 1 else 0.0
+        ref_s = gaussian_filter(ref, sigma) if sigma > 0 else ref
+
+        sl = tuple(slice(0, n, f) for n in ref.shape)
+        grid = np.stack(np.meshgrid(*[np.arange(n)[s] for n, s in zip(ref.shape, sl)], indexing='ij'),
+                        axis=-1).reshape(-1, 3)
+        x_mm = (grid - self._center) * self._vox_mm
+
+        # Reference intensity gradient (per mm) at the level sample points
+        grad = np.stack([g[sl].ravel() / d for g, d in zip(np.gradient(ref_s), self._vox_mm)], axis=1)
+
+        # Jacobian of the reference warped by a small rigid transform (small-angle rotation about center)
+        # d/d(omega) of (omega x x) = -[x]x
+        J = np.empty([x_mm.shape[0], 6])
+        J[:, 0:3] = np.cross(x_mm, grad)
+        J[:, 3:6] = grad
+
+        H = J.T @ J
+        H_inv = np.linalg.inv(H + 1e-9 * np.trace(H) * np.eye(6))
+
+        return dict(sigma=sigma, x_mm=x_mm, ref=ref_s[sl].ravel(), J=J, H_inv=H_inv)
+
+    def _warp(self, mov, A, x_mm, order=1, prefilter=True):
+
+        # Reference mm coordinates -> moving mm coordinates -> moving voxel coordinates
+        y_mm = x_mm @ A[:3, :3].T + A[:3, 3]
+        y_vox = y_mm / self._vox_mm + self._center
+
+        return map_coordinates(mov, y_vox.T, order=order, mode='nearest', prefilter=prefilter)
+
+
+def rigid_params(A):
+    """
+    MCFLIRT-style parameters from a rigid transform matrix
+
+    :param A: array, 4x4 rigid transform
+    :return: array, [rx, ry, rz, dx, dy, dz] with R = Rx Ry Rz (radians) and translation in mm
+    """
+
+    rx, ry, rz = Rotation.from_matrix(A[:3, :3]).as_euler('XYZ')
+
+    return np.array([rx, ry, rz, A[0, 3], A[1, 3], A[2, 3]])
+
+
+def _rigid_matrix(p):
+
+    # p = [rotation vector (radians), translation (mm)]
+    A = np.eye(4)
+    A[:3, :3] = Rotation.from_rotvec(p[:3]).as_matrix()
+    A[:3, 3] = p[3:6]
+
+    return A
+
@@ -31,19 +31,21 @@ SOFTWARE.
 
 import os
 import sys
+import hashlib
+import tempfile
 import subprocess
 import pkg_resources
 import nibabel as nb
 import numpy as np
-from scipy.ndimage.morphology import (binary_dilation,
-                                      binary_erosion,
-                                      generate_binary_structure)
+from scipy.ndimage import label, binary_fill_holes, distance_transform_edt
 
 
-def register_template(tmean_nii, work_dir, mode='phantom'):
+def register_template(tmean_nii, work_dir, mode='phantom', localizer='sphere', xfm_dir='',
+                      reuse_ncc=0.995, init_ncc=0.95):
     """
     Register the appropriate template to the provided tmean image
-    - for phantom QC, a translation-only registration is performed
+    - for phantom QC, the phantom sphere is fitted directly (localizer='sphere')
+      or a translation-only registration is performed (localizer='flirt' or failed sphere fit)
     - for in vivo QC, an affine registration is performed
 
     :param tmean_nii: Nifti object,
@@ -52,34 +54,31 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
         Full path to working directory
     :param mode: str,
         QC mode, 'phantom' or 'live'
-    :return:
+    :param localizer: str,
+        Phantom localizer, 'sphere' (in-process sphere fit) or 'flirt' (template registration)
+    :param xfm_dir: str,
+        Transform cache directory for this scanner and protocol (see xfm_cache_key), '' to disable
+    :param reuse_ncc: float,
+        Temporal mean NCC with the cached session above which the cached transform is reused as is
+    :param init_ncc: float,
+        NCC above which the cached transform initializes a local FLIRT search (-nosearch)
+    :return labels_nii: Nifti object,
+        Template labels in subject space
     """
 
+    if 'phantom' in mode and 'sphere' in localizer:
+
+        try:
+            return sphere_labels(tmean_nii)
+        except ValueError as err:
+            print('      * Phantom sphere fit failed ({}) - using FLIRT registration'.format(err))
+
     # Save temporal mean image for use by FLIRT
     tmean_fname = os.path.join(work_dir, 'fixed.nii.gz')
     nb.save(tmean_nii, tmean_fname)
 
     # Link appropriate template for mode
-    if 'phantom' in mode:
-        dof = 6
-        template_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'fbirn_sphere.nii.gz')
-        )
-        labels_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'fbirn_labels.nii.gz')
-        )
-    else:
-        dof = 12
-        template_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'MNI152_T1_2mm.nii.gz')
-        )
-        labels_fname = pkg_resources.resource_filename(
-            __name__,
-            os.path.join('templates', 'MNI-maxprob-thr25-2mm.nii.gz')
-        )
+    dof, template_fname, labels_fname = mode_templates(mode)
 
     template_xfm_fname = os.path.join(work_dir, 'template_xfm.nii.gz')
     labels_xfm_fname = os.path.join(work_dir, 'labels_xfm.nii.gz')
@@ -88,16 +87,45 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
     flirt_cmd = os.path.join(fsl_dir, 'bin', 'flirt')
     xfm_fname = os.path.join(work_dir, 'xfm.mat')
 
-    # Run FLIRT registration
-    print('      Registering template to subject ({} DOF)'.format(dof))
-    cmd = [flirt_cmd,
-           '-in', template_fname,
-           '-ref', tmean_fname,
-           '-out', template_xfm_fname,
-           '-dof', str(dof),
-           '-omat', xfm_fname,
-    ]
-    subprocess.run(cmd, stderr=sys.stderr, stdout=sys.stdout)
+    # Reuse or refine a transform cached for this scanner and protocol if the geometry matches
+    search = 'full'
+    cached = load_cached_xfm(xfm_dir, tmean_nii) if xfm_dir else None
+
+    if cached is not None:
+
+        cached_xfm, ncc = cached
+
+        if ncc >= reuse_ncc:
+            search = 'reuse'
+        elif ncc >= init_ncc:
+            search = 'init'
+
+        print('      Cached template transform NCC {:.4f} : {}'.format(
+            ncc, dict(reuse='reusing transform', init='refining transform', full='full search')[search]))
+
+        if search != 'full':
+            np.savetxt(xfm_fname, cached_xfm, fmt='%.10f')
+
+    if search != 'reuse':
+
+        # Run FLIRT registration
+        print('      Registering template to subject ({} DOF)'.format(dof))
+        cmd = [flirt_cmd,
+               '-in', template_fname,
+               '-ref', tmean_fname,
+               '-out', template_xfm_fname,
+               '-dof', str(dof),
+               '-omat', xfm_fname,
+        ]
+
+        # Start from the cached transform with a local optimization only
+        if search == 'init':
+            cmd += ['-init', xfm_fname, '-nosearch']
+
+        subprocess.run(cmd, stderr=sys.stderr, stdout=sys.stdout)
+
+        if xfm_dir:
+            save_cached_xfm(xfm_dir, np.loadtxt(xfm_fname), tmean_nii)
 
     # Apply resulting transform to label image
     print('      Resampling labels to subject space')
@@ -118,29 +146,243 @@ def register_template(tmean_nii, work_dir, mode='phantom'):
     return labels_nii
 
 
-def make_rois(labels_nii):
+def mode_templates(mode):
+    """
+    Registration degrees of freedom, template and template labels for a QC mode
+
+    :param mode: str, QC mode, 'phantom' or 'live'
+    :return dof: int, FLIRT degrees of freedom
+    :return template_fname: str, template image filename
+    :return labels_fname: str, template label image filename
+    """
+
+    if 'phantom' in mode:
+        dof = 6
+        template_fname = pkg_resources.resource_filename(
+            __name__,
+            os.path.join('templates', 'fbirn_sphere.nii.gz')
+        )
+        labels_fname = pkg_resources.resource_filename(
+            __name__,
+            os.path.join('templates', 'fbirn_labels.nii.gz')
+        )
+    else:
+        dof = 12
+        template_fname = pkg_resources.resource_filename(
+            __name__,
+            os.path.join('templates', 'MNI152_T1_2mm.nii.gz')
+        )
+        labels_fname = pkg_resources.resource_filename(
+            __name__,
+            os.path.join('templates', 'MNI-maxprob-thr25-2mm.nii.gz')
+        )
+
+    return dof, template_fname, labels_fname
+
+
+def xfm_cache_key(serial_number, tmean_nii, mode='phantom'):
+    """
+    Transform cache key from scanner serial number, matrix size, voxel size, QC mode and template
+    Phantom and live sessions with the same geometry register different templates, so they
+    never share a cached transform. Template contents are hashed so an updated template starts afresh
+
+    :param serial_number: str, DeviceSerialNumber
+    :param tmean_nii: Nifti object, temporal mean image
+    :param mode: str, QC mode, 'phantom' or 'live'
+    :return: str, cache subdirectory name
+    """
+
+    matrix = 'x'.join(str(n) for n in tmean_nii.shape[:3])
+    vox = 'x'.join('{:.3f}'.format(v) for v in tmean_nii.header.get('pixdim')[1:4])
+
+    _, template_fname, labels_fname = mode_templates(mode)
+
+    h = hashlib.sha1()
+    for fname in (template_fname, labels_fname):
+        with open(fname, 'rb') as fd:
+            h.update(fd.read())
+
+    template = os.path.basename(template_fname).split('.')[0]
+
+    return '{}_{}_{}_{}_{}_{}'.format(serial_number, matrix, vox,
+                                      'phantom' if 'phantom' in mode else 'live', template, h.hexdigest()[:12])
+
+
+def load_cached_xfm(xfm_dir, tmean_nii):
+    """
+    Cached template transform and the normalized cross correlation of the temporal mean
+    with the temporal mean of the session that produced it
+
+    :param xfm_dir: str, transform cache directory
+    :param tmean_nii: Nifti object, temporal mean image of this session
+    :return: (xfm, ncc) tuple, or None if nothing is cached for this geometry
+    """
+
+    entry_fname = os.path.join(xfm_dir, 'xfm.npz')
+
+    if not os.path.isfile(entry_fname):
+        return None
+
+    with np.load(entry_fname) as entry:
+        xfm, ref = entry['xfm'], entry['tmean']
+
+    tmean = np.asanyarray(tmean_nii.dataobj)
+
+    if ref.shape != tmean.shape:
+        return None
+
+    return xfm, normalized_correlation(tmean, ref)
+
+
+def save_cached_xfm(xfm_dir, xfm, tmean_nii):
+    """
+    Store a template transform with the temporal mean it was estimated for
+    The entry is a single file written under a temporary name and renamed into place, so readers
+    never see a partial entry and concurrent writers for the same scanner simply replace each other
+    """
+
+    os.makedirs(xfm_dir, exist_ok=True)
+
+    fd, tmp_fname = tempfile.mkstemp(dir=xfm_dir, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as fobj:
+            np.savez(fobj, xfm=xfm, tmean=np.asanyarray(tmean_nii.dataobj).astype(np.float32))
+        os.replace(tmp_fname, os.path.join(xfm_dir, 'xfm.npz'))
+    except OSError:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
+def normalized_correlation(a, b, step=2):
+    """
+    Normalized cross correlation of two images on a subsampled grid
+
+    :param a, b: array, images with identical shape
+    :param step: int, voxel subsampling along each axis
+    :return: float, NCC in [-1, 1]
+    """
+
+    sl = tuple(slice(None, None, step) for _ in range(a.ndim))
+
+    a = a[sl].astype(np.float64).ravel()
+    b = b[sl].astype(np.float64).ravel()
+
+    a = a - a.mean()
+    b = b - b.mean()
+
+    denom = np.sqrt(np.dot(a, a) * np.dot(b, b))
+
+    return float(np.dot(a, b) / denom) if denom > 0 else 0.0
+
+
+def fit_sphere(tmean_nii, thresh=0.5):
+    """
+    Fit the phantom sphere center and radius from the temporal mean image
+    The phantom is segmented at a fraction of the robust maximum intensity. Each slice cuts the
+    sphere in a disc of area A(z) = pi * (R^2 - (z - zc)^2), so A(z)/pi + z^2 is linear in z and a
+    least squares line gives zc and R, even when the slab does not cover the whole sphere.
+    The in-plane center is the centroid of the segmented phantom.
+
+    :param tmean_nii: Nifti object, temporal mean image
+    :param thresh: float, segmentation threshold as a fraction of the 99th percentile intensity
+    :return center_vox: array, sphere center in voxel coordinates
+    :return radius_mm: float, sphere radius in mm
+    """
+
+    tmean = np.asanyarray(tmean_nii.dataobj)
+    vox_mm = np.array(tmean_nii.header.get('pixdim')[1:4], dtype=float)
+
+    mask = tmean > thresh * np.percentile(tmean, 99)
+
+    # Largest connected component with holes filled (signal voids, bubbles)
+    cc, n_cc = label(mask)
+    if n_cc < 1:
+        raise ValueError('no phantom signal')
+    mask = binary_fill_holes(cc == np.argmax(np.bincount(cc.ravel())[1:]) + 1)
+
+    # Disc area (mm^2) and slice position (mm) for slices cutting the sphere
+    area = np.sum(mask, axis=(0, 1)) * vox_mm[0] * vox_mm[1]
+    z_mm = np.arange(mask.shape[2]) * vox_mm[2]
+
+    # Ignore grazing slices where partial volume dominates (disc radius under two voxels)
+    ok = area > np.pi * (2 * max(vox_mm[0], vox_mm[1])) ** 2
+    if np.sum(ok) < 3:
+        raise ValueError('phantom spans fewer than three slices')
+
+    # A/pi + z^2 = (R^2 - zc^2) + 2 zc z
+    c1, c0 = np.polyfit(z_mm[ok], area[ok] / np.pi + z_mm[ok] ** 2, 1)
+    zc = c1 / 2.0
+    r2 = c0 + zc ** 2
+
+    if r2 <= 0:
+        raise ValueError('degenerate sphere fit')
+
+    xc, yc, _ = np.argwhere(mask).mean(axis=0)
+
+    center_vox = np.array([xc, yc, zc / vox_mm[2]])
+
+    return center_vox, float(np.sqrt(r2))
+
+
+def sphere_labels(tmean_nii, inset_mm=3.0):
+    """
+    Phantom signal label (1) from an analytic sphere fit, in place of registering fbirn_labels
+
+    :param tmean_nii: Nifti object, temporal mean image
+    :param inset_mm: float, label boundary inside the fitted phantom surface (as fbirn_labels)
+    :return labels_nii: Nifti object, phantom labels in subject space
+    """
+
+    center_vox, radius_mm = fit_sphere(tmean_nii)
+
+    vox_mm = np.array(tmean_nii.header.get('pixdim')[1:4], dtype=float)
+    nx, ny, nz = tmean_nii.shape[:3]
+
+    print('      Phantom sphere fit : center ({:.1f}, {:.1f}, {:.1f}) vox, radius {:.1f} mm'.format(
+        *center_vox, radius_mm))
+
+    # Separable squared distances from the center (mm^2)
+    dx2 = ((np.arange(nx) - center_vox[0]) * vox_mm[0]) ** 2
+    dy2 = ((np.arange(ny) - center_vox[1]) * vox_mm[1]) ** 2
+    dz2 = ((np.arange(nz) - center_vox[2]) * vox_mm[2]) ** 2
+
+    r2 = dx2[:, None, None] + dy2[None, :, None] + dz2[None, None, :]
+
+    labels = (r2 < (radius_mm - inset_mm) ** 2).astype(np.uint16)
+
+    return nb.Nifti1Image(labels, tmean_nii.affine)
+
+
+def make_rois(labels_nii, erode_mm=7.0, dilate_mm=14.0):
     """
     Organize labels and add air space and Nyquist ROIs
+    Margins are applied with Euclidean distance transforms sampled at the voxel size,
+    so they are the same in mm for any protocol and cost one pass each
 
     :param labels_nii: Nifti object,
         Raw labels in subject space
+    :param erode_mm: float,
+        Erosion of the signal mask used for the Nyquist ghost ROI (mm)
+    :param dilate_mm: float,
+        Dilation of the eroded signal mask excluded from the air and ghost ROIs (mm)
     :return rois_nii: Nifti object,
         Integer ROI image include air and Nyquist ghost
+    :return roi_set: ROISet,
+        Sparse voxel indices of each ROI label for gathering from (voxels x time) views
     """
 
     # Extract label image
-    labels_img = labels_nii.get_data().astype(np.uint)
+    labels_img = np.asanyarray(labels_nii.dataobj).astype(np.uint)
+    vox_mm = labels_nii.header.get_zooms()[:3]
 
     # Create signal mask from sum of all ROI labels
     signal_mask = labels_img > 0
 
-    # Construct 3D binary sphere structuring element
-    k = generate_binary_structure(3, 2)  # 3D, 2-connected
-
-    # Erode signal mask x N, then dilate x 2N
-    n_iter = 2
-    signal_mask_ero = binary_erosion(signal_mask, structure=k, iterations=n_iter)
-    signal_mask_dil = binary_dilation(signal_mask_ero, structure=k, iterations=n_iter * 2)
+    # Erode signal mask by erode_mm, then dilate the eroded mask by dilate_mm
+    signal_mask_ero = distance_transform_edt(signal_mask, sampling=vox_mm) > erode_mm
+    signal_mask_dil = distance_transform_edt(np.logical_not(signal_mask_ero), sampling=vox_mm) <= dilate_mm
 
     # Create Nyquist mask by rolling eroded signal mask by FOVy/2
     ny = signal_mask.shape[1]
@@ -162,4 +404,120 @@ def make_rois(labels_nii):
     # Wrap image in a Nifti object
     rois_nii = nb.Nifti1Image(rois, labels_nii.affine)
 
-    return rois_nii
+    return rois_nii, ROISet(rois)
+
+
+class ROISet:
+
+    def __init__(self, rois_img):
+        """
+        Sparse ROI labels : flat voxel indices sorted by label with per-label counts
+        Indices are in Fortran voxel order, so ROI voxels are gathered directly from
+        (voxels x time) views of the series without label masks
+
+        ROI label indices (see make_rois)
+        0 : unassigned (dropped)
+        1 : air space
+        2 : Nyquist ghost
+        3, 4, ... : signal labels
+
+        :param rois_img: array, 3D integer ROI label image
+        """
+
+        rois = np.asarray(rois_img).astype(np.int64).ravel(order='F')
+
+        self.shape = np.asarray(rois_img).shape
+        self.n_labels = max(int(rois.max()), 0) if rois.size > 0 else 0
+
+        order = np.argsort(rois, kind='stable')
+        counts = np.bincount(rois, minlength=self.n_labels + 1)
+
+        # Flat voxel indices of labels 1 .. n_labels, label by label
+        self.inds = order[counts[0]:]
+        self.counts = counts[1:]
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+
+        # Rows (label - 1) of non-empty labels
+        self.present = np.flatnonzero(self.counts > 0)
+
+    @classmethod
+    def from_nii(cls, rois_nii):
+        return cls(np.asanyarray(rois_nii.dataobj))
+
+    @property
+    def n_voxels(self):
+        return self.inds.size
+
+    def indices(self, lc):
+        """
+        :param lc: int, ROI label (1 .. n_labels)
+        :return: array, flat voxel indices of label lc
+        """
+
+        if lc < 1 or lc > self.n_labels:
+            return self.inds[:0]
+
+        s0 = self.starts[lc - 1]
+
+        return self.inds[s0:s0 + self.counts[lc - 1]]
+
+    def indices_from(self, lc):
+        """
+        Flat voxel indices of all labels >= lc (contiguous in the sorted index list)
+
+        :param lc: int, first ROI label
+        :return: array, flat voxel indices
+        """
+
+        if lc > self.n_labels:
+            return self.inds[:0]
+
+        return self.inds[self.starts[max(lc, 1) - 1]:]
+
+    def gather(self, x_vt, lc=None):
+        """
+        Rows of a (voxels x time) array for one label or all labelled voxels
+
+        :param x_vt: array, (voxels x time) view in Fortran voxel order, or flat 3D image
+        :param lc: int, ROI label, or None for all labels (ordered as self.inds)
+        :return: array, gathered rows
+        """
+
+        return x_vt[self.inds if lc is None else self.indices(lc)]
+
+    def means(self, x):
+        """
+        Per-label means of rows already gathered with gather(x_vt)
+
+        :param x: array, (ROI voxels x k) or (ROI voxels,) gathered rows
+        :return: array, (n_labels x k) or (n_labels,) means, NaN for empty labels
+        """
+
+        means = np.full((self.n_labels,) + x.shape[1:], np.nan)
+
+        if self.present.size > 0:
+            sums = np.add.reduceat(x, self.starts[self.present], axis=0, dtype=np.float64)
+            means[self.present] = sums / self.counts[self.present].reshape((-1,) + (1,) * (x.ndim - 1))
+
+        return means
+
+    def split(self, x):
+        """
+        Iterate over per-label blocks of rows already gathered with gather(x_vt)
+
+        :param x: array, gathered rows
+        :return: generator of (row, block) for non-empty labels, where row = label - 1
+        """
+
+        for row in self.present:
+            s0 = self.starts[row]
+            yield row, x[s0:s0 + self.counts[row]]
+
+
+def as_roiset(rois):
+    """
+    :param rois: ROISet or Nifti object, integer ROI labels
+    :return: ROISet
+    """
+
+    return rois if isinstance(rois, ROISet) else ROISet.from_nii(rois)
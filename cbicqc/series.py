@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Session-scoped access to the 4D QC series
+The series is decoded once into a single array and every stage reads views of that array
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import numpy as np
+import nibabel as nb
+from nibabel.arrayproxy import is_proxy
+from nibabel.openers import ImageOpener
+
+
+class QCSeries:
+
+    def __init__(self, img_nii, dtype=np.float32):
+        """
+        4D QC series decoded on first use into one Fortran-ordered array
+        Fortran order keeps each volume contiguous and makes the (voxels x time) reshape a view
+
+        :param img_nii: Nifti object, 4D series (typically file-backed)
+        :param dtype: numpy dtype, decoded data type
+        """
+
+        self._src_nii = img_nii
+        self._dtype = np.dtype(dtype)
+        self._data = None
+        self._nii = None
+
+    @property
+    def shape(self):
+        return self._src_nii.shape
+
+    @property
+    def affine(self):
+        return self._src_nii.affine
+
+    @property
+    def vox_mm(self):
+        return self._src_nii.header.get('pixdim')[1:4]
+
+    @property
+    def data(self):
+        """
+        Decoded 4D array (nx x ny x nz x nt), decoded once and shared by all stages
+        """
+
+        if self._data is None:
+            # get_fdata scales in the requested dtype and is not cached on the source image
+            data = self._src_nii.get_fdata(dtype=self._dtype, caching='unchanged')
+            self._data = np.asfortranarray(data)
+
+        return self._data
+
+    @property
+    def lazy_nii(self):
+        """
+        Decoded in-memory image if the series has been decoded, otherwise the file-backed source
+        Used by streaming stages that should not force a full decode
+        """
+
+        return self.nii if self._data is not None else self._src_nii
+
+    @property
+    def nii(self):
+        """
+        In-memory Nifti image wrapping the shared array
+        np.asanyarray(nii.dataobj) returns the shared array itself, not a copy
+        """
+
+        if self._nii is None:
+            self._nii = nb.Nifti1Image(self.data, self.affine, self._src_nii.header)
+            self._nii.set_data_dtype(self._dtype)
+
+        return self._nii
+
+    def voxels_by_time(self):
+        """
+        :return: array, (voxels x time) view of the shared array (Fortran voxel order)
+        """
+
+        return self.data.reshape((-1, self.shape[3]), order='F')
+
+    def set_nii(self, img_nii):
+        """
+        Replace the shared series, for example with its motion corrected version
+        The previous array is released once no other references remain
+
+        :param img_nii: Nifti object, replacement 4D series with identical geometry
+        """
+
+        self._src_nii = img_nii
+        self._data = np.asfortranarray(img_nii.get_fdata(dtype=self._dtype, caching='unchanged'))
+        self._nii = None
+
+
+def iter_volume_chunks(img_nii, chunk_mb=256, dtype=np.float32):
+    """
+    Iterate over blocks of whole volumes from a 4D Nifti image
+    In-memory images yield views of their array. File-backed images are read sequentially,
+    so each volume is decoded exactly once, even from gzipped files without random access
+
+    :param img_nii: Nifti object, 4D series
+    :param chunk_mb: float, approximate float64 working memory per chunk (MB)
+    :param dtype: numpy dtype, chunk data type for file-backed images
+    :return: generator of (t0, chunk) where chunk is (nx x ny x nz x n_vols)
+    """
+
+    nx, ny, nz, nt = img_nii.shape[:4]
+    n_vox = nx * ny * nz
+
+    # Volumes per chunk from float64 working memory budget
+    n_vols = int(max(1, chunk_mb * 2 ** 20 // (n_vox * 8)))
+
+    dataobj = img_nii.dataobj
+
+    if not is_proxy(dataobj):
+
+        data = np.asanyarray(dataobj)
+        for t0 in range(0, nt, n_vols):
+            yield t0, data[..., t0:t0 + n_vols]
+
+        return
+
+    # Nifti voxel data are stored x-fastest, so volumes are contiguous on disk
+    raw_dtype = np.dtype(dataobj.dtype)
+    slope, inter = dataobj.slope, dataobj.inter
+
+    with ImageOpener(dataobj.file_like) as fobj:
+
+        fobj.seek(dataobj.offset)
+
+        for t0 in range(0, nt, n_vols):
+
+            k = min(n_vols, nt - t0)
+
+            raw = np.frombuffer(fobj.read(n_vox * k * raw_dtype.itemsize), dtype=raw_dtype)
+            chunk = raw.reshape((nx, ny, nz, k), order='F').astype(dtype)
+
+            if slope != 1.0 or inter != 0.0:
+                chunk *= slope
+                chunk += inter
+
+            yield t0, chunk
+
+
+def spool_series(img_nii, spool_fname, chunk_mb=256, dtype=np.float32):
+    """
+    Decode a 4D series once into an uncompressed scratch array on disk
+    Stages that read the series in spatial slabs (each slab spans every volume) would otherwise
+    decompress a gzipped file once per slab. The spooled array supports cheap slab reads with
+    memory bounded by chunk_mb
+
+    :param img_nii: Nifti object, 4D series (typically file-backed)
+    :param spool_fname: str, scratch filename (deleted by the caller)
+    :param chunk_mb: float, approximate working memory per chunk of volumes (MB)
+    :param dtype: numpy dtype, spooled data type
+    :return data: memmap, (nx x ny x nz x nt) Fortran ordered
+    """
+
+    data = np.memmap(spool_fname, dtype=dtype, mode='w+', shape=img_nii.shape[:4], order='F')
+
+    for t0, chunk in iter_volume_chunks(img_nii, chunk_mb, dtype=dtype):
+        data[..., t0:t0 + chunk.shape[3]] = chunk
+
+    data.flush()
+
+    return data
+
+
+def spool_voxels(img_nii, inds, spool_fname, chunk_mb=256, dtype=np.float32):
+    """
+    Transpose selected voxel timeseries into an uncompressed (voxels x time) scratch array on disk
+    The series is read once in chunks of whole volumes, after which blocks of voxel timeseries
+    are contiguous reads with memory bounded by the block size
+
+    :param img_nii: Nifti object, 4D series (typically file-backed)
+    :param inds: array, flat voxel indices (Fortran order)
+    :param spool_fname: str, scratch filename (deleted by the caller)
+    :param chunk_mb: float, approximate working memory per chunk of volumes (MB)
+    :param dtype: numpy dtype, spooled data type
+    :return data: memmap, (voxels x nt) C ordered
+    """
+
+    nt = img_nii.shape[3]
+
+    data = np.memmap(spool_fname, dtype=dtype, mode='w+', shape=(inds.size, nt))
+
+    for t0, chunk in iter_volume_chunks(img_nii, chunk_mb, dtype=dtype):
+        data[:, t0:t0 + chunk.shape[3]] = chunk.reshape((-1, chunk.shape[3]), order='F')[inds]
+
+    data.flush()
+
+    return data
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Power spectra of ROI and motion timeseries with spectral peak detection, and voxelwise spectral peak maps
+Spectra are computed once per session, stored alongside the report and only rendered by the plots
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import tempfile
+import numpy as np
+import nibabel as nb
+from nibabel.arrayproxy import is_proxy
+from scipy.fft import rfft, rfftfreq
+from scipy.signal import periodogram, welch, find_peaks, detrend
+from scipy.signal.windows import dpss
+
+from .moco import total_rotation
+from .series import spool_series
+
+
+def power_spectra(x, fs, method='periodogram', nperseg=64, nw=3.0):
+    """
+    Power spectra of a batch of timeseries (one FFT call for all rows)
+
+    :param x: array, timeseries (n_series x nt)
+    :param fs: float, sampling frequency (Hz)
+    :param method: str, 'periodogram', 'welch' or 'multitaper'
+    :param nperseg: int, Welch segment length (volumes)
+    :param nw: float, multitaper time-halfbandwidth product (2 * nw - 1 tapers)
+    :return f: array, frequencies (Hz)
+    :return pspec: array, one-sided power spectral densities (n_series x nf, units^2 / Hz)
+    """
+
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    nt = x.shape[1]
+
+    if 'welch' in method:
+        return welch(x, fs, nperseg=min(nperseg, nt), scaling='density', axis=-1)
+
+    if 'multitaper' in method:
+
+        # DPSS (Slepian) tapers, unit energy : (n_tapers x nt)
+        n_tapers = max(1, int(2 * nw) - 1)
+        tapers = dpss(nt, nw, n_tapers)
+
+        # Demean, taper and transform all series and tapers at once : (n_series x n_tapers x nf)
+        x = x - np.mean(x, axis=1, keepdims=True)
+        xk = rfft(x[:, np.newaxis, :] * tapers[np.newaxis, :, :], axis=-1)
+
+        # Average eigenspectra of the unit energy tapers, then fold to a one-sided density
+        pspec = np.mean(np.abs(xk) ** 2, axis=1) / fs
+        pspec[:, 1:(nt + 1) // 2] *= 2
+
+        return rfftfreq(nt, 1.0 / fs), pspec
+
+    return periodogram(x, fs, scaling='density', axis=-1)
+
+
+def spectral_peaks(f, pspec, n_peaks=3, prominence_db=6.0):
+    """
+    Dominant spectral peaks of each spectrum (eg cold head or gradient vibration lines)
+
+    :param f: array, frequencies (Hz)
+    :param pspec: array, power spectra (n_series x nf)
+    :param n_peaks: int, maximum peaks reported per spectrum
+    :param prominence_db: float, minimum peak prominence (dB)
+    :return peak_hz: array, peak frequencies ordered by decreasing power (n_series x n_peaks), NaN padded
+    :return peak_db: array, peak power relative to spectrum maximum (dB), NaN padded
+    """
+
+    n_series = pspec.shape[0]
+
+    peak_hz = np.full([n_series, n_peaks], np.nan)
+    peak_db = np.full([n_series, n_peaks], np.nan)
+
+    # Power dB relative to row max, ignoring the DC term
+    p_db = relative_db(pspec[:, 1:])
+
+    for sc in range(n_series):
+
+        pks, _ = find_peaks(p_db[sc], prominence=prominence_db)
+
+        # Strongest peaks first
+        pks = pks[np.argsort(p_db[sc, pks])[::-1][:n_peaks]]
+
+        peak_hz[sc, :pks.size] = f[1:][pks]
+        peak_db[sc, :pks.size] = p_db[sc, pks]
+
+    return peak_hz, peak_db
+
+
+def session_spectra(t, s_detrend_t, mopars, method='periodogram', n_peaks=3):
+    """
+    ROI and total motion spectra with their dominant peaks
+
+    :param t: array, time vector (s)
+    :param s_detrend_t: array, detrended ROI timeseries (n_rois x nt)
+    :param mopars: array, motion parameters (nt x 6) [rx, ry, rz, dx, dy, dz]
+    :param method: str, spectral estimator (see power_spectra)
+    :param n_peaks: int, peaks reported per spectrum
+    :return spectra: dict, frequencies, spectra and peaks for the ROIs and total motion
+    """
+
+    # Sampling frequency (Hz)
+    fs = 1.0 / (t[1] - t[0])
+
+    # Total displacement and rotation timecourses
+    # total_rotation converts its argument in place, so pass a copy
+    dtot = np.linalg.norm(mopars[:, 3:6], ord=2, axis=1)
+    rtot = total_rotation(np.array(mopars[:, 0:3], dtype=np.float64))
+
+    f, roi_pspec = power_spectra(s_detrend_t, fs, method=method)
+    _, motion_pspec = power_spectra(np.array([dtot, rtot]), fs, method=method)
+
+    roi_peak_hz, roi_peak_db = spectral_peaks(f, roi_pspec, n_peaks=n_peaks)
+    motion_peak_hz, motion_peak_db = spectral_peaks(f, motion_pspec, n_peaks=n_peaks)
+
+    return dict(method=method,
+                f=f,
+                roi_pspec=roi_pspec,
+                roi_peak_hz=roi_peak_hz,
+                roi_peak_db=roi_peak_db,
+                motion_pspec=motion_pspec,
+                motion_peak_hz=motion_peak_hz,
+                motion_peak_db=motion_peak_db)
+
+
+def spectral_peak_maps(img_nii, tr, bands=(), f_min=0.01, chunk_mb=256):
+    """
+    Voxelwise spectral peak maps for localizing periodic instabilities confined to a slab or coil region
+    The series is processed in z-slabs with every voxel timeseries linearly detrended and transformed
+    in one rFFT call per slab, so memory is bounded by chunk_mb rather than the series size
+    File-backed series are first decoded once, volume by volume, to an uncompressed scratch file
+
+    Powers are fractions of each voxel's total power above f_min, so maps are comparable across
+    signal levels. Frequencies below f_min (residual warm-up and drift) are excluded
+
+    :param img_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param tr: float, repetition time (s)
+    :param bands: list, (f_lo, f_hi) frequency bands in Hz (eg around known vibration lines)
+    :param f_min: float, lowest frequency considered (Hz)
+    :param chunk_mb: float, approximate working memory per slab (MB)
+    :return peak_hz_nii: Nifti object, peak frequency map (Hz)
+    :return peak_frac_nii: Nifti object, peak power fraction map
+    :return band_frac_nii: Nifti object, band power fraction maps (one volume per band), None if no bands
+    """
+
+    nx, ny, nz, nt = img_nii.shape[:4]
+
+    f = rfftfreq(nt, tr)
+
+    # Frequencies searched for peaks (DC always excluded)
+    k0 = int(np.searchsorted(f, max(f_min, f[1])))
+    f_search = f[k0:]
+    band_masks = [(f_search >= lo) & (f_search <= hi) for lo, hi in bands]
+
+    peak_hz = np.zeros([nx, ny, nz], dtype=np.float32, order='F')
+    peak_frac = np.zeros([nx, ny, nz], dtype=np.float32, order='F')
+    band_frac = np.zeros([nx, ny, nz, len(bands)], dtype=np.float32, order='F')
+
+    # Slices per slab from the working memory budget (float64 data, complex spectra and FFT workspace)
+    n_slab = int(max(1, chunk_mb * 2 ** 20 // (nx * ny * nt * 8 * 4)))
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+
+        # Every slab spans all volumes, so a file-backed series read in several slabs is decoded
+        # once into an uncompressed scratch array rather than decompressed again for each slab
+        if is_proxy(img_nii.dataobj) and n_slab < nz:
+            data = spool_series(img_nii, os.path.join(spool_dir, 'series.dat'), chunk_mb)
+        else:
+            data = img_nii.dataobj
+
+        for z0 in range(0, nz, n_slab):
+
+            z1 = min(z0 + n_slab, nz)
+            _slab_peaks(data[:, :, z0:z1, :], z0, f_search, k0, band_masks, peak_hz, peak_frac, band_frac)
+
+        del data
+
+    affine = img_nii.affine
+
+    return (nb.Nifti1Image(peak_hz, affine),
+            nb.Nifti1Image(peak_frac, affine),
+            nb.Nifti1Image(band_frac, affine) if len(bands) > 0 else None)
+
+
+def _slab_peaks(slab_data, z0, f_search, k0, band_masks, peak_hz, peak_frac, band_frac):
+    """
+    Spectral peak and band power fractions of one z-slab, written into the output maps
+
+    :param slab_data: array, (nx x ny x n_slab x nt) slab of the series
+    :param z0: int, first slice of the slab
+    :param f_search: array, frequencies searched for peaks (Hz)
+    :param k0: int, first searched frequency bin
+    :param band_masks: list, boolean masks of f_search for each band
+    :param peak_hz, peak_frac, band_frac: array, output maps
+    """
+
+    nx, ny, nzs, nt = slab_data.shape
+    z1 = z0 + nzs
+
+    # Slab voxel timeseries : (voxels x nt)
+    x = np.asarray(slab_data, dtype=np.float64).reshape((-1, nt), order='F')
+
+    x_f = rfft(detrend(x, axis=1, type='linear', overwrite_data=True), axis=1)
+    del x
+
+    # Power above f_min (view) without complex temporaries
+    p = np.abs(x_f)
+    del x_f
+    p *= p
+    p = p[:, k0:]
+
+    total = np.sum(p, axis=1)
+    total_safe = np.where(total > 0, total, 1.0)
+
+    k = np.argmax(p, axis=1)
+    slab = (nx, ny, z1 - z0)
+
+    peak_hz[:, :, z0:z1] = np.where(total > 0, f_search[k], 0.0).reshape(slab, order='F')
+    peak_frac[:, :, z0:z1] = (p[np.arange(p.shape[0]), k] / total_safe).reshape(slab, order='F')
+
+    for bc, bm in enumerate(band_masks):
+        band_frac[:, :, z0:z1, bc] = (np.sum(p[:, bm], axis=1) / total_safe).reshape(slab, order='F')
+
+
+def save_spectra(spectra, spectra_fname):
+    """
+    Compact per-session spectra file (compressed npz, float32 spectra)
+
+    :param spectra: dict, from session_spectra
+    :param spectra_fname: str, output .npz filename
+    """
+
+    arrays = {k: (v.astype(np.float32) if isinstance(v, np.ndarray) else np.array(v))
+              for k, v in spectra.items()}
+
+    np.savez_compressed(spectra_fname, **arrays)
+
+
+def load_spectra(spectra_fname):
+    """
+    :param spectra_fname: str, .npz file from save_spectra
+    :return spectra: dict, as from session_spectra
+    """
+
+    with np.load(spectra_fname) as npz:
+        spectra = {k: npz[k] for k in npz.files}
+
+    spectra['method'] = str(spectra['method'])
+
+    return spectra
+
+
+def relative_db(pspec):
+    """
+    Power in dB relative to the maximum of each spectrum (zero for flat spectra)
+
+    :param pspec: array, power spectra (n_series x nf)
+    :return: array, relative power (dB)
+    """
+
+    p_max = np.max(pspec, axis=-1, keepdims=True)
+    ok = p_max >= 1e-10
+
+    return np.where(ok, 10.0 * np.log10(np.maximum(pspec, 1e-30) / np.where(ok, p_max, 1.0)), 0.0)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Slice spike and zipper artifact detection from air space slice and line profiles
+Profiles are accumulated during ROI timeseries extraction, so detection needs no further
+pass over the 4D series
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import warnings
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.ndimage import median_filter
+
+
+def air_profile_operator(roi_set, min_vox=4):
+    """
+    Sparse averaging operator from air space voxels to slice, row and column means
+    Applied to the gathered air space rows of each chunk of volumes, one sparse product
+    gives every profile for all volumes in the chunk
+
+    Profile rows
+    0 .. nz-1 : slice means
+    then ny * nz row means (along x) ordered y + ny * z
+    then nx * nz column means (along y) ordered x + nx * z
+
+    :param roi_set: ROISet, sparse ROI voxel indices (air space is label 1)
+    :param min_vox: int, minimum air voxels in a slice or line for a valid profile
+    :return op: csr_matrix, (n_profiles x n_air) averaging operator
+    :return valid: array, bool, profiles with at least min_vox air voxels
+    """
+
+    nx, ny, nz = roi_set.shape[:3]
+
+    # Voxel coordinates from Fortran order flat indices
+    inds = roi_set.indices(1)
+    x = inds % nx
+    y = (inds // nx) % ny
+    z = inds // (nx * ny)
+
+    rows = np.concatenate([z, nz + y + ny * z, nz + ny * nz + x + nx * z])
+    cols = np.tile(np.arange(inds.size), 3)
+
+    n_profiles = nz + (nx + ny) * nz
+    counts = np.bincount(rows, minlength=n_profiles)
+
+    valid = counts >= min_vox
+    weights = np.where(valid, 1.0 / np.maximum(counts, 1), 0.0)[rows]
+
+    op = csr_matrix((weights, (rows, cols)), shape=(n_profiles, inds.size))
+
+    return op, valid
+
+
+def slice_spikes(air_profiles, shape, spike_thresh=5.0, zipper_thresh=5.0, hp_lines=4, hp_vols=8):
+    """
+    Slice spikes and zipper lines from air space profiles
+
+    Spikes : per-slice, per-volume robust z-scores of the high-passed slice air signal over time
+    Only positive excursions are counted since EMI adds energy to the air space
+    Zippers : per-slice, per-volume robust z-scores of the high-passed row and column profiles across
+    lines, with each line scored by its median z over volumes so only persistent lines are reported
+
+    Robust z-scores are modified z-scores (0.6745 * deviation / MAD), as in spike_count
+    High-pass baselines are running medians of the neighbours only, excluding the sample itself,
+    so residuals have no point mass at zero to shrink the MAD
+
+    :param air_profiles: array, (n_profiles x nt) profiles from air_profile_operator, NaN if invalid
+    :param shape: tuple, (nx, ny, nz) image dimensions
+    :param spike_thresh: float, slice spike robust z threshold
+    :param zipper_thresh: float, zipper line score threshold
+    :param hp_lines: int, neighbouring lines (even) in the running median of the line profile high-pass
+    :param hp_vols: int, neighbouring volumes (even) in the running median of the slice signal high-pass
+    :return spikes: dict, slice spike z-scores, zipper line scores and localized detections
+    """
+
+    nx, ny, nz = shape[:3]
+    nt = air_profiles.shape[1]
+
+    p = np.asarray(air_profiles, dtype=np.float64)
+
+    # Slice air signal relative to its running median over time : (nz x nt)
+    s = p[:nz]
+    slice_z = _robust_z(s - _neighbour_median(s, hp_vols, axis=1), axis=1)
+
+    # Row (ny x nz x nt) and column (nx x nz x nt) profiles
+    row_p = p[nz:nz + ny * nz].reshape((ny, nz, nt), order='F')
+    col_p = p[nz + ny * nz:].reshape((nx, nz, nt), order='F')
+
+    row_score = _line_scores(row_p, hp_lines)
+    col_score = _line_scores(col_p, hp_lines)
+
+    # Localize spikes as (slice, volume) and zipper lines as (direction, slice, line)
+    zc, tc = np.nonzero(np.nan_to_num(slice_z) > spike_thresh)
+    order = np.argsort(-slice_z[zc, tc])
+
+    spike_list = [[int(zc[i]), int(tc[i]), float(slice_z[zc[i], tc[i]])] for i in order]
+
+    zipper_list = []
+    for direction, score in (('row', row_score), ('column', col_score)):
+        lc, zc = np.nonzero(np.nan_to_num(score) > zipper_thresh)
+        zipper_list += [[direction, int(zc[i]), int(lc[i]), float(score[lc[i], zc[i]])] for i in range(lc.size)]
+
+    zipper_list.sort(key=lambda zl: -zl[3])
+
+    scores = np.concatenate([row_score.ravel(), col_score.ravel()])
+    zipper_score = float(np.nanmax(scores)) if np.any(np.isfinite(scores)) else 0.0
+
+    return dict(slice_z=slice_z.astype(np.float32),
+                row_score=row_score.astype(np.float32),
+                col_score=col_score.astype(np.float32),
+                spike_thresh=spike_thresh,
+                n_spikes=len(spike_list),
+                spikes=spike_list,
+                zipper_score=zipper_score,
+                zipper_lines=zipper_list)
+
+
+def save_slice_spikes(spikes, spikes_fname):
+    """
+    Localized slice spikes and zipper lines as a JSON sidecar
+
+    :param spikes: dict, from slice_spikes
+    :param spikes_fname: str, output .json filename
+    """
+
+    summary = dict(SliceSpikes=[dict(Slice=z, Volume=t, Z=round(s, 2)) for z, t, s in spikes['spikes']],
+                   ZipperLines=[dict(Direction=d, Slice=z, Line=l, Score=round(s, 2))
+                                for d, z, l, s in spikes['zipper_lines']])
+
+    with open(spikes_fname, 'w') as fd:
+        json.dump(summary, fd, indent=4)
+
+
+def _line_scores(lines, hp_lines):
+    """
+    Persistence score of each line in a stack of line profiles
+
+    :param lines: array, (n_lines x nz x nt) line profiles, NaN for invalid lines
+    :param hp_lines: int, neighbouring lines in the running median
+    :return score: array, (n_lines x nz) median over volumes of the robust z across lines
+    """
+
+    invalid = np.isnan(lines)
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        # Invalid lines take the median line value so they do not bias the running median
+        filled = np.nan_to_num(np.where(invalid, np.nanmedian(lines, axis=0, keepdims=True), lines))
+
+        d = filled - _neighbour_median(filled, hp_lines, axis=0)
+        d[invalid] = np.nan
+
+        return np.nanmedian(_robust_z(d, axis=0), axis=2)
+
+
+def _neighbour_median(x, n, axis):
+    """
+    Running median of the n nearest neighbours along an axis, excluding the centre sample
+    """
+
+    footprint = np.ones(n + 1, dtype=bool)
+    footprint[n // 2] = False
+
+    shape = [1] * x.ndim
+    shape[axis] = n + 1
+
+    return median_filter(x, footprint=footprint.reshape(shape), mode='nearest')
+
+
+def _robust_z(x, axis):
+    """
+    Modified z-score along an axis (NaN ignored, zero where the MAD vanishes)
+    """
+
+    # Slices or lines without air space are all-NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(x, axis=axis, keepdims=True)
+        mad = np.nanmedian(np.abs(x - med), axis=axis, keepdims=True)
+
+    return 0.6745 * (x - med) / np.where(mad > 0, mad, np.inf)
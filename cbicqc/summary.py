@@ -30,14 +30,10 @@ SOFTWARE.
 """
 
 import os
-import shutil
-import tempfile
+import io
 import numpy as np
 from datetime import datetime
 
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
 
@@ -49,22 +45,24 @@ from reportlab.lib.units import inch
 from reportlab.platypus import (SimpleDocTemplate,
                                 Paragraph,
                                 Spacer,
-                                Image,
                                 Table,
                                 PageBreak)
 
-from .graphics import (metric_trend_plot)
+from .graphics import (metric_trend_plot, new_figure, save_figure)
+from .report import figure_flowable
 
 
 class Summarize:
 
-    def __init__(self, report_dir, metrics_df, past_months):
+    def __init__(self, report_dir, metrics_df, past_months, fig_format='png', fig_dpi=150):
         """
         Create summary report PDF and CSV file for all sessions
 
         :param report_dir: str, report output directory in derivatives
         :param metrics_df: DataFrame, session metric dataframe
         :param past_months: int, number of past months to summarize
+        :param fig_format: str, embedded figure format ('png' or 'svg')
+        :param fig_dpi: int, raster figure resolution
         """
 
         # For datetime axis labeling without warnings
@@ -88,6 +86,8 @@ class Summarize:
         self._metrics_df = metrics_df
         self._subject = metrics_df['Subject'][0]
         self._past_months = past_months
+        self._fig_format = fig_format
+        self._fig_dpi = fig_dpi
         self._summary_pdf = os.path.join(report_dir, '{}_summary.pdf'.format(self._subject))
         self._summary_csv = self._summary_pdf.replace('.pdf', '.csv')
 
@@ -98,9 +98,6 @@ class Summarize:
         # Summary PDF construction
         #
 
-        # Create working directory for images
-        self._work_dir = tempfile.mkdtemp()
-
         # Contents - list of flowables to be built into a document
         self._contents = []
 
@@ -114,9 +111,6 @@ class Summarize:
 
         self._doc.build(self._contents)
 
-        # Delete working directory
-        shutil.rmtree(self._work_dir)
-
         # Finally write CSV for metrics of interest
         self._write_csv()
 
@@ -182,37 +176,34 @@ class Summarize:
         self._contents.append(Paragraph(ptext, self._pstyles['Justify']))
         self._contents.append(Spacer(1, 0.25 * inch))
 
-        trend_png_fname = self._plot_trends()
-        trends_img = Image(trend_png_fname, 7.0 * inch, 9.0 * inch, hAlign='LEFT')
+        trends_img = figure_flowable(self._plot_trends(), 7.0 * inch, 9.0 * inch)
         self._contents.append(trends_img)
 
     def _plot_trends(self):
         """
-        Generate a PNG of the trends and histogram for each of the passed metrics
-        :return:
+        Render the trends and histogram for each of the passed metrics to memory
+        :return: bytes, rendered figure
         """
 
         # Number of metrics to plot
         n_metrics = len(self._metric_names)
 
-        # Output PNG filename
-        png_fname = os.path.join(self._work_dir, 'metric_trends.png')
-
         # Setup plot grid
-        plt.figure(figsize=(14, 18))
-        gs = gridspec.GridSpec(n_metrics, 2, width_ratios=[3, 1])
+        fig = new_figure((14, 18))
+        gs = fig.add_gridspec(n_metrics, 2, width_ratios=[3, 1])
 
         # Fill each of the subplots
         for mc, m_name in enumerate(self._metric_names):
-            metric_trend_plot(mc, m_name, self._metrics_df, gridspec=gs, past_months=self._past_months)
+            metric_trend_plot(fig, mc, m_name, self._metrics_df, gridspec=gs, past_months=self._past_months)
 
         # Tweak subplot margins and spacing
-        plt.tight_layout()
+        fig.tight_layout()
 
-        # Save plot to file
-        plt.savefig(png_fname, dpi=300)
+        # Render plot to memory
+        buf = io.BytesIO()
+        save_figure(fig, buf, dpi=self._fig_dpi, fmt=self._fig_format)
 
-        return png_fname
+        return buf.getvalue()
 
     def _write_csv(self):
 
@@ -25,15 +25,22 @@ Copyright 2019 California Institute of Technology.
 """
 
 import numpy as np
-from scipy.optimize import least_squares
+from scipy.optimize import least_squares, OptimizeResult
 import nibabel as nb
 
+from .series import iter_volume_chunks
+from .rois import as_roiset
+from .spikes import air_profile_operator
+
 
 def temporal_mean_sd(qc_moco_nii):
 
+    # Shared 4D array (no copy or float64 cast for in-memory series)
+    s = np.asanyarray(qc_moco_nii.dataobj)
+
     # Temporal mean of 4D timeseries
-    tmean = np.mean(qc_moco_nii.get_data(), axis=3)
-    tsd = np.std(qc_moco_nii.get_data(), axis=3)
+    tmean = np.mean(s, axis=3)
+    tsd = np.std(s, axis=3)
     tsfnr = tmean / (tsd + np.finfo(float).eps)
 
     tmean_nii = nb.Nifti1Image(tmean, qc_moco_nii.affine)
@@ -43,38 +50,169 @@ def temporal_mean_sd(qc_moco_nii):
     return tmean_nii, tsd_nii, tsfnr_nii
 
 
-def extract_timeseries(qc_moco_nii, rois_nii):
+def temporal_mean_sd_streaming(qc_moco_nii, chunk_mb=256):
+    """
+    Single-pass temporal mean, SD and tSFNR from chunks of volumes
+    File-backed series are streamed from disk, so peak memory is set by chunk_mb rather than
+    by series length. Chunk statistics are merged with the stable parallel Welford update.
 
-    rois = rois_nii.get_data()
-    s = qc_moco_nii.get_data()
+    :param qc_moco_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param chunk_mb: float, approximate working memory per chunk (MB)
+    :return tmean_nii, tsd_nii, tsfnr_nii: Nifti objects, temporal mean, SD and tSFNR
+    """
 
-    # Number of time points
-    nt = s.shape[3]
+    n = 0
+    tmean = np.zeros(qc_moco_nii.shape[:3])
+    m2 = np.zeros(qc_moco_nii.shape[:3])
 
-    # ROI label indices
-    # 0 : unassigned
-    # 1 : air space
-    # 2 : Nyquist ghost
-    # 3 : signal
+    for _, chunk in iter_volume_chunks(qc_moco_nii, chunk_mb):
+        n = welford_update(n, tmean, m2, chunk)
 
-    labels = [1, 2, 3]
-    nl = len(labels)
+    # Population SD to match np.std
+    tsd = np.sqrt(m2 / n)
+    tsfnr = tmean / (tsd + np.finfo(float).eps)
 
-    s_mean_t = np.zeros([nl, nt])
+    tmean_nii = nb.Nifti1Image(tmean, qc_moco_nii.affine)
+    tsd_nii = nb.Nifti1Image(tsd, qc_moco_nii.affine)
+    tsfnr_nii = nb.Nifti1Image(tsfnr, qc_moco_nii.affine)
 
-    for lc in range(0, nl):
-        mask = np.array(rois == labels[lc])
-        for tc in range(0, nt):
-            s_t = s[:, :, :, tc]
-            s_mean_t[lc, tc] = np.mean(s_t[mask])
+    return tmean_nii, tsd_nii, tsfnr_nii
+
+
+def welford_update(n, mean, m2, chunk):
+    """
+    Merge a chunk of samples along the last axis into running mean and sum of squared deviations
+    (Chan et al. parallel form of Welford's algorithm). mean and m2 are updated in place.
+
+    :param n: int, number of samples merged so far
+    :param mean: array, running mean (float64)
+    :param m2: array, running sum of squared deviations from the mean (float64)
+    :param chunk: array, new samples with time in the last axis
+    :return n: int, updated sample count
+    """
+
+    k = chunk.shape[-1]
+
+    chunk_mean = np.mean(chunk, axis=-1, dtype=np.float64)
+    chunk_m2 = np.sum(np.square(chunk - chunk_mean[..., np.newaxis], dtype=np.float64), axis=-1)
+
+    n_new = n + k
+    delta = chunk_mean - mean
+
+    mean += delta * (k / n_new)
+    m2 += chunk_m2 + np.square(delta) * (n * k / n_new)
+
+    return n_new
+
+
+def extract_timeseries(qc_moco_nii, rois, chunk_mb=256, air_profiles=False):
+    """
+    Spatial mean timeseries of every ROI label
+
+    :param qc_moco_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param rois: ROISet or Nifti object, integer ROI labels
+    :param chunk_mb: float, approximate working memory per chunk of volumes (MB)
+    :param air_profiles: bool, also return air space slice and line profiles from the same pass
+    :return s_mean_t: array, spatial mean timeseries (n_labels x nt) for labels 1, 2, ..., max label
+    :return air_profiles: array, (n_profiles x nt) air space profiles (see air_profile_operator), if requested
+    """
+
+    stats = ('mean', 'air_profiles') if air_profiles else ('mean',)
+
+    results = extract_roi_stats(qc_moco_nii, rois, stats=stats, chunk_mb=chunk_mb)
+
+    return (results['mean'], results['air_profiles']) if air_profiles else results['mean']
+
+
+def extract_roi_stats(qc_moco_nii, rois, stats=('mean', 'median', 'sd'), chunk_mb=256):
+    """
+    Spatial mean, median and SD timeseries for all ROI labels in one pass over the series
+    Each chunk of volumes is gathered as a (ROI voxels x time) block using the sorted
+    ROI voxel indices and reduced for all labels and volumes at once
+
+    ROI label indices
+    0 : unassigned
+    1 : air space
+    2 : Nyquist ghost
+    3 : signal
+    4, 5, ... : additional template labels (eg MNI atlas regions in live mode)
+
+    :param qc_moco_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param rois: ROISet or Nifti object, integer ROI labels
+    Air space slice and line profiles ('air_profiles') for slice spike and zipper detection
+    are reduced from the same gathered rows with one sparse product per chunk
+
+    :param stats: tuple, any of 'mean', 'median', 'sd', 'air_profiles'
+    :param chunk_mb: float, approximate working memory per chunk of volumes (MB)
+    :return: dict, (n_labels x nt) timeseries arrays keyed by statistic, NaN rows for empty labels
+    """
+
+    roi_set = as_roiset(rois)
+
+    nl = roi_set.n_labels
+    nt = qc_moco_nii.shape[3]
+
+    results = {stat: np.full([nl, nt], np.nan) for stat in stats if stat != 'air_profiles'}
+
+    if 'air_profiles' in stats:
+        air_op, air_valid = air_profile_operator(roi_set)
+        results['air_profiles'] = np.full([air_op.shape[0], nt], np.nan, dtype=np.float32)
+
+    for t0, chunk in iter_volume_chunks(qc_moco_nii, chunk_mb):
+
+        k = chunk.shape[3]
+
+        # Gather all ROI voxels for this chunk : (ROI voxels x k)
+        x = roi_set.gather(chunk.reshape((-1, k), order='F'))
+
+        if 'mean' in stats:
+            results['mean'][:, t0:t0 + k] = roi_set.means(x)
 
-    return s_mean_t
+        if 'air_profiles' in stats:
+            # Air space (label 1) rows lead the gathered block
+            results['air_profiles'][air_valid, t0:t0 + k] = (air_op @ x[:air_op.shape[1]])[air_valid]
 
+        for row, x_l in roi_set.split(x):
 
-def detrend_timeseries(s_mean_t):
+            if 'median' in stats:
+                results['median'][row, t0:t0 + k] = np.median(x_l, axis=0)
+
+            if 'sd' in stats:
+                results['sd'][row, t0:t0 + k] = np.std(x_l, axis=0, dtype=np.float64)
+
+    return results
+
+
+def detrend_timeseries(s_mean_t, method='batch'):
     """
-    :param s_mean_t: spatial mean ROI timeseries
-    :return:
+    Exponential + linear detrending of ROI timeseries
+
+    :param s_mean_t: spatial mean ROI timeseries (n_rois x nt)
+    :param method: str, 'batch' (vectorized variable projection fit of all timeseries)
+        or 'lsq' (per-timeseries scipy least_squares reference fit)
+    :return fit_results: list, fit result per ROI with .x (explin parameters) and .fun (explin residuals)
+    :return s_detrend_t: array, detrended timeseries (n_rois x nt)
+    """
+
+    if 'lsq' in method:
+        return _detrend_timeseries_lsq(s_mean_t)
+
+    s_mean = np.mean(s_mean_t, axis=1)
+
+    x, fun, cost = fit_explin(s_mean_t)
+
+    # Add fit residual to temporal mean - detrended timeseries
+    s_detrend_t = s_mean[:, np.newaxis] + fun
+
+    fit_results = [OptimizeResult(x=x[lc], fun=fun[lc], cost=cost[lc], success=True)
+                   for lc in range(x.shape[0])]
+
+    return fit_results, s_detrend_t
+
+
+def _detrend_timeseries_lsq(s_mean_t):
+    """
+    Reference per-ROI robust fit with scipy least_squares (numeric Jacobian)
     """
 
     nl, nt = s_mean_t.shape
@@ -104,9 +242,6 @@ def detrend_timeseries(s_mean_t):
                                bounds=bounds,
                                args=(t, s_t))
 
-        # Fitted curve
-        s_fit = explin(result.x, t, 0)
-
         # Add fit residual to temporal mean - detrended timeseries
         s_detrend_t[lc, :] = s_mean + result.fun
 
@@ -115,6 +250,288 @@ def detrend_timeseries(s_mean_t):
     return fit_results, s_detrend_t
 
 
+def fit_explin(y, loss='huber', f_scale=1.0, n_tau=48, n_iter=30):
+    """
+    Batched robust fit of the explin model to many timeseries at once by variable projection
+    For a given time constant the amplitude, slope and offset are solved in closed form
+    (bounded weighted least squares), so only the time constant is searched: a coarse grid
+    followed by vectorized Gauss-Newton steps using the analytic Jacobian in log(tau).
+    Huber loss is handled by iteratively reweighted least squares.
+
+    Same bounds as the least_squares fit: 0 <= amp <= range(y), 0 < tau <= nt, slope <= 0
+
+    :param y: array, timeseries (n_series x nt)
+    :param loss: str, 'huber' or 'linear'
+    :param f_scale: float, Huber loss soft margin (scipy least_squares convention)
+    :param n_tau: int, number of grid time constants
+    :param n_iter: int, maximum reweighting/Gauss-Newton iterations
+    :return x: array, parameters (n_series x 4) in explin order [amp, tau, slope, offset]
+    :return fun: array, explin residuals, fitted curve minus data (n_series x nt)
+    :return cost: array, robust cost per series (0.5 * sum of loss)
+    """
+
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    ns, nt = y.shape
+
+    t = np.arange(0, nt, dtype=np.float64)
+    a_max = np.max(y, axis=1) - np.min(y, axis=1)
+    tau_min, tau_max = 0.1, float(nt)
+
+    # Coarse grid search by least squares - basis shared by all series
+    best_q = np.full(ns, np.inf)
+    tau = np.full(ns, tau_max)
+
+    for tau_g in np.geomspace(0.5, tau_max, n_tau):
+
+        _, q = _bounded_lsq(*_normal_equations(np.exp(-t / tau_g), t, y, None), a_max)
+
+        better = q < best_q
+        best_q[better], tau[better] = q[better], tau_g
+
+    # Robust weights (unit weights for least squares are implicit)
+    w = np.ones_like(y) if 'huber' in loss else None
+
+    # Series still iterating
+    act = np.arange(ns)
+
+    for _ in range(n_iter):
+
+        ya, ta, aa = y[act], tau[act], a_max[act]
+        wa = None if w is None else w[act]
+
+        e = np.exp(-t / ta[:, np.newaxis])
+        G, rhs = _normal_equations(e, t, ya, wa)
+        p, _ = _bounded_lsq(G, rhs, aa)
+        r = _explin_fun(p, e, t, ya)
+
+        if 'huber' in loss:
+            wa_new = _huber_weights(r, f_scale)
+            dw = np.max(np.abs(wa_new - wa), axis=1)
+            w[act] = wa = wa_new
+            G, rhs = _normal_equations(e, t, ya, wa)
+            p, _ = _bounded_lsq(G, rhs, aa)
+            r = _explin_fun(p, e, t, ya)
+        else:
+            dw = np.zeros(len(act))
+
+        cost = _robust_cost(r, loss, f_scale)
+
+        # Analytic derivative of the model with respect to log(tau)
+        J = p[:, 0:1] * e * (t / ta[:, np.newaxis])
+
+        # Variable projection (Kaufman) : remove the component of J in the span of the linear basis
+        wJ = J if wa is None else wa * J
+        BWJ = np.stack([np.sum(wJ * e, axis=1), wJ @ t, np.sum(wJ, axis=1)], axis=1)
+        c = _solve_small(_ridge(G), BWJ)
+        J_perp = J - (c[:, 0:1] * e + c[:, 1:2] * t + c[:, 2:3])
+
+        wJ_perp = J_perp if wa is None else wa * J_perp
+        num = np.sum(wJ_perp * r, axis=1)
+        den = np.sum(wJ_perp * J_perp, axis=1)
+        step = np.where(den > 0, -num / np.where(den > 0, den, 1.0), 0.0)
+
+        # Limit each step to a factor of e^2 in tau
+        step = np.clip(step, -2.0, 2.0)
+
+        # Backtracking : accept the first halving that reduces the robust cost
+        todo = np.flatnonzero(np.abs(step) > 1e-4)
+        moved = np.zeros(len(act), dtype=bool)
+
+        for h in [1.0, 0.5, 0.25, 0.125]:
+
+            if todo.size == 0:
+                break
+
+            tau_new = np.clip(ta[todo] * np.exp(h * step[todo]), tau_min, tau_max)
+            e_new = np.exp(-t / tau_new[:, np.newaxis])
+            y_new, w_new = ya[todo], None if wa is None else wa[todo]
+            p_new, _ = _bounded_lsq(*_normal_equations(e_new, t, y_new, w_new), aa[todo])
+            cost_new = _robust_cost(_explin_fun(p_new, e_new, t, y_new), loss, f_scale)
+
+            ok = cost_new < cost[todo]
+            tau[act[todo[ok]]] = tau_new[ok]
+            moved[todo[ok]] = True
+            todo = todo[~ok]
+
+        # Converged once tau is stationary and the robust weights have settled
+        act = act[moved | (dw > 1e-3)]
+
+        if act.size == 0:
+            break
+
+    # Final linear parameters for the converged time constants
+    e = np.exp(-t / tau[:, np.newaxis])
+    p, _ = _bounded_lsq(*_normal_equations(e, t, y, w), a_max)
+    fun = _explin_fun(p, e, t, y)
+
+    x = np.stack([p[:, 0], tau, p[:, 1], p[:, 2]], axis=1)
+
+    return x, fun, _robust_cost(fun, loss, f_scale)
+
+
+def _normal_equations(e, t, y, w):
+    """
+    Weighted normal equations for the linear basis [exp(-t/tau), t, 1]
+
+    :param e: array, exponential basis, shared (nt,) or per series (n_series x nt)
+    :param w: array, weights (n_series x nt) or None for unit weights
+    :return G: array, Gram matrices (n_series x 3 x 3)
+    :return rhs: array, basis-data products (n_series x 3)
+    """
+
+    ns, nt = y.shape
+
+    if w is None and e.ndim == 1:
+
+        B = np.stack([e, t, np.ones(nt)], axis=1)
+        G = np.broadcast_to(B.T @ B, (ns, 3, 3))
+        rhs = y @ B
+
+        return G, rhs
+
+    ww = np.ones_like(y) if w is None else w
+    e = np.broadcast_to(e, y.shape)
+
+    we = ww * e
+    sw, swt, swtt = np.sum(ww, axis=1), ww @ t, ww @ (t * t)
+    swe, swet, swee = np.sum(we, axis=1), we @ t, np.sum(we * e, axis=1)
+
+    G = np.stack([np.stack([swee, swet, swe], axis=1),
+                  np.stack([swet, swtt, swt], axis=1),
+                  np.stack([swe, swt, sw], axis=1)], axis=1)
+
+    wy = ww * y
+    rhs = np.stack([np.sum(wy * e, axis=1), wy @ t, np.sum(wy, axis=1)], axis=1)
+
+    return G, rhs
+
+
+def _bounded_lsq(G, rhs, a_max):
+    """
+    Solve the normal equations for [amp, slope, offset] with 0 <= amp <= a_max and slope <= 0
+    The problem is a convex quadratic, so the constrained optimum is the lowest cost feasible
+    solution over all combinations of free and bound-fixed amplitude and slope
+
+    :return p: array, [amp, slope, offset] (n_series x 3)
+    :return q: array, weighted sum of squares up to a per-series constant
+    """
+
+    ns = rhs.shape[0]
+
+    best_p = np.zeros([ns, 3])
+    best_q = np.full(ns, np.inf)
+
+    for fix_a in [None, 0.0, 'max']:
+        for fix_b in [None, 0.0]:
+
+            p = np.zeros([ns, 3])
+            if fix_a is not None:
+                p[:, 0] = a_max if fix_a == 'max' else fix_a
+
+            free = [i for i, f in enumerate([fix_a, fix_b, None]) if f is None]
+
+            # Right hand side for free parameters given fixed parameters
+            r = rhs - np.einsum('sij,sj->si', G, p)
+            Gf = _sub_matrix(G, free)
+            p[:, free] = _solve_small(_ridge(Gf), r[:, free])
+
+            feasible = (p[:, 0] >= 0) & (p[:, 0] <= a_max) & (p[:, 1] <= 0)
+
+            # Quadratic cost up to a per-series constant
+            q = np.einsum('si,sij,sj->s', p, G, p) - 2.0 * np.sum(p * rhs, axis=1)
+
+            better = feasible & (q < best_q)
+            best_p[better], best_q[better] = p[better], q[better]
+
+    return best_p, best_q
+
+
+def _solve_small(A, b):
+    """
+    Solve many small (1x1 to 3x3) linear systems in closed form
+    Much faster than batched LAPACK calls for millions of tiny systems
+
+    :param A: array, system matrices (n_series x n x n), possibly broadcast from one matrix
+    :param b: array, right hand sides (n_series x n)
+    :return x: array, solutions (n_series x n)
+    """
+
+    n = A.shape[-1]
+
+    # Shared matrix (broadcast along the series axis) - single inverse
+    if _is_shared(A):
+        return b @ np.linalg.inv(A[0]).T
+
+    if n == 1:
+        return b / A[:, 0, :]
+
+    if n == 2:
+        det = A[:, 0, 0] * A[:, 1, 1] - A[:, 0, 1] * A[:, 1, 0]
+        x0 = A[:, 1, 1] * b[:, 0] - A[:, 0, 1] * b[:, 1]
+        x1 = A[:, 0, 0] * b[:, 1] - A[:, 1, 0] * b[:, 0]
+        return np.stack([x0, x1], axis=1) / det[:, np.newaxis]
+
+    # 3x3 inverse rows are cross products of matrix columns divided by the determinant
+    c0, c1, c2 = A[:, :, 0], A[:, :, 1], A[:, :, 2]
+    adj = np.stack([np.cross(c1, c2), np.cross(c2, c0), np.cross(c0, c1)], axis=1)
+    det = np.sum(c0 * adj[:, 0], axis=1)
+
+    return np.einsum('sij,sj->si', adj, b) / det[:, np.newaxis]
+
+
+def _is_shared(G):
+
+    # One matrix broadcast along the series axis
+    return G.shape[0] > 1 and G.strides[0] == 0
+
+
+def _sub_matrix(G, idx):
+
+    # Keep shared (broadcast) matrices shared
+    if _is_shared(G):
+        return np.broadcast_to(G[:1][:, idx][:, :, idx], (G.shape[0], len(idx), len(idx)))
+
+    return G[:, idx][:, :, idx]
+
+
+def _ridge(G, eps=1e-10):
+
+    # Small diagonal load keeps near-collinear bases (eg tau ~ nt) solvable
+    n = G.shape[-1]
+
+    if _is_shared(G):
+        return np.broadcast_to(_ridge(G[:1], eps), G.shape)
+
+    scale = np.trace(G, axis1=-2, axis2=-1)[:, np.newaxis, np.newaxis] / n
+
+    return G + eps * scale * np.eye(n)
+
+
+def _explin_fun(p, e, t, y):
+
+    # Fitted curve minus data (explin residual convention)
+    return p[:, 0:1] * e + p[:, 1:2] * t + p[:, 2:3] - y
+
+
+def _huber_weights(r, f_scale):
+
+    ar = np.abs(r)
+
+    return np.where(ar <= f_scale, 1.0, f_scale / np.maximum(ar, f_scale))
+
+
+def _robust_cost(r, loss, f_scale):
+
+    z = (r / f_scale) ** 2
+
+    if 'huber' in loss:
+        rho = np.where(z <= 1, z, 2 * np.sqrt(z) - 1)
+    else:
+        rho = z
+
+    return 0.5 * f_scale ** 2 * np.sum(rho, axis=1)
+
+
 def explin(x, t, y):
     """
     Exponential + linear trend model
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing and peak memory tracing
+Traces are written in Chrome trace-event JSON format (load in chrome://tracing or Perfetto)
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+import time
+import resource
+import tracemalloc
+import threading
+import contextlib
+
+
+class StageTracer:
+
+    def __init__(self, trace_memory=False):
+        """
+        Records wall time and peak memory of (possibly nested) analysis stages
+
+        :param trace_memory: bool, track per-stage peak memory with tracemalloc (numpy allocations included)
+            Tracing slows every allocation, so by default only the process RSS high-water mark is recorded
+        """
+
+        self._events = []
+        self._stack = []
+        self._pid = os.getpid()
+        self._tid = threading.get_ident()
+
+        # Per-stage peaks need tracemalloc.reset_peak (Python 3.9+)
+        # Fall back to the process high-water mark otherwise
+        self._trace_memory = trace_memory and hasattr(tracemalloc, 'reset_peak')
+
+        if self._trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        """
+        Time a stage and record its peak memory
+
+        :param name: str, stage name
+        :param args: dict, additional values to record with the stage
+        :return event: dict, trace event - callers may add to event['args'] within the block
+        """
+
+        event = dict(name=name, cat='cbicqc', ph='X', pid=self._pid, tid=self._tid, args=dict(args))
+
+        if self._trace_memory:
+
+            # Bank the enclosing stage's peak before resetting for this stage
+            _, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+
+        frame = dict(peak=0)
+        self._stack.append(frame)
+
+        event['ts'] = time.time() * 1e6
+        t0 = time.perf_counter()
+
+        try:
+
+            yield event
+
+        finally:
+
+            event['dur'] = (time.perf_counter() - t0) * 1e6
+
+            self._stack.pop()
+
+            if self._trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                frame['peak'] = max(frame['peak'], peak)
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+                event['args']['peak_mb'] = round(frame['peak'] / 2 ** 20, 3)
+            else:
+                event['args']['max_rss_mb'] = round(_max_rss_mb(), 3)
+
+            self._events.append(event)
+
+    def save(self, trace_fname):
+        """
+        Write Chrome trace-event JSON
+        """
+
+        events = sorted(self._events, key=lambda ev: ev['ts'])
+
+        with open(trace_fname, 'w') as fd:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fd, indent=1)
+
+
+def _max_rss_mb():
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 2 ** 20 if os.uname().sysname == 'Darwin' else 2 ** 10
+
+    return maxrss / scale
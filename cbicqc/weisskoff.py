@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Weisskoff analysis and radius of decorrelation (fBIRN phantom QC protocol)
+
+MIT License
+
+Copyright (c) 2026 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import numpy as np
+
+from .rois import as_roiset
+
+
+def weisskoff(img_nii, rois, n_max=21):
+    """
+    Weisskoff fluctuation analysis of square ROIs centered on the phantom
+    Each volume of the central phantom slice is reduced to a 2D summed-area table, so the
+    mean of every ROI size from 1 x 1 to N x N needs four table lookups per size and volume
+
+    Following the fBIRN protocol, each ROI mean timeseries is detrended with a second order
+    polynomial and its fluctuation is the residual SD as a percentage of the mean. Uncorrelated
+    noise falls as 1/N, and the radius of decorrelation (RDC) is F(1) / F(N_max), the ROI size
+    beyond which larger ROIs no longer reduce the fluctuation
+
+    :param img_nii: Nifti object, 4D series (in-memory or file-backed)
+    :param rois: ROISet or Nifti object, integer ROI labels (signal labels >= 3)
+    :param n_max: int, largest ROI width (voxels), reduced to fit within the slice
+    :return results: dict, ROI widths, measured and theoretical fluctuations (%) and RDC (voxels)
+    """
+
+    roi_set = as_roiset(rois)
+
+    nx, ny, nz, nt = img_nii.shape[:4]
+
+    # Phantom center from the signal voxel centroid
+    inds = roi_set.indices_from(3)
+    xc = int(round(np.mean(inds % nx)))
+    yc = int(round(np.mean((inds // nx) % ny)))
+    zc = int(round(np.mean(inds // (nx * ny))))
+
+    # Central slice timeseries : (nx x ny x nt)
+    img = np.asarray(img_nii.dataobj[:, :, zc, :], dtype=np.float64)
+
+    # Summed-area table of every volume, zero padded so s[x, y] sums img[:x, :y]
+    sat = np.zeros([nx + 1, ny + 1, nt])
+    np.cumsum(np.cumsum(img, axis=0), axis=1, out=sat[1:, 1:])
+
+    # Square ROIs of width 1 .. n_max, centered on the phantom and within the slice
+    n_max = int(min(n_max, 2 * min(xc, yc) + 1, 2 * min(nx - 1 - xc, ny - 1 - yc) + 1))
+    widths = np.arange(1, n_max + 1)
+
+    x0 = xc - (widths - 1) // 2
+    y0 = yc - (widths - 1) // 2
+    x1, y1 = x0 + widths, y0 + widths
+
+    # ROI mean timeseries of all widths at once : (n_widths x nt)
+    roi_sums = sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]
+    roi_means = roi_sums / (widths ** 2)[:, np.newaxis]
+
+    # Quadratic detrend of all ROI timeseries with one least squares solve
+    t = np.arange(nt, dtype=np.float64)
+    coeffs = np.polynomial.polynomial.polyfit(t, roi_means.T, 2)
+    resid = roi_means - np.polynomial.polynomial.polyval(t, coeffs)
+
+    # Percent fluctuation of each ROI width
+    cv = 100.0 * np.std(resid, axis=1) / np.mean(roi_means, axis=1)
+    cv_theory = cv[0] / widths
+
+    return dict(widths=widths,
+                cv=cv,
+                cv_theory=cv_theory,
+                rdc=float(cv[0] / cv[-1]),
+                center=[xc, yc, zc])
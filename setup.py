@@ -147,7 +147,6 @@ setup(
     install_requires=['pydicom>=1.2.2',
                       'numpy>=1.15.2',
                       'scipy',
-                      'pybids',
                       'nibabel',
                       'nipype',
                       'reportlab',
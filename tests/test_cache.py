@@ -0,0 +1,61 @@
+"""
+Stage cache pruning and result storage
+"""
+
+import os
+import time
+import numpy as np
+import nibabel as nb
+
+from cbicqc.cache import StageCache
+
+
+def _stage(n):
+    return np.zeros(n, dtype=np.uint8)
+
+
+def _series(n):
+    return nb.Nifti1Image(np.zeros([4, 4, 4, n], dtype=np.float32), np.eye(4))
+
+
+def test_prune_size_and_age(tmp_path):
+
+    cache = StageCache(str(tmp_path))
+
+    keys = [cache.run(_stage, params=dict(n=2 ** 20 + k))[1] for k in range(4)]
+
+    # Stored oldest first : age the first entry past the limit
+    for k, key in enumerate(keys):
+        t = time.time() - 86400.0 * (10 if k == 0 else 4 - k)
+        os.utime(cache._entry_dir(key), (t, t))
+
+    n_removed, _ = cache.prune(max_gb=0, max_age_days=5)
+    assert n_removed == 1
+
+    # Two ~1 MB entries fit in 2.5 MB, the least recently used one goes
+    n_removed, size_gb = cache.prune(max_gb=2.5 / 1024, max_age_days=0)
+    assert n_removed == 1
+    assert size_gb <= 2.5 / 1024
+    assert [cache.lookup(_stage, params=dict(n=2 ** 20 + k))[0] for k in range(4)] == [False, False, True, True]
+
+
+def test_4d_results_cached(tmp_path):
+
+    # 4D results that are not the series itself (eg band power maps) are cached
+    cache = StageCache(str(tmp_path))
+
+    cache.run(_series, params=dict(n=3))
+    result, _ = cache.run(_series, params=dict(n=3))
+
+    assert cache.hit
+    assert result.shape == (4, 4, 4, 3)
+
+
+def test_keep_false_not_stored(tmp_path):
+
+    cache = StageCache(str(tmp_path))
+
+    _, key = cache.run(_series, params=dict(n=3), keep=False)
+
+    assert not cache.lookup(_series, params=dict(n=3))[0]
+    assert key == cache.lookup(_series, params=dict(n=3))[2]
@@ -0,0 +1,51 @@
+"""
+Directory follower for real-time QC with slow and partial writes
+"""
+
+import os
+import gzip
+import threading
+import numpy as np
+import nibabel as nb
+
+from cbicqc.realtime import IncrementalQC, follow_directory
+
+
+def _volumes(nt=12, shape=(16, 16, 8)):
+    x, y, z = np.meshgrid(*[np.arange(n) - (n - 1) / 2.0 for n in shape], indexing='ij')
+    vol = 1000.0 * (x ** 2 / 25.0 + y ** 2 / 25.0 + z ** 2 / 6.0 < 1.0) + 5.0
+    rng = np.random.default_rng(5)
+    return [(vol + rng.normal(0, 5.0, shape)).astype(np.float32) for _ in range(nt)]
+
+
+def test_partial_file_retried(tmp_path):
+
+    in_dir = str(tmp_path)
+    vols = _volumes()
+    affine = np.diag([3.0, 3.0, 4.0, 1.0])
+
+    for tc, vol in enumerate(vols[:-1]):
+        nb.save(nb.Nifti1Image(vol, affine), os.path.join(in_dir, 'vol_{}.nii.gz'.format(tc)))
+
+    # Last volume starts as a truncated gzip stream and is completed a little later
+    last_fname = os.path.join(in_dir, 'vol_{}.nii.gz'.format(len(vols) - 1))
+    full = gzip.compress(nb.Nifti1Image(vols[-1], affine).to_bytes())
+
+    with open(last_fname, 'wb') as fd:
+        fd.write(full[:len(full) // 2])
+
+    def _finish():
+        with open(last_fname, 'wb') as fd:
+            fd.write(full)
+
+    timer = threading.Timer(0.5, _finish)
+    timer.start()
+
+    try:
+        qc = IncrementalQC(report_every=100, n_init=4)
+        metrics = follow_directory(in_dir, qc, poll_interval=0.1, timeout=3.0, n_volumes=len(vols))
+    finally:
+        timer.join()
+
+    assert qc.n_volumes == len(vols)
+    assert metrics['Volumes'] == len(vols)
@@ -0,0 +1,61 @@
+"""
+Spline and Fourier shift_volumes backends agree, invert each other on a smooth volume
+and differ in speed
+"""
+
+import time
+import numpy as np
+import pytest
+
+from cbicqc.resample import shift_volumes
+
+
+def _blob(shape=(32, 32, 24), nt=4):
+    # Smooth, effectively band-limited Gaussian blob well inside the FOV
+    x, y, z = np.meshgrid(*[np.arange(n) - (n - 1) / 2.0 for n in shape], indexing='ij')
+    vol = 100.0 * np.exp(-(x ** 2 / 40.0 + y ** 2 / 30.0 + z ** 2 / 10.0))
+    return np.repeat(vol[..., np.newaxis], nt, axis=3)
+
+
+def _shifts(nt=4):
+    rng = np.random.default_rng(0)
+    return rng.uniform(-1.5, 1.5, size=(nt, 3))
+
+
+def test_backends_agree():
+
+    img, shifts = _blob(), _shifts()
+
+    s_spline = shift_volumes(img, shifts, method='spline', order=3)
+    s_fourier = shift_volumes(img, shifts, method='fourier')
+
+    assert np.max(np.abs(s_spline - s_fourier)) < 0.005 * np.max(img)
+
+
+@pytest.mark.parametrize('method, tol', [('spline', 0.01), ('fourier', 1e-6)])
+def test_shift_inverts(method, tol):
+
+    img, shifts = _blob(), _shifts()
+
+    moved = shift_volumes(img, shifts, method=method)
+    restored = shift_volumes(moved, -shifts, method=method)
+
+    assert np.max(np.abs(restored - img)) < tol * np.max(img)
+
+
+def test_fourier_faster_than_cubic_spline():
+
+    # Typical phantom series dimensions, single threaded for a like-for-like comparison
+    rng = np.random.default_rng(2)
+    img = rng.normal(size=(64, 64, 30, 8)).astype(np.float32)
+    shifts = rng.uniform(-1.0, 1.0, size=(8, 3))
+
+    dur = dict()
+
+    for method in ('spline', 'fourier'):
+        t0 = time.perf_counter()
+        shift_volumes(img, shifts, method=method, order=3, n_threads=1)
+        dur[method] = time.perf_counter() - t0
+
+    # About 20x faster on a single core, asserted with a wide margin
+    assert dur['fourier'] < 0.5 * dur['spline']
@@ -0,0 +1,80 @@
+"""
+Native rigid motion correction recovers known synthetic motion
+"""
+
+import numpy as np
+import nibabel as nb
+
+from cbicqc.rigid import moco_rigid, rigid_params, RigidRegistration, _rigid_matrix
+
+
+VOX_MM = np.array([2.0, 2.0, 2.5])
+
+
+def _phantom(A, shape=(48, 48, 32)):
+    """
+    Analytic phantom sampled so that reference mm coordinates x map to moving coordinates A x
+    """
+
+    grid = np.indices(shape).reshape(3, -1).T
+    y_mm = (grid - (np.array(shape) - 1) / 2.0) * VOX_MM
+
+    A_inv = np.linalg.inv(A)
+    x_mm = y_mm @ A_inv[:3, :3].T + A_inv[:3, 3]
+
+    # Asymmetric sum of Gaussian blobs so every rotation axis is observable
+    blobs = [(100.0, [0.0, 0.0, 0.0], 12.0),
+             (60.0, [15.0, 5.0, 8.0], 9.0),
+             (40.0, [-10.0, 14.0, -6.0], 8.0),
+             (30.0, [4.0, -16.0, 10.0], 8.0)]
+
+    vol = np.zeros(grid.shape[0])
+    for amp, c, w in blobs:
+        vol += amp * np.exp(-np.sum((x_mm - c) ** 2, axis=1) / (2 * w ** 2))
+
+    return vol.reshape(shape)
+
+
+def test_moco_rigid_recovers_motion():
+
+    # [rotation vector (radians), translation (mm)]
+    p_true = np.array([[0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                       [0.02, 0.0, 0.0, 1.0, 0.0, 0.0],
+                       [0.0, -0.03, 0.01, 0.0, -1.5, 0.5],
+                       [0.01, 0.02, -0.02, -0.8, 1.2, -1.0]])
+
+    A_true = [_rigid_matrix(p) for p in p_true]
+
+    img = np.stack([_phantom(A) for A in A_true], axis=3).astype(np.float32)
+    img_nii = nb.Nifti1Image(img, np.diag(np.append(VOX_MM, 1.0)))
+
+    moco_nii, moco_pars = moco_rigid(img_nii, reference='first', n_threads=1)
+
+    pars_true = np.array([rigid_params(A) for A in A_true])
+
+    # Within 0.01 degree and 0.005 mm
+    np.testing.assert_allclose(moco_pars[:, :3], pars_true[:, :3], atol=np.radians(0.01))
+    np.testing.assert_allclose(moco_pars[:, 3:], pars_true[:, 3:], atol=0.005)
+
+    # Corrected volumes match the reference volume
+    moco = moco_nii.get_fdata()
+    ref = img[..., 0]
+    assert np.max(np.abs(moco - ref[..., np.newaxis])) < 0.02 * np.max(ref)
+
+
+def test_trilinear_cost_bias():
+
+    # Trilinear interpolation in the registration cost biases rotations by about 0.15 degree here,
+    # which cubic interpolation (the default) removes
+    p_true = np.array([0.01, 0.02, -0.02, -0.8, 1.2, -1.0])
+    A_true = _rigid_matrix(p_true)
+
+    ref, mov = _phantom(np.eye(4)), _phantom(A_true)
+
+    err = []
+    for order in (1, 3):
+        A = RigidRegistration(ref, VOX_MM, order=order).register(mov)
+        err.append(np.max(np.abs(rigid_params(A)[:3] - rigid_params(A_true)[:3])))
+
+    assert err[0] > np.radians(0.05)
+    assert err[1] < np.radians(0.01)
@@ -0,0 +1,32 @@
+"""
+Sphere fit of the phantom temporal mean, including slabs that truncate the sphere in z
+"""
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from cbicqc.rois import fit_sphere
+
+
+VOX_MM = np.array([3.0, 3.0, 4.0])
+
+
+def _sphere(center_vox, radius_mm, shape=(64, 64, 30)):
+    grid = np.indices(shape).astype(float)
+    r_mm = np.sqrt(sum(((g - c) * d) ** 2 for g, c, d in zip(grid, center_vox, VOX_MM)))
+    tmean = np.where(r_mm <= radius_mm, 1000.0, 10.0).astype(np.float32)
+    return nb.Nifti1Image(tmean, np.diag(np.append(VOX_MM, 1.0)))
+
+
+@pytest.mark.parametrize('center_vox', [[31.5, 32.0, 14.5],    # whole sphere
+                                        [30.0, 33.0, 8.0],     # truncated below
+                                        [33.0, 31.0, 24.0]])   # truncated above
+def test_fit_sphere(center_vox):
+
+    radius_mm = 50.0
+
+    center, radius = fit_sphere(_sphere(center_vox, radius_mm))
+
+    np.testing.assert_allclose(center, center_vox, atol=0.25)
+    assert radius == pytest.approx(radius_mm, abs=1.0)
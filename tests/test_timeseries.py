@@ -0,0 +1,41 @@
+"""
+Batched variable projection explin fit against the per-timeseries least_squares reference
+"""
+
+import numpy as np
+
+from cbicqc.timeseries import detrend_timeseries, explin
+
+
+def _curves(n=12, nt=200):
+    rng = np.random.default_rng(1)
+    t = np.arange(nt)
+    x_true = np.stack([rng.uniform(5, 50, n),
+                       rng.uniform(5, 60, n),
+                       -rng.uniform(0, 0.05, n),
+                       rng.uniform(800, 1200, n)], axis=1)
+    model = np.stack([explin(x, t, 0.0) for x in x_true])
+    return model + rng.normal(0, 1.0, model.shape)
+
+
+def test_batch_cost_matches_lsq():
+
+    y = _curves()
+
+    batch, _ = detrend_timeseries(y, method='batch')
+    lsq, _ = detrend_timeseries(y, method='lsq')
+
+    for b, r in zip(batch, lsq):
+        assert b.cost <= r.cost * 1.005 + 1e-9
+
+
+def test_batch_detrended_residuals():
+
+    y = _curves()
+    t = np.arange(y.shape[1])
+
+    batch, s_detrend_t = detrend_timeseries(y, method='batch')
+
+    for lc, b in enumerate(batch):
+        np.testing.assert_allclose(b.fun, explin(b.x, t, y[lc]))
+        np.testing.assert_allclose(s_detrend_t[lc], np.mean(y[lc]) + b.fun)